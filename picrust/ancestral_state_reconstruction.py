@@ -17,51 +17,229 @@ from os import makedirs, remove, popen
 from subprocess import Popen, PIPE, STDOUT
 from picrust.count import wagner_for_picrust
 from picrust.ace import ace_for_picrust
+from picrust.native_asr import wagner_native_for_picrust, pic_native_for_picrust,\
+  bm_native_for_picrust
 from cogent import LoadTable
 from cogent.util.table import Table
 from cogent.app.util import get_tmp_filename
 from picrust.util import get_picrust_project_dir
 from os.path import join
 from time import sleep
+from multiprocessing import Pool, cpu_count
+from math import ceil
 
-from picrust.parallel import submit_jobs, system_call,wait_for_output_files
+from picrust.parallel import submit_jobs, system_call,wait_for_job_sentinels,\
+  wrap_command_with_sentinel, get_sentinel_fp
+from picrust.asr_cache import run_asr_with_cache
 
 def combine_asr_tables(output_files,verbose=False):
-    """ Combine all tables coming from asr output. Cuts 2nd column out and joins them together into single table.
+    """ Combine all tables coming from asr output. Cuts out all but the 1st column and joins them together into single table.
     Assumes all output files have same row identifiers and that these are in the same order.
     """
+    def load_tables():
+        for i,output_file in enumerate(output_files):
+            if verbose:
+                print "Combining file {0} of {1}: {2}".format(i,len(output_files),output_file)
+            yield LoadTable(filename=output_file,header=True,sep='\t')
+
+    return combine_asr_table_objects(load_tables())
+
+def combine_asr_table_objects(tables):
+    """ Combine asr Table objects. Cuts out all but the 1st column of each and joins them together into single table.
+    Assumes all tables have same row identifiers and that these are in the same order.
+    Tables may have any number of trait columns (e.g. from jobs with blocks of traits).
+    """
 
     #Going to store an array of arrays here
     combined_table=[]
    
-    #load in the first column (containing row ids). File doesn't matter since they should all have identical first columns.
-    table=LoadTable(filename=output_files[0],header=True,sep='\t')
-    row_ids = table.getRawData(columns=[table.Header[0]])
-    combined_table.append([table.Header[0]])
-    for row_id in row_ids:
-        combined_table.append([row_id])
-            
-    #Now add the rest of the files to the table
-    for i,output_file in enumerate(output_files):
-        if verbose:
-            print "Combining file {0} of {1}: {2}".format(i,len(output_files),output_file)
-        #pull out the second column (first column with actual preditions)
-        table=LoadTable(filename=output_file,header=True,sep='\t')
-        predictions = table.getRawData(columns=[table.Header[1]])
-
-        #Add the header for our column to the list of headers
-        combined_table[0].append(table.Header[1])
-
-        #Add rest of values in the column 
+    for table in tables:
+        if not combined_table:
+            #load in the first column (containing row ids). Table doesn't matter since they should all have identical first columns.
+            row_ids = table.getRawData(columns=[table.Header[0]])
+            combined_table.append([table.Header[0]])
+            for row_id in row_ids:
+                combined_table.append([row_id])
+
+        #Add the headers for the columns with actual predictions to the list of headers
+        combined_table[0].extend(table.Header[1:])
+
+        #Add rest of values in the columns
         j=1
-        for prediction in predictions:
-            combined_table[j].append(prediction)
+        for row in table.getRawData():
+            combined_table[j].extend(row[1:])
             j+=1
 
     return combined_table
 
-def run_asr_in_parallel(tree, table, asr_method, parallel_method='sge',tmp_dir='jobs/',num_jobs=100, verbose=False):
-    '''Runs the ancestral state reconstructions in parallel'''
+def run_asr_for_picrust(tree,table,asr_method,HALT_EXEC=False,cache_dir=None):
+    """Runs a single ancestral state reconstruction on a tree and trait table filepath
+
+    asr_method -- one of the keys of ASR_METHODS (e.g. 'ace_pic' or 'wagner')
+    cache_dir -- if provided, an ASR cache directory (see picrust.asr_cache). Only
+    traits that aren't already in the cache are reconstructed.
+
+    Returns the asr Table and the confidence interval Table (None for methods, such
+    as wagner, that don't calculate confidence intervals).
+    """
+    if asr_method not in ASR_METHODS:
+        raise ValueError("Unknown asr_method: %s. Valid choices are: %s" %\
+          (asr_method,', '.join(sorted(ASR_METHODS))))
+    if cache_dir is not None:
+        return run_asr_with_cache(tree,table,asr_method,cache_dir,\
+          lambda table_fp: ASR_METHODS[asr_method](tree,table_fp,HALT_EXEC=HALT_EXEC))
+    return ASR_METHODS[asr_method](tree,table,HALT_EXEC=HALT_EXEC)
+
+def _wagner_asr(tree,table,HALT_EXEC=False):
+    return wagner_for_picrust(tree,table,HALT_EXEC=HALT_EXEC),None
+
+def _wagner_native_asr(tree,table,HALT_EXEC=False):
+    return wagner_native_for_picrust(tree,table),None
+
+#Functions taking (tree filepath, trait table filepath, HALT_EXEC) and 
+#returning (asr table, ci table) for each asr method
+ASR_METHODS={\
+  'wagner':_wagner_asr,\
+  'wagner_native':_wagner_native_asr,\
+  'ace_ml':lambda tree,table,HALT_EXEC=False: ace_for_picrust(tree,table,'ML',HALT_EXEC=HALT_EXEC),\
+  'ace_reml':lambda tree,table,HALT_EXEC=False: ace_for_picrust(tree,table,'REML',HALT_EXEC=HALT_EXEC),\
+  'ace_pic':lambda tree,table,HALT_EXEC=False: ace_for_picrust(tree,table,'pic',HALT_EXEC=HALT_EXEC),\
+  'pic_native':lambda tree,table,HALT_EXEC=False: pic_native_for_picrust(tree,table),\
+  'ml_native':lambda tree,table,HALT_EXEC=False: bm_native_for_picrust(tree,table,'ML'),\
+  'reml_native':lambda tree,table,HALT_EXEC=False: bm_native_for_picrust(tree,table,'REML'),\
+}
+
+def get_trait_blocks(num_traits,traits_per_job):
+    """Split trait columns 1..num_traits into blocks of consecutive columns, one per job
+
+    Returns a list of lists of column indices.  Each job runs the asr method once for
+    its block, so the tree is loaded and the asr app started once per block rather than
+    once per trait.
+    """
+    if traits_per_job < 1:
+        raise ValueError("traits_per_job must be at least 1, not %s" % traits_per_job)
+    columns=range(1,num_traits+1)
+    return [columns[i:i+traits_per_job] for i in range(0,num_traits,traits_per_job)]
+
+def _table_to_raw(table):
+    """Return (header, rows) for a Table, so it can be passed between processes"""
+    if table is None:
+        return None
+    return list(table.Header),table.getRawData()
+
+def _run_asr_for_block(args):
+    """Run asr for a block of trait columns (local_pool worker process function)
+
+    Returns the block index with the asr and ci tables as (header, rows), since
+    cogent Tables can't be pickled.
+    """
+    i,tree,header,rows,asr_method,tmp_dir=args
+
+    #the asr apps read their input from file, so write out the block's trait table
+    block_fp=get_tmp_filename(tmp_dir=tmp_dir,prefix='in_asr_')
+    Table(header=header,rows=rows).writeToFile(block_fp,sep='\t')
+    try:
+        asr_table,ci_table=run_asr_for_picrust(tree,block_fp,asr_method)
+    finally:
+        remove(block_fp)
+    return i,_table_to_raw(asr_table),_table_to_raw(ci_table)
+
+def run_asr_in_local_pool(tree, table, asr_method, tmp_dir='jobs/', num_jobs=None, traits_per_job=None, verbose=False):
+    """Runs the ancestral state reconstruction for blocks of traits in a pool of local processes
+
+    tree -- the tree filepath
+    table -- the trait table filepath
+    num_jobs -- the number of worker processes (default and maximum: the number of cpus)
+    traits_per_job -- the number of trait columns reconstructed by each asr run
+    (default: enough for four blocks per process, to balance the load while 
+    starting few asr runs)
+    
+    Each block of trait columns is sent directly to a worker, and the reconstructions are returned
+    to this process as soon as they finish, so no jobs or output files are written and
+    there is no polling for results. Returns the combined asr Table and ci Table (the
+    latter is None for methods, such as wagner, without confidence intervals).
+    """
+    if asr_method not in ASR_METHODS:
+        raise ValueError("Unknown asr_method: %s. Valid choices are: %s" %\
+          (asr_method,', '.join(sorted(ASR_METHODS))))
+
+    table=LoadTable(filename=table, header=True, sep='\t')
+    num_traits=table.Shape[1]-1
+    if num_traits < 1:
+        raise ValueError("Trait table contains no traits.")
+
+    num_processes=cpu_count()
+    if num_jobs is not None:
+        if num_jobs < 1:
+            raise ValueError("num_jobs must be at least 1, not %s" % num_jobs)
+        num_processes=min(num_jobs,num_processes)
+    num_processes=min(num_processes,num_traits)
+
+    if traits_per_job is None:
+        traits_per_job=int(ceil(num_traits/(4*num_processes)))
+    blocks=get_trait_blocks(num_traits,traits_per_job)
+
+    def make_jobs():
+        for i,block in enumerate(blocks):
+            block_table=table.getColumns([0]+block)
+            yield i,tree,list(block_table.Header),block_table.getRawData(),\
+              asr_method,tmp_dir
+
+    if(verbose):
+        print "Running ASR for {0} traits in {1} blocks in {2} processes.".format(\
+          num_traits,len(blocks),num_processes)
+
+    asr_tables={}
+    ci_tables={}
+    pool=Pool(num_processes)
+    try:
+        for i,asr_table,ci_table in pool.imap_unordered(_run_asr_for_block,make_jobs()):
+            asr_tables[i]=asr_table
+            ci_tables[i]=ci_table
+            if(verbose):
+                print "Finished ASR for traits {0} to {1} ({2} of {3} blocks done).".format(\
+                  asr_table[0][1],asr_table[0][-1],len(asr_tables),len(blocks))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    #Combine in the order of the trait table
+    order=range(len(blocks))
+    combined_table=combine_asr_table_objects(\
+      Table(header=asr_tables[i][0],rows=asr_tables[i][1]) for i in order)
+    combined_table=Table(header=combined_table[0],rows=combined_table[1:])
+    if ci_tables[0] is None:
+        return combined_table,None
+    combined_ci_table=combine_asr_table_objects(\
+      Table(header=ci_tables[i][0],rows=ci_tables[i][1]) for i in order)
+    combined_ci_table=Table(header=combined_ci_table[0],rows=combined_ci_table[1:])
+    return combined_table,combined_ci_table
+
+def run_asr_in_parallel(tree, table, asr_method, parallel_method='sge',tmp_dir='jobs/',num_jobs=100, traits_per_job=None, verbose=False, cache_dir=None):
+    '''Runs the ancestral state reconstructions in parallel
+
+    parallel_method -- 'sge', 'torque' or 'multithreaded' submit one job per block
+    of traits and wait for their output files. 'local_pool' runs the blocks in a
+    pool of processes on this machine instead (see run_asr_in_local_pool).
+    traits_per_job -- the number of trait columns reconstructed by each job, so
+    that the tree is loaded and the asr app started once per block of traits
+    (default: enough traits for each of num_jobs to get one block)
+    cache_dir -- if provided, an ASR cache directory (see picrust.asr_cache). Only
+    traits that aren't already in the cache are sent to the jobs.
+    '''
+    if cache_dir is not None:
+        return run_asr_with_cache(tree,table,asr_method,cache_dir,\
+          lambda table_fp: run_asr_in_parallel(tree,table_fp,asr_method,\
+            parallel_method=parallel_method,tmp_dir=tmp_dir,num_jobs=num_jobs,\
+            traits_per_job=traits_per_job,verbose=verbose),\
+          tmp_dir=tmp_dir,verbose=verbose)
+
+    if(parallel_method=='local_pool'):
+        return run_asr_in_local_pool(tree,table,asr_method,tmp_dir=tmp_dir,\
+          num_jobs=num_jobs,traits_per_job=traits_per_job,verbose=verbose)
 
     asr_script_fp = join(get_picrust_project_dir(),'scripts','ancestral_state_reconstruction.py')
 
@@ -77,15 +255,19 @@ def run_asr_in_parallel(tree, table, asr_method, parallel_method='sge',tmp_dir='
     if(verbose):
         print "Loading trait table..."
         
-    #foreach trait in the table, create a new tmp file with just that trait, and create the job command and add it a tmp jobs file
+    #foreach block of traits in the table, create a new tmp file with just those traits, and create the job command and add it a tmp jobs file
     table=LoadTable(filename=table, header=True, sep='\t')
 
     #get dimensions of the table
     dim=table.Shape
+    num_traits=dim[1]-1
+    if traits_per_job is None:
+        traits_per_job=max(1,int(ceil(num_traits/num_jobs)))
     
     created_tmp_files=[]    
     output_files=[]
     ci_files=[]
+    sentinel_files=[]
 
     #create a tmp file to store the job commands (which we will pass to our parallel script to run)
     jobs_fp=get_tmp_filename(tmp_dir=tmp_dir,prefix='jobs_asr_')
@@ -95,15 +277,15 @@ def run_asr_in_parallel(tree, table, asr_method, parallel_method='sge',tmp_dir='
     if(verbose):
         print "Creating temporary input files in: ",tmp_dir
         
-    #iterate over each column
-    for i in range(1,dim[1]):
-        #create a new table with only a single trait
-        single_col_table=table.getColumns([0,i])
+    #iterate over each block of columns
+    for block in get_trait_blocks(num_traits,traits_per_job):
+        #create a new table with only the block's traits
+        block_table=table.getColumns([0]+block)
         
         #write the new table to a tmp file
-        single_col_fp=get_tmp_filename(tmp_dir=tmp_dir,prefix='in_asr_')
-        single_col_table.writeToFile(single_col_fp,sep='\t')
-        created_tmp_files.append(single_col_fp)
+        block_fp=get_tmp_filename(tmp_dir=tmp_dir,prefix='in_asr_')
+        block_table.writeToFile(block_fp,sep='\t')
+        created_tmp_files.append(block_fp)
 
         #create tmp output files
         tmp_output_fp=get_tmp_filename(tmp_dir=tmp_dir,prefix='out_asr_')
@@ -112,7 +294,12 @@ def run_asr_in_parallel(tree, table, asr_method, parallel_method='sge',tmp_dir='
         ci_files.append(tmp_ci_fp)
 
         #create the job command
-        cmd= "{0} -i {1} -t {2} -m {3} -o {4} -c {5}".format(asr_script_fp, single_col_fp, tree, asr_method, tmp_output_fp, tmp_ci_fp)
+        cmd= "{0} -i {1} -t {2} -m {3} -o {4} -c {5}".format(asr_script_fp, block_fp, tree, asr_method, tmp_output_fp, tmp_ci_fp)
+
+        #record the job's exit status in a sentinel file once it finishes
+        sentinel_fp=get_sentinel_fp(tmp_output_fp)
+        sentinel_files.append(sentinel_fp)
+        cmd=wrap_command_with_sentinel(cmd,sentinel_fp)
  
         #add job command to the the jobs file
         jobs.write(cmd+"\n")
@@ -120,6 +307,7 @@ def run_asr_in_parallel(tree, table, asr_method, parallel_method='sge',tmp_dir='
     jobs.close()
     created_tmp_files.extend(output_files)
     created_tmp_files.extend(ci_files)
+    created_tmp_files.extend(sentinel_files)
     
     if(verbose):
         print "Launching parallel jobs."
@@ -131,22 +319,26 @@ def run_asr_in_parallel(tree, table, asr_method, parallel_method='sge',tmp_dir='
     if(verbose):
         print "Jobs are now running. Will wait until finished."
 
-    #wait until all jobs finished (e.g. simple poller)
-    wait_for_output_files(output_files)
+    #wait until all jobs finished (raises an error if any job fails)
+    wait_for_job_sentinels(sentinel_files,verbose=verbose)
 
     if(verbose):
         print "Jobs are done running. Now combining all tmp files."
     #Combine output files
     combined_table=combine_asr_tables(output_files)
-    combined_ci_table=combine_asr_tables(ci_files)
-    
-    #create a Table object
     combined_table=Table(header=combined_table[0],rows=combined_table[1:])
-    combined_ci_table=Table(header=combined_ci_table[0],rows=combined_ci_table[1:])
+
+    #methods without confidence intervals (e.g. wagner) don't write ci files
+    if exists(ci_files[0]):
+        combined_ci_table=combine_asr_tables(ci_files)
+        combined_ci_table=Table(header=combined_ci_table[0],rows=combined_ci_table[1:])
+    else:
+        combined_ci_table=None
         
     #clean up all tmp files
     for file in created_tmp_files:
-        remove(file)
+        if exists(file):
+            remove(file)
 
     #return the combined table
     return combined_table,combined_ci_table
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+"""A persistent cache of ancestral state reconstructions, keyed by content"""
+
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from os import makedirs, rename, remove, getpid
+from os.path import join, exists, isdir
+from hashlib import md5
+from json import dumps, loads
+from cogent import LoadTable
+from cogent.util.table import Table
+from cogent.app.util import get_tmp_filename
+
+ASR_CACHE_VERSION = 1
+
+def get_file_md5(filepath,block_size=2**20):
+    """Return the md5 hex digest of a file's contents"""
+    digest = md5()
+    f = open(filepath,'rb')
+    block = f.read(block_size)
+    while block:
+        digest.update(block)
+        block = f.read(block_size)
+    f.close()
+    return digest.hexdigest()
+
+def get_asr_cache_keys(tree_md5,asr_method,trait_table,params=None):
+    """Return a cache key for each trait column of a trait Table
+
+    tree_md5 -- the md5 of the tree file (see get_file_md5)
+    asr_method -- the ASR method name (e.g. 'ace_pic')
+    trait_table -- a cogent Table with tips in the first column
+    params -- optional dict of method parameters that affect the result
+
+    Keys are made from the tree md5, the method and its parameters, and the
+    md5 of the trait's sorted (tip, value) pairs.  Trait names aren't part
+    of the key, so identical traits under different names share an entry.
+    """
+    prefix = dumps([ASR_CACHE_VERSION,tree_md5,asr_method,\
+      sorted((params or {}).items())])
+    rows = trait_table.getRawData()
+    #Sort by tip, so that the key doesn't depend on row order
+    rows.sort(key=lambda row: str(row[0]))
+    tips = [str(row[0]) for row in rows]
+    keys = []
+    for i in range(1,len(trait_table.Header)):
+        digest = md5(prefix)
+        for tip,row in zip(tips,rows):
+            digest.update('%s\t%r\n' % (tip,row[i]))
+        keys.append(digest.hexdigest())
+    return keys
+
+def get_asr_cache_fp(cache_dir,key):
+    """Return the filepath of a cache entry"""
+    return join(cache_dir,key[:2],key + '.json')
+
+def load_cached_asr_columns(cache_dir,keys):
+    """Return a dict of key to cache entry for the keys that are in the cache
+
+    Each entry is a dict holding 'asr' and 'ci', lists of [row id, value] in
+    table order (ci is None for methods without confidence intervals), and
+    'header', the name of the row id column of the asr and ci tables.
+    """
+    result = {}
+    for key in set(keys):
+        fp = get_asr_cache_fp(cache_dir,key)
+        if not exists(fp):
+            continue
+        try:
+            entry = loads(open(fp).read())
+        except ValueError:
+            #e.g. a partly written file from an older, non-atomic writer
+            continue
+        result[key] = dict([(name,_decode(value)) for name,value in entry.items()])
+    return result
+
+def _decode(value):
+    """Convert the unicode strings json gives back to str, as in loaded Tables"""
+    if isinstance(value,unicode):
+        return str(value)
+    if isinstance(value,list):
+        return map(_decode,value)
+    return value
+
+def get_asr_cache_entries(asr_table,ci_table=None):
+    """Return a cache entry for each trait column of asr_table (and ci_table)"""
+    asr_rows = asr_table.getRawData()
+    ci_rows = ci_table.getRawData() if ci_table is not None else None
+    header = [asr_table.Header[0],\
+      ci_table.Header[0] if ci_table is not None else None]
+    entries = []
+    for i in range(1,len(asr_table.Header)):
+        entry = {'header':header,'ci':None}
+        entry['asr'] = [[row[0],row[i]] for row in asr_rows]
+        if ci_rows is not None:
+            entry['ci'] = [[row[0],row[i]] for row in ci_rows]
+        entries.append(entry)
+    return entries
+
+def save_asr_cache_entries(cache_dir,keys,entries):
+    """Store each of entries (see get_asr_cache_entries) under the matching key"""
+    if len(entries) != len(keys):
+        raise ValueError("Got %i cache keys for %i trait columns" %\
+          (len(keys),len(entries)))
+    for key,entry in zip(keys,entries):
+        fp = get_asr_cache_fp(cache_dir,key)
+        entry_dir = join(cache_dir,key[:2])
+        if not isdir(entry_dir):
+            try:
+                makedirs(entry_dir)
+            except OSError:
+                #created by another process in the meantime
+                if not isdir(entry_dir):
+                    raise
+        tmp_fp = '%s.%i.tmp' % (fp,getpid())
+        f = open(tmp_fp,'w')
+        f.write(dumps(entry))
+        f.close()
+        rename(tmp_fp,fp)
+
+def _combine_cached_columns(trait_ids,entries,column,header):
+    """Build a Table from the asr or ci columns of cache entries"""
+    row_ids = [row[0] for row in entries[0][column]]
+    rows = [[row_id] for row_id in row_ids]
+    for trait_id,entry in zip(trait_ids,entries):
+        if [row[0] for row in entry[column]] != row_ids:
+            raise ValueError("Cached reconstruction for %s has different nodes" %\
+              trait_id)
+        for row,(row_id,value) in zip(rows,entry[column]):
+            row.append(value)
+    return Table(header=[header] + list(trait_ids),rows=rows)
+
+def run_asr_with_cache(tree,table,asr_method,cache_dir,run_asr,params=None,\
+    tmp_dir=None,verbose=False):
+    """Run ASR for the traits that aren't cached, and combine them with the cached ones
+
+    tree -- the tree filepath
+    table -- the trait table filepath
+    asr_method -- the ASR method name, which is part of the cache keys
+    cache_dir -- the cache directory (created if needed)
+    run_asr -- a function taking a trait table filepath, and returning the
+    asr Table and ci Table (or None) for it, e.g. a wrapper around
+    run_asr_for_picrust or run_asr_in_parallel
+    params -- optional dict of method parameters, for the cache keys
+    tmp_dir -- where to write the table of uncached traits
+
+    Returns the asr Table and ci Table (or None) for all traits, in the order
+    of the trait table, as run_asr would.  New reconstructions are added to
+    the cache.
+    """
+    trait_table = LoadTable(filename=table,header=True,sep='\t')
+    trait_ids = trait_table.Header[1:]
+    if not trait_ids:
+        raise ValueError("Trait table contains no traits.")
+    keys = get_asr_cache_keys(get_file_md5(tree),asr_method,trait_table,params)
+    if not isdir(cache_dir):
+        makedirs(cache_dir)
+    cached = load_cached_asr_columns(cache_dir,keys)
+
+    #Identical columns only need to be reconstructed once
+    missing = []
+    missing_keys = []
+    for i,key in enumerate(keys):
+        if key not in cached:
+            missing.append(i + 1)
+            missing_keys.append(key)
+            cached[key] = None
+
+    if verbose:
+        print "Found {0} of {1} traits in the ASR cache. Reconstructing {2}.".format(\
+          len(keys) - len(missing),len(keys),len(missing))
+
+    if missing:
+        missing_fp = get_tmp_filename(tmp_dir=tmp_dir or '/tmp',\
+          prefix='asr_cache_misses_',suffix='.tab')
+        trait_table.getColumns([0] + missing).writeToFile(missing_fp,sep='\t')
+        try:
+            asr_table,ci_table = run_asr(missing_fp)
+        finally:
+            remove(missing_fp)
+        entries = get_asr_cache_entries(asr_table,ci_table)
+        save_asr_cache_entries(cache_dir,missing_keys,entries)
+        cached.update(zip(missing_keys,entries))
+
+    entries = [cached[key] for key in keys]
+    asr_header,ci_header = entries[0]['header']
+    asr_table = _combine_cached_columns(trait_ids,entries,'asr',asr_header)
+    if ci_header is None:
+        return asr_table,None
+    return asr_table,_combine_cached_columns(trait_ids,entries,'ci',ci_header)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+"""A sidecar index for loading a few samples of a large sparse BIOM table"""
+
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from os import path
+from array import array as typed_array
+from hashlib import md5
+from json import dumps, loads
+import re
+from numpy import argsort, asarray
+from biom.parse import parse_biom_table, direct_parse_key
+from picrust.asr_cache import get_file_md5
+
+BIOM_INDEX_MAGIC = "#PICRUST BIOM INDEX"
+BIOM_INDEX_VERSION = 1
+BIOM_INDEX_SUFFIX = ".idx"
+
+#Top level keys copied unchanged into tables loaded from the index
+BIOM_INDEX_KEYS = ["id","format","format_url","type",\
+  "generated_by","date","matrix_type","matrix_element_type"]
+
+SPARSE_TRIPLE_RE = re.compile(r'\[\s*(\d+)\s*,\s*(\d+)\s*,\s*([^\],\s]+)\s*\]')
+
+def get_biom_index_fp(biom_fp):
+    """Return the default index filepath for a BIOM table filepath"""
+    return biom_fp + BIOM_INDEX_SUFFIX
+
+def write_biom_index(biom_str,index_fp,source_fp=None):
+    """Write a sidecar index for the samples of a sparse BIOM table
+
+    biom_str -- the BIOM table as a JSON string
+    index_fp -- the output index filepath
+    source_fp -- the filepath biom_str was read from.  If provided, the md5
+    of its contents is stored so that stale indices can be detected.
+
+    The index holds a magic line, a JSON header (the table's top level keys
+    and rows, the sample ids, and the offset and length of each sample's
+    record), then one record per sample: its JSON, a tab, and its non-zero
+    'row,value' pairs.  Values are copied as text, so loaded subsets match
+    those from load_subset_from_biom_str.
+
+    Returns the number of indexed samples.  Raises a ValueError if the
+    table is not a sparse BIOM table.
+    """
+    matrix_type = direct_parse_key(biom_str,"matrix_type")
+    if matrix_type == "":
+        raise ValueError("biom_str does not appear to be in BIOM format!")
+    if matrix_type.split(':')[-1].strip() != '"sparse"':
+        raise ValueError("Only sparse BIOM tables can be indexed (found %s)" %\
+          matrix_type)
+
+    #Parse everything except the (large) data with json, so that the
+    #top level keys, rows and columns are read exactly
+    data = direct_parse_key(biom_str,"data")
+    data_start = biom_str.find(data)
+    table = loads(biom_str[:data_start] + '"data": []' +\
+      biom_str[data_start+len(data):])
+    columns = table["columns"]
+
+    header = {"version":BIOM_INDEX_VERSION}
+    header["keys"] = dict([(key,'"%s": %s' % (key,dumps(table.get(key))))\
+      for key in BIOM_INDEX_KEYS])
+    header["rows"] = '"rows": %s' % dumps(table["rows"])
+    header["column_ids"] = [column["id"] for column in columns]
+    header["shape"] = [len(table["rows"]),len(columns)]
+    if source_fp is not None:
+        header["source_md5"] = get_file_md5(source_fp)
+
+    #Record the position of each value in biom_str, rather than copying it
+    row_indices = typed_array('l')
+    column_indices = typed_array('l')
+    value_starts = typed_array('l')
+    value_ends = typed_array('l')
+    for match in SPARSE_TRIPLE_RE.finditer(data):
+        row_indices.append(int(match.group(1)))
+        column_indices.append(int(match.group(2)))
+        value_starts.append(match.start(3))
+        value_ends.append(match.end(3))
+
+    #Stable sort, so each column's values stay in the source table's order
+    order = argsort(asarray(column_indices),kind='mergesort')
+    column_indices = asarray(column_indices)[order].tolist()
+    order = order.tolist()
+
+    records = []
+    offsets = []
+    offset = 0
+    position = 0
+    for column_index,column in enumerate(columns):
+        pairs = []
+        while position < len(order) and\
+          column_indices[position] == column_index:
+            i = order[position]
+            pairs.append("%d,%s" %\
+              (row_indices[i],data[value_starts[i]:value_ends[i]]))
+            position += 1
+        record = "%s\t%s\n" % (dumps(column),';'.join(pairs))
+        records.append(record)
+        offsets.append([offset,len(record)])
+        offset += len(record)
+
+    if position != len(order):
+        raise ValueError("BIOM data refers to samples that are not in the table's columns")
+    header["offsets"] = offsets
+
+    out_f = open(index_fp,'w')
+    out_f.write(BIOM_INDEX_MAGIC + "\n")
+    out_f.write(dumps(header) + "\n")
+    out_f.writelines(records)
+    out_f.close()
+    return len(columns)
+
+def read_biom_index_header(index_fp):
+    """Return the header of a BIOM index file, and the offset of its records"""
+    index_f = open(index_fp,'rb')
+    if index_f.readline().rstrip("\n") != BIOM_INDEX_MAGIC:
+        index_f.close()
+        raise ValueError("%s is not a PICRUSt BIOM index file" % index_fp)
+    header = loads(index_f.readline())
+    records_start = index_f.tell()
+    index_f.close()
+    if header.get("version") != BIOM_INDEX_VERSION:
+        raise ValueError("Unsupported BIOM index version: %s" %\
+          header.get("version"))
+    return header,records_start
+
+def biom_index_is_current(index_fp,source_fp):
+    """Return True if index_fp is a valid index for the table at source_fp"""
+    if not path.exists(index_fp):
+        return False
+    try:
+        header,records_start = read_biom_index_header(index_fp)
+    except ValueError:
+        return False
+    return header.get("source_md5") == get_file_md5(source_fp)
+
+def load_subset_from_biom_index(index_fp,ids_to_load,source_fp=None):
+    """Load a biom table containing a subset of samples, using a BIOM index
+
+    index_fp -- a BIOM index filepath (see write_biom_index)
+    ids_to_load -- the sample ids to load
+    source_fp -- if provided, raise a ValueError unless the index is up to
+    date with the table at this filepath
+
+    Gives the same table as load_subset_from_biom_str with axis='samples',
+    but only reads the index header and the requested samples' records.
+    Raises a KeyError if any of ids_to_load are not in the table.
+    """
+    if source_fp is not None and not biom_index_is_current(index_fp,source_fp):
+        raise ValueError("BIOM index %s is missing or out of date for %s" %\
+          (index_fp,source_fp))
+
+    header,records_start = read_biom_index_header(index_fp)
+    ids = set(map(str,[l.strip() for l in ids_to_load]))
+    column_ids = header["column_ids"]
+    if not ids.issubset(set(column_ids)):
+        raise KeyError("Not all of the to_keep ids are in the BIOM index!")
+
+    #Samples keep the order they have in the source table
+    idxs = [i for i,column_id in enumerate(column_ids) if column_id in ids]
+
+    index_f = open(index_fp,'rb')
+    new_columns = []
+    new_data = []
+    for new_index,i in enumerate(idxs):
+        offset,length = header["offsets"][i]
+        index_f.seek(records_start + offset)
+        column,pairs = index_f.read(length).rstrip("\n").split("\t")
+        new_columns.append(column)
+        if not pairs:
+            continue
+        for pair in pairs.split(";"):
+            row,value = pair.split(",")
+            new_data.append("[%s,%d,%s]" % (row,new_index,value))
+    index_f.close()
+
+    if not new_data and idxs and header["shape"][0]:
+        #biom can't build a table without data, so give an explicit zero
+        new_data.append("[0,0,0]")
+
+    pieces = [header["keys"][key] for key in BIOM_INDEX_KEYS]
+    pieces.append('"data": [%s], "shape": [%d, %d]' %\
+      (','.join(new_data),header["shape"][0],len(idxs)))
+    pieces.append('"columns": [%s]' % ', '.join(new_columns))
+    pieces.append(header["rows"])
+    return parse_biom_table("{%s}" % ','.join(pieces))
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+import re
+from numpy import array, empty, zeros, ones, arange, isnan, where, nan,\
+  int32, float64
+from cogent.core.tree import PhyloNode
+
+def flatten_tree(tree,default_length=0.0):
+    """Return preorder nodes, parent indices and branch lengths for a tree
+
+    tree -- a PyCogent PhyloNode tree object
+    default_length -- the branch length used for nodes whose Length is None
+
+    Returns a list of the tree's nodes in preorder, an integer array holding
+    the preorder index of each node's parent (-1 for the root), and a float
+    array of branch lengths.  Because the order is preorder, every node's
+    parent appears before the node itself, so single forward passes over the
+    arrays can propagate values from the root to the tips.
+    """
+    nodes = list(tree.preorder())
+    node_index = dict([(id(n),i) for i,n in enumerate(nodes)])
+    parents = empty(len(nodes),dtype=int)
+    lengths = empty(len(nodes),dtype=float)
+    for i,node in enumerate(nodes):
+        if i == 0:
+            parents[i] = -1
+        else:
+            parents[i] = node_index[id(node.Parent)]
+        if node.Length is None:
+            lengths[i] = default_length
+        else:
+            lengths[i] = node.Length
+    return nodes,parents,lengths
+
+def get_root_distances(parents,lengths):
+    """Return the summed branch length from the root to each node
+
+    parents -- preorder parent indices (see flatten_tree)
+    lengths -- preorder branch lengths (see flatten_tree)
+
+    The root's own branch length is ignored, matching PhyloNode.distance
+    """
+    parent_list = parents.tolist()
+    length_list = lengths.tolist()
+    distances = [0.0]*len(parent_list)
+    for i in xrange(1,len(parent_list)):
+        distances[i] = distances[parent_list[i]] + length_list[i]
+    return array(distances)
+
+def get_nearest_marked_ancestors(parents,is_marked):
+    """Return the index of the closest marked (strict) ancestor of each node
+
+    parents -- preorder parent indices (see flatten_tree)
+    is_marked -- a boolean array flagging nodes of interest (e.g. nodes
+    with reconstructed traits)
+
+    Nodes without any marked ancestor are assigned -1.
+    """
+    parent_list = parents.tolist()
+    marked = is_marked.tolist()
+    result = [-1]*len(parent_list)
+    for i in xrange(1,len(parent_list)):
+        parent = parent_list[i]
+        if marked[parent]:
+            result[i] = parent
+        else:
+            result[i] = result[parent]
+    return array(result,dtype=int)
+
+def get_trait_matrix(nodes,trait_label="Reconstruction"):
+    """Return per-node trait row indices and a 2D float matrix of traits
+
+    nodes -- a list of PhyloNode objects (e.g. from flatten_tree)
+    trait_label -- the node attribute where trait arrays are stored
+
+    Returns an integer array with the matrix row for each node (-1 where
+    the node has no traits) and a (nodes with traits x traits) float matrix.
+    """
+    trait_rows = empty(len(nodes),dtype=int)
+    trait_data = []
+    for i,node in enumerate(nodes):
+        traits = getattr(node,trait_label,None)
+        if traits is None:
+            trait_rows[i] = -1
+            continue
+        trait_rows[i] = len(trait_data)
+        trait_data.append(traits)
+
+    if not trait_data:
+        return trait_rows,zeros((0,0))
+
+    try:
+        trait_matrix = array(trait_data,dtype=float)
+    except ValueError:
+        raise ValueError("Node trait arrays under label '%s' must all have the same length" % trait_label)
+    if trait_matrix.ndim != 2:
+        raise ValueError("Node trait arrays under label '%s' must all have the same length" % trait_label)
+    return trait_rows,trait_matrix
+
+def get_nearest_marked_nodes(parents,lengths,is_marked,include_self=True):
+    """Return the closest marked node, and the distance to it, for each node
+
+    parents -- preorder parent indices (see flatten_tree)
+    lengths -- preorder branch lengths (see flatten_tree)
+    is_marked -- a boolean array flagging candidate nodes (e.g. tips
+    with known traits)
+    include_self -- if True, a marked node is its own nearest neighbor
+    (at distance 0).  If False, the nearest *other* marked node is found.
+
+    Uses two passes over the tree, so time and memory are O(N) rather
+    than the O(N^2) of a full distance matrix.  A postorder (up) pass
+    finds the nearest marked node within each subtree, recording the best
+    and second best child clades.  A preorder (down) pass then finds the
+    nearest marked node outside each subtree, via the parent's own best
+    outside match or the best sibling clade.
+
+    Exact ties are broken in favour of the node that comes first in
+    preorder.  Distances are summed along the up and down passes, so for
+    nodes that are equally close in theory, rounding may decide which one
+    is nearest.
+    Nodes with no (other) marked node in the tree are assigned index -1
+    and distance inf.
+    """
+    parent_list = parents.tolist()
+    length_list = lengths.tolist()
+    marked = is_marked.tolist()
+    n_nodes = len(parent_list)
+    no_match = (float('inf'),-1)
+
+    # Up pass: best and second best (distance,index) pairs reachable
+    # through each node's children, plus which child gave the best
+    best_below = [no_match]*n_nodes
+    second_below = [no_match]*n_nodes
+    best_child = [-1]*n_nodes
+    for i in xrange(n_nodes-1,0,-1):
+        if marked[i]:
+            in_subtree = (0.0,i)
+        else:
+            in_subtree = best_below[i]
+        if in_subtree[1] == -1:
+            continue
+        candidate = (in_subtree[0] + length_list[i],in_subtree[1])
+        parent = parent_list[i]
+        if candidate < best_below[parent]:
+            second_below[parent] = best_below[parent]
+            best_below[parent] = candidate
+            best_child[parent] = i
+        elif candidate < second_below[parent]:
+            second_below[parent] = candidate
+
+    # Down pass: best (distance,index) pair outside of each node's subtree
+    best_above = [no_match]*n_nodes
+    for i in xrange(1,n_nodes):
+        parent = parent_list[i]
+        if best_child[parent] == i:
+            best = second_below[parent]
+        else:
+            best = best_below[parent]
+        if best_above[parent] < best:
+            best = best_above[parent]
+        if marked[parent] and (0.0,parent) < best:
+            best = (0.0,parent)
+        if best[1] != -1:
+            best_above[i] = (best[0] + length_list[i],best[1])
+
+    nearest = empty(n_nodes,dtype=int)
+    distances = empty(n_nodes,dtype=float)
+    for i in xrange(n_nodes):
+        best = min(best_below[i],best_above[i])
+        if include_self and marked[i]:
+            best = (0.0,i)
+        nearest[i] = best[1]
+        distances[i] = best[0]
+    return nearest,distances
+
+def get_ancestor_mask(parents,node_indices):
+    """Return a boolean array flagging the given nodes and all of their ancestors
+
+    parents -- preorder parent indices (see flatten_tree)
+    node_indices -- preorder indices of the nodes of interest (e.g. tips
+    that were added to a tree)
+
+    Each path to the root is only walked until it meets a node that is
+    already flagged, so the time is linear in the number of flagged nodes.
+    """
+    parent_list = parents.tolist()
+    flagged = [False]*len(parent_list)
+    for i in node_indices:
+        while i != -1 and not flagged[i]:
+            flagged[i] = True
+            i = parent_list[i]
+    return array(flagged,dtype=bool)
+
+class CompactTree(object):
+    """A tree stored in numpy arrays, rather than as PhyloNode objects
+
+    Nodes are numbered in preorder, so every node's parent comes before it
+    (as for flatten_tree), and are described by:
+
+        parents -- the index of each node's parent (-1 for the root)
+        lengths -- branch lengths (nan where the length is unknown)
+        name_ids -- the index of each node's name in names (-1 for no name)
+        names -- the list of distinct node names
+        first_child, next_sibling -- the index of each node's first child and
+        of its next sibling, in the order of PhyloNode.Children (-1 for none)
+        postorder -- the node indices in postorder, as PhyloNode.postorder
+        visits them
+
+    This uses a few tens of bytes per node, an order of magnitude less than
+    PhyloNode objects, and the functions in this module, picrust.native_asr
+    and the vectorized and tree_dp functions in picrust.predict_traits run
+    on the arrays directly.  Traits are stored per trait label as a matrix
+    with a row for each node that has traits (see assign_traits).
+    """
+
+    def __init__(self,parents,lengths,node_names):
+        """Build a CompactTree from preorder parents, lengths and node names
+
+        node_names -- the name of each node (or None), in preorder
+        """
+        n_nodes = len(parents)
+        if len(lengths) != n_nodes or len(node_names) != n_nodes:
+            raise ValueError("parents, lengths and node_names must have the same length")
+        self.parents = array(parents,dtype=int32)
+        if n_nodes and (self.parents[0] != -1 or\
+          (self.parents[1:] >= arange(1,n_nodes)).any() or\
+          (self.parents[1:] < 0).any()):
+            raise ValueError("Nodes must be in preorder, with the root first")
+        self.lengths = array([nan if l is None else l for l in lengths],dtype=float64)
+
+        name_index = {}
+        self.names = []
+        name_ids = empty(n_nodes,dtype=int32)
+        for i,name in enumerate(node_names):
+            if name is None:
+                name_ids[i] = -1
+                continue
+            if name not in name_index:
+                name_index[name] = len(self.names)
+                self.names.append(name)
+            name_ids[i] = name_index[name]
+        self.name_ids = name_ids
+
+        #Children in order: walk backwards so each parent's first child is
+        #the last one seen
+        parent_list = self.parents.tolist()
+        first_child = [-1]*n_nodes
+        next_sibling = [-1]*n_nodes
+        depths = [0]*n_nodes
+        sizes = [1]*n_nodes
+        for i in xrange(n_nodes-1,0,-1):
+            parent = parent_list[i]
+            next_sibling[i] = first_child[parent]
+            first_child[parent] = i
+            sizes[parent] += sizes[i]
+        for i in xrange(1,n_nodes):
+            depths[i] = depths[parent_list[i]] + 1
+        self.first_child = array(first_child,dtype=int32)
+        self.next_sibling = array(next_sibling,dtype=int32)
+
+        #A node comes after its subtree, and after the nodes before it in
+        #preorder that aren't its ancestors
+        postorder = empty(n_nodes,dtype=int32)
+        postorder[array(sizes) - 1 + arange(n_nodes) - array(depths)] =\
+          arange(n_nodes)
+        self.postorder = postorder
+        self.traits = {}
+
+    @classmethod
+    def from_phylo_node(cls,tree,trait_labels=[]):
+        """Return a CompactTree for a PyCogent PhyloNode tree
+
+        trait_labels -- node attributes holding trait arrays (e.g. from
+        assign_traits_to_tree) to store as the CompactTree's traits
+        """
+        nodes,parents,lengths = flatten_tree(tree,default_length=nan)
+        result = cls(parents,lengths,[n.Name for n in nodes])
+        for trait_label in trait_labels:
+            result.traits[trait_label] = get_trait_matrix(nodes,trait_label)
+        return result
+
+    @classmethod
+    def from_arrays(cls,arrays):
+        """Return a CompactTree from the dict of arrays given by to_arrays"""
+        result = cls.__new__(cls)
+        for name in ['parents','lengths','name_ids','first_child',\
+          'next_sibling','postorder']:
+            setattr(result,name,arrays[name])
+        result.names = arrays['names'].tolist()
+        result.traits = {}
+        for i,trait_label in enumerate(arrays['trait_labels'].tolist()):
+            result.traits[trait_label] = (arrays['trait_rows_%i' % i],\
+              arrays['trait_matrix_%i' % i])
+        return result
+
+    def to_arrays(self):
+        """Return a dict of the arrays describing the tree and its traits
+
+        The names and trait labels are stored as string arrays, so the dict
+        can be saved with numpy.savez and read back with from_arrays.
+        """
+        arrays = {'parents':self.parents,'lengths':self.lengths,\
+          'name_ids':self.name_ids,'first_child':self.first_child,\
+          'next_sibling':self.next_sibling,'postorder':self.postorder,\
+          'names':array(self.names,dtype=str)}
+        trait_labels = sorted(self.traits)
+        arrays['trait_labels'] = array(trait_labels,dtype=str)
+        for i,trait_label in enumerate(trait_labels):
+            arrays['trait_rows_%i' % i],arrays['trait_matrix_%i' % i] =\
+              self.traits[trait_label]
+        return arrays
+
+    @classmethod
+    def from_newick(cls,lines,label_conversion_fns=[]):
+        """Return a CompactTree for newick data (see parse_newick)"""
+        return cls(*parse_newick(lines,label_conversion_fns))
+
+    def to_phylo_node(self,constructor=PhyloNode,trait_labels=[]):
+        """Return the tree as PyCogent PhyloNode (or constructor) objects
+
+        trait_labels -- trait labels to set as node attributes, as
+        assign_traits_to_tree does (None for nodes without traits).  The
+        trait arrays are rows of the trait matrix, not copies.
+        """
+        lengths = self.lengths.tolist()
+        names = self.get_node_names()
+        parent_list = self.parents.tolist()
+        nodes = []
+        for i in xrange(len(self)):
+            length = None if isnan(lengths[i]) else lengths[i]
+            node = constructor(Name=names[i],Length=length)
+            if i:
+                nodes[parent_list[i]].append(node)
+            nodes.append(node)
+        for trait_label in trait_labels:
+            trait_rows,trait_matrix = self.get_trait_matrix(trait_label)
+            for node,row in zip(nodes,trait_rows.tolist()):
+                setattr(node,trait_label,trait_matrix[row] if row >= 0 else None)
+        return nodes[0]
+
+    def __len__(self):
+        return len(self.parents)
+
+    def get_node_names(self):
+        """Return a list of the name of each node (None if unnamed)"""
+        names = self.names + [None]
+        return [names[i] for i in self.name_ids.tolist()]
+
+    def get_node_index(self):
+        """Return a dict of node name to node index (the first in preorder)"""
+        index = {}
+        for i,name_id in enumerate(self.name_ids.tolist()):
+            if name_id != -1 and self.names[name_id] not in index:
+                index[self.names[name_id]] = i
+        return index
+
+    def get_lengths(self,default_length=0.0):
+        """Return branch lengths, with default_length where they are unknown"""
+        return where(isnan(self.lengths),default_length,self.lengths)
+
+    def get_tip_mask(self):
+        """Return a boolean array flagging the tips"""
+        return self.first_child == -1
+
+    def get_children(self,i):
+        """Return the indices of the children of node i, in order"""
+        children = []
+        child = self.first_child[i]
+        while child != -1:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    def getTipNames(self):
+        """Return the names of the tips in preorder, as PhyloNode.getTipNames"""
+        names = self.names + [None]
+        return [names[i] for i in self.name_ids[self.get_tip_mask()].tolist()]
+
+    def assign_traits(self,traits,trait_label="Reconstruction",\
+        fix_bad_labels=True):
+        """Store trait arrays for the nodes named in traits, as assign_traits_to_tree does
+
+        traits -- a dict of trait arrays keyed by node name
+        trait_label -- the label the traits are stored under
+        fix_bad_labels -- if True, quotes are stripped from names and keys
+
+        As in assign_traits_to_tree, a 'root' key assigns traits to the root.
+        The traits are stored as trait rows and a trait matrix (see
+        get_trait_matrix).
+        """
+        if fix_bad_labels:
+            traits = dict([(str(k).strip('"').strip("'"),v)\
+              for k,v in traits.items()])
+        node_traits = []
+        for i,name in enumerate(self.get_node_names()):
+            if name is None:
+                continue
+            name = name.strip()
+            if fix_bad_labels:
+                name = name.strip("'").strip('"')
+            value = traits.get(name)
+            if value is not None:
+                node_traits.append((i,value))
+        if 'root' in traits and len(self):
+            node_traits = [(i,v) for i,v in node_traits if i != 0]
+            node_traits.insert(0,(0,traits['root']))
+
+        trait_rows = -ones(len(self),dtype=int)
+        for row,(i,value) in enumerate(node_traits):
+            trait_rows[i] = row
+        if not node_traits:
+            trait_matrix = zeros((0,0))
+        else:
+            try:
+                trait_matrix = array([v for i,v in node_traits],dtype=float)
+            except ValueError:
+                raise ValueError("Node trait arrays under label '%s' must all have the same length" % trait_label)
+            if trait_matrix.ndim != 2:
+                raise ValueError("Node trait arrays under label '%s' must all have the same length" % trait_label)
+        self.traits[trait_label] = (trait_rows,trait_matrix)
+
+    def get_trait_matrix(self,trait_label="Reconstruction"):
+        """Return per-node trait rows and the trait matrix, as get_trait_matrix does
+
+        Nodes without traits (or all nodes, if no traits were assigned with
+        this label) have a trait row of -1.
+        """
+        if trait_label not in self.traits:
+            return -ones(len(self),dtype=int),zeros((0,0))
+        return self.traits[trait_label]
+
+def as_compact_tree(tree,trait_labels=[]):
+    """Return tree as a CompactTree, converting PyCogent PhyloNode trees
+
+    trait_labels -- the node attributes holding trait arrays to convert
+    (see CompactTree.from_phylo_node).  CompactTrees are returned unchanged.
+    """
+    if isinstance(tree,CompactTree):
+        return tree
+    return CompactTree.from_phylo_node(tree,trait_labels)
+
+#Punctuation, or a label: runs of other characters and quoted text, in which
+#punctuation doesn't count (as in cogent's DndTokenizer)
+_newick_token = re.compile(r"[(),:;]|(?:[^(),:;']+|'[^']*'?)+")
+
+def parse_newick(lines,label_conversion_fns=[]):
+    """Parse newick data into preorder parents, lengths and node names
+
+    lines -- a newick string, or an iterable of lines (e.g. an open file)
+    label_conversion_fns -- functions applied in turn to each node name, e.g.
+    from picrust.format_tree_and_trait_table.set_label_conversion_fns
+
+    Reads the same trees as cogent's DndParser (names keep their quotes,
+    unnamed nodes have a name of None and missing lengths are nan), but
+    walks the tokens with an explicit current node rather than building
+    PhyloNode objects, so it uses no recursion and handles trees of any depth.
+    Returns parents, lengths and names lists in preorder, as taken by
+    CompactTree.  Raises a ValueError for unbalanced parentheses.
+    """
+    if isinstance(lines,basestring):
+        data = lines
+    else:
+        data = ''.join(lines)
+    data = data[max(data.find('('),0):]
+    if data.count('(') != data.count(')'):
+        raise ValueError("Found %i left parens but %i right parens." %\
+          (data.count('('),data.count(')')))
+
+    parents = []
+    lengths = []
+    names = []
+    curr = -1
+    post_colon = False
+    closed = False
+    last = None
+    for match in _newick_token.finditer(data):
+        t = match.group()
+        if t == ':':
+            post_colon = True
+            last = t
+            continue
+        if t == ')' or t == ',':
+            if curr < 0:
+                raise ValueError("Newick data closes more nodes than it opens.")
+            if last == ',' or last == '(':
+                #an unnamed tip
+                parents.append(curr)
+                lengths.append(nan)
+                names.append(None)
+            else:
+                #move up from the last node to the one being filled
+                curr = parents[curr]
+                if curr < 0:
+                    raise ValueError("Newick data closes more nodes than it opens.")
+            if t == ')':
+                closed = True
+                post_colon = False
+                last = t
+                continue
+        elif t == '(':
+            parents.append(curr)
+            lengths.append(nan)
+            names.append(None)
+            curr = len(parents) - 1
+        elif t == ';':
+            break
+        else:
+            t = t.strip()
+            if not t:
+                continue
+            if post_colon:
+                lengths[curr] = float(t)
+            else:
+                for f in label_conversion_fns:
+                    t = f(t)
+                if closed:
+                    names[curr] = t
+                else:
+                    parents.append(curr)
+                    lengths.append(nan)
+                    names.append(t)
+                    curr = len(parents) - 1
+        post_colon = False
+        closed = False
+        last = t
+
+    if curr > 0:
+        raise ValueError("Newick data didn't get back to the root of the tree.")
+    if not parents:
+        raise ValueError("No tree found in the newick data.")
+    return parents,lengths,names
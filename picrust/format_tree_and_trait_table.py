@@ -21,6 +21,7 @@ from cogent.util.option_parsing import parse_command_line_parameters,\
 
 from picrust.parse import parse_trait_table,yield_trait_table_fields
 from util import PicrustNode
+from picrust.compact_tree import CompactTree
 
 def reformat_tree_and_trait_table(tree,trait_table_lines,trait_to_tree_mapping,\
     input_trait_table_delimiter="\t", output_trait_table_delimiter="\t",\
@@ -517,24 +518,26 @@ def make_char_translation_fn(translation_dict,deletion_chars=''):
     their appropriate output
     """
 
+    #Build the translation table once, rather than for every label
+    from_chars = ''
+    to_chars = ''
+    for k,v in translation_dict.items():
+        from_chars += k
+        to_chars += v
+
+    translation_table = maketrans(from_chars,to_chars)
+
     def translate_conversion_fn(trait_value_field):
         # Return translation, or the original value if no translation
         # is available
         trait_value_field = str(trait_value_field).strip()
         
-        from_chars = ''
-        to_chars = ''
-        for k,v in translation_dict.items():
-            from_chars += k
-            to_chars += v
-
-        translation_table = maketrans(from_chars,to_chars)
         #print trait_value_field
         #print translation_dict.keys()
         result = trait_value_field.translate(translation_table,deletion_chars)
 
         
-        if result in translation_dict.keys():
+        if result in translation_dict:
             raise RuntimeError("failed to translate value: %s" % result)
         
         return str(result)
@@ -735,12 +738,23 @@ def remap_trait_table_organisms(trait_table_fields,trait_to_tree_mapping_dict,ve
     
     return remapped_fields
 
-def load_picrust_tree(tree_fp, verbose=False):
-    """Safely load a tree for picrust"""
+def load_picrust_tree(tree_fp, verbose=False, compact=False):
+    """Safely load a tree for picrust
+
+    tree_fp -- the newick tree filepath
+    verbose -- print verbose output
+    compact -- if True, return a picrust.compact_tree.CompactTree, parsed
+    straight into arrays with labels cleaned up as they are read (much faster
+    and smaller for large trees, and not limited by tree depth).  Otherwise
+    return a PicrustNode tree.
+    """
+    label_conversion_fns = set_label_conversion_fns(verbose=verbose)
+    if compact:
+        return CompactTree.from_newick(open(tree_fp,'U'),label_conversion_fns)
+
     #PicrustNode seems to run into very slow/memory intentsive perfromance...
     #tree = DndParser(open(opts.input_tree),constructor=PicrustNode)
     tree = DndParser(open(tree_fp),constructor=PicrustNode)
-    label_conversion_fns = set_label_conversion_fns(verbose=verbose)
 
     tree = fix_tree_labels(tree,label_conversion_fns)
     return tree
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+"""Update reconstructions and predictions when genomes are added"""
+
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from numpy import array, array_equal, flatnonzero, zeros, sqrt
+from biom.parse import parse_biom_table
+from picrust.compact_tree import get_ancestor_mask,\
+  get_nearest_marked_ancestors, as_compact_tree
+from picrust.native_asr import load_asr_tree_and_traits, pic_reconstruction,\
+  make_asr_table, make_asr_ci_table, NORMAL_QUANTILE_95
+from picrust.predict_traits import load_trait_matrix_from_file
+
+#ASR methods whose reconstructions can be updated along the paths to the root
+INCREMENTAL_ASR_METHODS = ['ace_pic','pic_native']
+
+def get_changed_tips(tip_names,tip_values,previous_trait_table_path,trait_ids):
+    """Return the indices of tips that are new or have changed values
+
+    tip_names -- the tip names, in the order of the rows of tip_values
+    tip_values -- a (tips x traits) array of the current tip values
+    previous_trait_table_path -- the trait table used for the previous
+    reconstruction
+    trait_ids -- the trait names of the columns of tip_values
+
+    Raises a ValueError if tips were removed from the trait table, since
+    their old positions in the tree can't be found.
+    """
+    previous_ids,previous_index,previous_matrix =\
+      load_trait_matrix_from_file(previous_trait_table_path,trait_ids)
+    previous_index = dict([(str(name).strip("'"),row) for name,row in\
+      previous_index.items()])
+    removed = set(previous_index).difference(tip_names)
+    if removed:
+        raise ValueError("Tips were removed from the trait table (e.g. %s). Only added or changed genomes can be updated incrementally." % sorted(removed)[0])
+    changed = []
+    for i,name in enumerate(tip_names):
+        row = previous_index.get(name)
+        if row is None or not array_equal(previous_matrix[row],tip_values[i]):
+            changed.append(i)
+    return changed
+
+def update_pic_reconstruction_for_picrust(tree_path,trait_table_path,\
+    previous_trait_table_path,previous_asr_path,verbose=False):
+    """Update an independent contrasts reconstruction for new or changed tips
+
+    tree_path -- the (pruned) newick tree for the current trait table
+    trait_table_path -- the current trait table
+    previous_trait_table_path -- the trait table of the previous reconstruction
+    previous_asr_path -- the previous reconstruction (from ace_pic or
+    pic_native) of the same traits
+
+    Returns a Table of reconstructed values and a Table of 95% confidence
+    intervals for every internal node, as pic_native_for_picrust does.  Only
+    nodes that are ancestors of new or changed tips, or that aren't in the
+    previous reconstruction, are reconstructed; the others keep their
+    previous values, as rounded in previous_asr_path.  Confidence intervals
+    only depend on branch lengths, so they are calculated for every node.
+
+    (Parsimony chooses states in a final top down pass, so a new tip can
+    change states anywhere in the tree; rerun wagner_native instead.)
+    """
+    tree,trait_ids,tip_indices,tip_values =\
+      load_asr_tree_and_traits(tree_path,trait_table_path)
+    node_names = [str(name).strip("'") for name in tree.get_node_names()]
+    tip_names = [node_names[i] for i in tip_indices]
+    changed_tips = get_changed_tips(tip_names,tip_values,\
+      previous_trait_table_path,trait_ids)
+
+    previous_ids,previous_index,previous_matrix =\
+      load_trait_matrix_from_file(previous_asr_path,trait_ids)
+    previous_index = dict([(str(name).strip("'"),row) for name,row in\
+      previous_index.items()])
+    is_tip = tree.get_tip_mask()
+    missing = [i for i,name in enumerate(node_names) if not is_tip[i] and\
+      name not in previous_index]
+
+    to_update = get_ancestor_mask(tree.parents,\
+      [tip_indices[i] for i in changed_tips] + missing)
+    known_indices = flatnonzero(~to_update & ~is_tip)
+    known_values = previous_matrix[[previous_index[node_names[i]]\
+      for i in known_indices]]
+
+    if verbose:
+        print "Found {0} new or changed tips. Reconstructing {1} of {2} internal nodes.".format(\
+          len(changed_tips),len(tree) - len(tip_indices) - len(known_indices),\
+          len(tree) - len(tip_indices))
+
+    values,variances = pic_reconstruction(tree.parents,tree.get_lengths(),\
+      tip_indices,tip_values,known_indices=known_indices,known_values=known_values)
+    margin = NORMAL_QUANTILE_95*sqrt(variances)[:,None]
+    asr_table = make_asr_table(tree,trait_ids,values,postorder=False)
+    ci_table = make_asr_ci_table(tree,trait_ids,values - margin,values + margin)
+    return asr_table,ci_table
+
+def get_nodes_to_repredict(tree,nodes_to_predict,trait_label="Reconstruction",\
+    previous_trait_label="previous_Reconstruction"):
+    """Return the nodes whose asr_and_weighting predictions may have changed
+
+    tree -- a PyCogent PhyloNode tree or CompactTree, with the current traits
+    (genomes and reconstructions) in trait_label, and the traits used for the
+    previous predictions in previous_trait_label (see assign_traits_to_tree)
+    nodes_to_predict -- the names of the tips to be predicted
+
+    A prediction is the weighted average of the node's most recent
+    reconstructed ancestor and the annotated children of its parent, or the
+    node's own traits if they are known, so it can only change if one of
+    these traits changed, or a different ancestor became the most recent
+    reconstructed one.  Returns the names in nodes_to_predict for which this
+    is the case, in the order given.
+    """
+    tree = as_compact_tree(tree,[trait_label,previous_trait_label])
+    names,parents = tree.get_node_names(),tree.parents
+    is_tip = tree.get_tip_mask()
+    rows,matrix = tree.get_trait_matrix(trait_label)
+    previous_rows,previous_matrix = tree.get_trait_matrix(previous_trait_label)
+    has_traits = rows >= 0
+    had_traits = previous_rows >= 0
+    changed = has_traits != had_traits
+    both = flatnonzero(has_traits & had_traits)
+    if matrix.shape[1:] != previous_matrix.shape[1:]:
+        changed[both] = True
+    else:
+        changed[both] = (matrix[rows[both]] !=\
+          previous_matrix[previous_rows[both]]).any(1)
+
+    #the most recent reconstructed ancestor moved, or its traits changed
+    ancestors = get_nearest_marked_ancestors(parents,has_traits)
+    affected = ancestors != get_nearest_marked_ancestors(parents,had_traits)
+    has_ancestor = ancestors >= 0
+    affected[has_ancestor] |= changed[ancestors[has_ancestor]]
+
+    #an annotated child of the parent (including the node itself) changed
+    parent_of_changed = zeros(len(names),dtype=bool)
+    parent_of_changed[parents[changed[1:].nonzero()[0] + 1]] = True
+    affected[1:] |= parent_of_changed[parents[1:]]
+    affected |= changed
+
+    affected_names = set([name for i,name in enumerate(names)\
+      if affected[i] and is_tip[i]])
+    return [name for name in nodes_to_predict if name in affected_names]
+
+def load_predictions_from_biom(biom_fp,trait_ids):
+    """Load trait predictions from a predict_traits.py .biom output file
+
+    biom_fp -- the .biom filepath (organisms are samples, traits are
+    observations)
+    trait_ids -- the trait names, in the order wanted for the prediction arrays
+
+    Returns a dict of trait arrays keyed by organism, as the predict_traits
+    functions return.  Raises a ValueError if some of trait_ids aren't in
+    the table.
+    """
+    table = parse_biom_table(open(biom_fp,'U'))
+    observation_index = dict([(o,i) for i,o in enumerate(table.ObservationIds)])
+    missing = [t for t in trait_ids if t not in observation_index]
+    if missing:
+        raise ValueError("Traits are missing from the previous predictions in %s (e.g. %s)" %\
+          (biom_fp,missing[0]))
+    rows = array([observation_index[t] for t in trait_ids],dtype=int)
+    return dict([(sample_id,array(values,dtype=float)[rows])\
+      for values,sample_id,metadata in table.iterSamples()])
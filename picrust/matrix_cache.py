@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+"""A binary, memory-mappable cache format for large PICRUSt tables"""
+
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from struct import pack, unpack
+from tempfile import TemporaryFile
+from json import dumps, loads
+from numpy import array, asarray, memmap, zeros, dtype as numpy_dtype,\
+  flatnonzero, float64, int64, arange
+from biom.table import table_factory, SparseOTUTable, DenseOTUTable,\
+  SparsePathwayTable, DensePathwayTable, SparseFunctionTable,\
+  DenseFunctionTable, SparseOrthologTable, DenseOrthologTable,\
+  SparseGeneTable, DenseGeneTable, SparseMetaboliteTable,\
+  DenseMetaboliteTable, SparseTaxonTable, DenseTaxonTable
+from picrust.util import is_sparse_biom_table, get_biom_table_type
+
+MATRIX_CACHE_MAGIC = "PICRUSTM"
+MATRIX_CACHE_VERSION = 1
+MATRIX_TYPES = ['dense','csr']
+ARRAY_ALIGNMENT = 64
+PREAMBLE_LENGTH = 24
+
+#(sparse,dense) biom table classes, by biom table type
+BIOM_TABLE_CONSTRUCTORS = {
+  'otu table':(SparseOTUTable,DenseOTUTable),
+  'pathway table':(SparsePathwayTable,DensePathwayTable),
+  'function table':(SparseFunctionTable,DenseFunctionTable),
+  'ortholog table':(SparseOrthologTable,DenseOrthologTable),
+  'gene table':(SparseGeneTable,DenseGeneTable),
+  'metabolite table':(SparseMetaboliteTable,DenseMetaboliteTable),
+  'taxon table':(SparseTaxonTable,DenseTaxonTable)}
+
+def is_matrix_cache_file(filepath):
+    """Return True if filepath is a matrix cache file, based on its magic string"""
+    try:
+        f = open(filepath,'rb')
+    except IOError:
+        return False
+    magic = f.read(len(MATRIX_CACHE_MAGIC))
+    f.close()
+    return magic == MATRIX_CACHE_MAGIC
+
+def write_matrix_cache(out_fp,row_ids,column_ids,rows,matrix_type="dense",\
+    dtype=float64,row_metadata=None,column_metadata=None,table_type=None,\
+    table_id=None):
+    """Write rows of a matrix, with ids and metadata, to a matrix cache file
+
+    out_fp -- the path of the file to write
+    row_ids -- ids for each row (e.g. organisms)
+    column_ids -- ids for each column (e.g. traits or gene families)
+    rows -- an iterable of 1D arrays, one per row id, in order.  Rows are
+    written as they are produced, so the whole matrix never needs to be
+    held in memory.
+    matrix_type -- 'dense' or 'csr' (compressed sparse row; best for
+    mostly zero tables such as gene content)
+    dtype -- the numpy dtype for stored values
+    row_metadata, column_metadata -- optional lists of JSON-compatible
+    metadata (e.g. from a biom table), one entry per id
+    table_type -- optional biom table type (e.g. 'Gene table'), used when
+    converting the cache back into a biom table
+    table_id -- optional biom table id
+
+    The file starts with the magic string 'PICRUSTM' and the offset and
+    length of a JSON header (little-endian uint64s), followed by the raw
+    arrays, each aligned to 64 bytes, and then the header itself.  The
+    header holds the ids, metadata and table type, and the offset, dtype and
+    shape of each array: 'data' for dense matrices, or 'data', 'indices' and
+    'indptr' for csr ones (as for scipy.sparse.csr_matrix).
+    """
+    if matrix_type not in MATRIX_TYPES:
+        raise ValueError("Unknown matrix type '%s'.  Valid types are: %s" %\
+          (matrix_type,", ".join(MATRIX_TYPES)))
+    row_ids = map(str,row_ids)
+    column_ids = map(str,column_ids)
+    n_cols = len(column_ids)
+    value_dtype = numpy_dtype(dtype).newbyteorder('<')
+    index_dtype = numpy_dtype(int64).newbyteorder('<')
+
+    out_f = open(out_fp,'wb')
+    out_f.write(pack('<8sQQ',MATRIX_CACHE_MAGIC,0,0))
+    arrays = {}
+    n_rows = 0
+    if matrix_type == "dense":
+        offset = _pad_to_alignment(out_f)
+        for row in rows:
+            row = _check_row(row,n_cols,n_rows)
+            out_f.write(row.astype(value_dtype).tostring())
+            n_rows += 1
+        arrays['data'] = (offset,value_dtype.str,[n_rows,n_cols])
+    else:
+        #values go straight to the output; column indices are spooled to
+        #a temporary file and copied in once all rows have been seen
+        offset = _pad_to_alignment(out_f)
+        indices_f = TemporaryFile()
+        indptr = [0]
+        for row in rows:
+            row = _check_row(row,n_cols,n_rows)
+            nonzero = flatnonzero(row)
+            out_f.write(row[nonzero].astype(value_dtype).tostring())
+            indices_f.write(nonzero.astype(index_dtype).tostring())
+            indptr.append(indptr[-1] + len(nonzero))
+            n_rows += 1
+        n_values = indptr[-1]
+        arrays['data'] = (offset,value_dtype.str,[n_values])
+
+        offset = _pad_to_alignment(out_f)
+        indices_f.seek(0)
+        while True:
+            block = indices_f.read(2**24)
+            if not block:
+                break
+            out_f.write(block)
+        indices_f.close()
+        arrays['indices'] = (offset,index_dtype.str,[n_values])
+
+        offset = _pad_to_alignment(out_f)
+        out_f.write(array(indptr,dtype=index_dtype).tostring())
+        arrays['indptr'] = (offset,index_dtype.str,[n_rows+1])
+
+    if n_rows != len(row_ids):
+        out_f.close()
+        raise ValueError("Got %i rows of data for %i row ids" %\
+          (n_rows,len(row_ids)))
+
+    header = {'version':MATRIX_CACHE_VERSION,\
+      'matrix_type':matrix_type,\
+      'shape':[n_rows,n_cols],\
+      'row_ids':row_ids,\
+      'column_ids':column_ids,\
+      'row_metadata':row_metadata,\
+      'column_metadata':column_metadata,\
+      'table_type':table_type,\
+      'table_id':table_id,\
+      'arrays':dict([(name,{'offset':o,'dtype':d,'shape':s}) for\
+        name,(o,d,s) in arrays.items()])}
+    header_str = dumps(header)
+    header_offset = out_f.tell()
+    out_f.write(header_str)
+    out_f.seek(0)
+    out_f.write(pack('<8sQQ',MATRIX_CACHE_MAGIC,header_offset,len(header_str)))
+    out_f.close()
+
+def _pad_to_alignment(f):
+    """Pad an open file with zero bytes to the next array boundary; return the offset"""
+    offset = f.tell()
+    padding = (-offset) % ARRAY_ALIGNMENT
+    f.write('\x00'*padding)
+    return offset + padding
+
+def _check_row(row,n_cols,row_number):
+    """Return row as a 1D numpy array, checking its length"""
+    row = asarray(row).ravel()
+    if len(row) != n_cols:
+        raise ValueError("Row %i has %i values, but there are %i column ids" %\
+          (row_number,len(row),n_cols))
+    return row
+
+def load_matrix_cache(filepath):
+    """Open a matrix cache file, memory-mapping its arrays
+
+    Returns a MatrixCache object.  No matrix values are read until they
+    are used, and processes that open the same file share its pages
+    through the OS page cache.
+    """
+    f = open(filepath,'rb')
+    preamble = f.read(PREAMBLE_LENGTH)
+    if len(preamble) != PREAMBLE_LENGTH or\
+      not preamble.startswith(MATRIX_CACHE_MAGIC):
+        f.close()
+        raise ValueError("%s is not a PICRUSt matrix cache file" % filepath)
+    magic,header_offset,header_length = unpack('<8sQQ',preamble)
+    f.seek(header_offset)
+    header = loads(f.read(header_length))
+    f.close()
+
+    if header['version'] > MATRIX_CACHE_VERSION:
+        raise ValueError("%s was written by a newer version of PICRUSt (matrix cache format version %i)" %\
+          (filepath,header['version']))
+
+    arrays = {}
+    for name,info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if 0 in shape:
+            arrays[name] = zeros(shape,dtype=info['dtype'])
+        else:
+            arrays[name] = memmap(filepath,dtype=info['dtype'],mode='r',\
+              offset=info['offset'],shape=shape)
+    return MatrixCache(header,arrays)
+
+class MatrixCache(object):
+    """A memory-mapped organisms x traits matrix, with ids and metadata"""
+
+    def __init__(self,header,arrays):
+        self.matrix_type = header['matrix_type']
+        self.shape = tuple(header['shape'])
+        self.row_ids = header['row_ids']
+        self.column_ids = header['column_ids']
+        self.row_metadata = header['row_metadata']
+        self.column_metadata = header['column_metadata']
+        self.table_type = header['table_type']
+        self.table_id = header['table_id']
+        self.arrays = arrays
+
+    def get_row_index(self):
+        """Return a dict mapping row ids to row indices"""
+        return dict([(row_id,i) for i,row_id in enumerate(self.row_ids)])
+
+    def get_rows(self,row_indices):
+        """Return a dense (rows x columns) array for the given row indices"""
+        row_indices = asarray(row_indices,dtype=int)
+        if self.matrix_type == "dense":
+            return asarray(self.arrays['data'][row_indices])
+
+        data = self.arrays['data']
+        indices = self.arrays['indices']
+        indptr = self.arrays['indptr']
+        result = zeros((len(row_indices),self.shape[1]),dtype=data.dtype)
+        for i,row in enumerate(row_indices):
+            start,end = indptr[row],indptr[row+1]
+            result[i,indices[start:end]] = data[start:end]
+        return result
+
+    def to_dense(self):
+        """Return the full matrix as a dense array
+
+        For dense caches this is the memory-mapped array itself, so no
+        values are copied.
+        """
+        if self.matrix_type == "dense":
+            return self.arrays['data']
+        return self.get_rows(arange(self.shape[0]))
+
+    def to_biom_table(self,row_ids=None):
+        """Return the cache (or some of its rows) as a biom table
+
+        row_ids -- if provided, only these rows are loaded.  As for
+        picrust.predict_metagenomes.load_subset_from_biom_str, all ids
+        must be present, and rows are kept in the order of the cache.
+
+        Rows become biom samples and columns become biom observations, so a
+        cache converted from a biom table round-trips to the same table.
+        """
+        if row_ids is None:
+            row_indices = arange(self.shape[0])
+        else:
+            row_ids = set(map(str,row_ids))
+            row_indices = [i for i,row_id in enumerate(self.row_ids)\
+              if row_id in row_ids]
+            if len(row_indices) != len(row_ids):
+                raise KeyError("Not all of the requested ids are in the matrix cache!")
+        sample_ids = [self.row_ids[i] for i in row_indices]
+        sample_metadata = None
+        if self.row_metadata is not None:
+            sample_metadata = [self.row_metadata[i] for i in row_indices]
+
+        table_type = (self.table_type or 'otu table').lower()
+        if table_type not in BIOM_TABLE_CONSTRUCTORS:
+            raise ValueError("Unknown biom table type '%s'" % self.table_type)
+        sparse_constructor,dense_constructor =\
+          BIOM_TABLE_CONSTRUCTORS[table_type]
+
+        if self.matrix_type == "dense":
+            values = self.get_rows(row_indices)
+            return table_factory(values.T.astype(float),sample_ids,\
+              self.column_ids,sample_metadata,self.column_metadata,\
+              table_id=self.table_id,constructor=dense_constructor)
+
+        #Build [observation,sample,value] triples straight from the
+        #compressed rows, without expanding them
+        data = self.arrays['data']
+        indices = self.arrays['indices']
+        indptr = self.arrays['indptr']
+        triples = []
+        for sample_index,row in enumerate(row_indices):
+            start,end = indptr[row],indptr[row+1]
+            for obs_index,value in zip(indices[start:end].tolist(),\
+              data[start:end].tolist()):
+                triples.append([obs_index,sample_index,value])
+        if not triples:
+            #a single zero, since biom converts dense arrays cell by cell
+            triples = [[0,0,0.0]]
+        return table_factory(triples,sample_ids,self.column_ids,\
+          sample_metadata,self.column_metadata,table_id=self.table_id,\
+          constructor=sparse_constructor,\
+          shape=(len(self.column_ids),len(sample_ids)))
+
+def biom_table_to_matrix_cache(table,out_fp,matrix_type=None,dtype=float64):
+    """Write a biom table to a matrix cache file
+
+    table -- a biom table object.  Samples (e.g. organisms) become rows and
+    observations (e.g. gene families) become columns.
+    out_fp -- the path of the file to write
+    matrix_type -- 'dense' or 'csr'.  By default, sparse biom tables are
+    stored as csr and dense tables as dense.
+    """
+    if matrix_type is None:
+        if is_sparse_biom_table(table):
+            matrix_type = "csr"
+        else:
+            matrix_type = "dense"
+    write_matrix_cache(out_fp,table.SampleIds,table.ObservationIds,\
+      table.iterSampleData(),matrix_type=matrix_type,dtype=dtype,\
+      row_metadata=_metadata_to_list(table.SampleMetadata),\
+      column_metadata=_metadata_to_list(table.ObservationMetadata),\
+      table_type=get_biom_table_type(table),table_id=table.TableId)
+
+def _metadata_to_list(metadata):
+    """Return biom metadata as a list of plain dicts (or None)"""
+    if metadata is None:
+        return None
+    return [None if md is None else dict(md) for md in metadata]
@@ -11,8 +11,10 @@ __maintainer__ = "Jesse Zaneveld"
 __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
 
-from numpy import dot, array, around
+from numpy import dot, array, around, arange, repeat, tile, bincount,\
+  cumsum, maximum, flatnonzero
 from biom.table import table_factory
+from biom.exception import TableException
 from picrust.predict_metagenomes import get_overlapping_ids,extract_otu_and_genome_data
 
 def partition_metagenome_contributions(otu_table,genome_table, limit_to_functions=[], remove_zero_rows=True,verbose=True):
@@ -23,65 +25,126 @@ def partition_metagenome_contributions(otu_table,genome_table, limit_to_function
     limit_to_functions -- a list of function ids to include.  If empty, include all function ids
     Output table as a list of lists with header
     Function\tOrganism\tSample\tCounts\tpercent_of_sample
+
+    See yield_metagenome_contributions to get the same rows one at a time
+    """
+    return list(yield_metagenome_contributions(otu_table,genome_table,\
+      limit_to_functions=limit_to_functions,remove_zero_rows=remove_zero_rows,\
+      verbose=verbose))
+
+def yield_metagenome_contributions(otu_table,genome_table, limit_to_functions=[], remove_zero_rows=True,verbose=True):
+    """Yield the contribution of each organism to each function, per sample
+
+    otu_table -- the BIOM Table object for the OTU table
+    genome_table -- the BIOM Table object for the predicted genomes
+    limit_to_functions -- a list of function ids to include.  If empty, include all function ids
+    remove_zero_rows -- if True, skip rows where the OTU contributes nothing
+
+    Yields the header row, then one row per gene, sample and OTU, in the
+    same order and with the same values as partition_metagenome_contributions.
+    Rows are produced one gene at a time, so the full result is never
+    held in memory.
+
+    The function filter and the overlap of the tables are checked (raising
+    a ValueError) when this is called, before any rows are requested, so
+    callers can fail before opening their output.
+
+    Contributions for a gene are calculated for all (sample,OTU) pairs at
+    once, as the gene count of each OTU times its abundance in each sample.
+    Only pairs where the OTU is present in the sample are considered
+    (unless remove_zero_rows is False), and per-sample totals are summed
+    with bincount.
     """
-    
     if limit_to_functions:
         if verbose:
-            print "Filtering the genome table to include only user-specified functions:",limit_to_functionss
+            print "Filtering the genome table to include only user-specified functions:",limit_to_functions
         ok_ids = frozenset(map(str,limit_to_functions))
         
         filter_by_set = lambda vals,gene_id,metadata: str(gene_id) in ok_ids
-        #filter_by_set = lambda vals,gene_id,metadata: gene_id in ok_ids
-        
-        #if verbose:
-            #print dir(genome_table)
-        #    print "Valid function ids:",genome_table.ObservationIds
-        genome_table = genome_table.filterObservations(filter_by_set)
+        try:
+            genome_table = genome_table.filterObservations(filter_by_set)
+        except TableException:
+            #biom refuses to build a table with no observations
+            genome_table = None
         
-        if genome_table.isEmpty():
+        if genome_table is None or genome_table.isEmpty():
             raise ValueError("User filtering by functions (%s) removed all results from the genome table"%(str(limit_to_functions)))
 
     otu_data,genome_data,overlapping_ids = extract_otu_and_genome_data(otu_table,genome_table)
-    #We have a list of data with abundances and gene copy numbers
-    lines=[]
-    result = [["Gene","Sample","OTU","GeneCountPerGenome",\
+    return _yield_contribution_rows(otu_table,genome_table,otu_data,\
+      genome_data,overlapping_ids,remove_zero_rows)
+
+def _yield_contribution_rows(otu_table,genome_table,otu_data,genome_data,\
+    overlapping_ids,remove_zero_rows):
+    """Yield the rows for yield_metagenome_contributions, from checked inputs"""
+    #OTUs x samples and OTUs x genes, with OTUs in overlapping_ids order
+    otu_data = array(otu_data,dtype=float)
+    genome_data = array(genome_data,dtype=float)
+    n_samples = len(otu_table.SampleIds)
+
+    yield ["Gene","Sample","OTU","GeneCountPerGenome",\
             "OTUAbundanceInSample","CountContributedByOTU",\
-            "ContributionPercentOfSample","ContributionPercentOfAllSamples"]]
+            "ContributionPercentOfSample","ContributionPercentOfAllSamples"]
 
-    #TODO refactor as array operations for speed
+    #(sample,OTU) pairs in output order: by sample, then by OTU
+    if remove_zero_rows:
+        entry_samples,entry_otus = otu_data.T.nonzero()
+    else:
+        entry_samples = repeat(arange(n_samples),len(overlapping_ids))
+        entry_otus = tile(arange(len(overlapping_ids)),n_samples)
+    entry_abundances = otu_data[entry_otus,entry_samples]
+    entry_sample_ids = [otu_table.SampleIds[k] for k in entry_samples]
+    entry_otu_ids = [overlapping_ids[i] for i in entry_otus]
 
     #Zero-valued total counts will be set to epsilon 
     epsilon = 1e-5
 
     for j,gene_id in enumerate(genome_table.ObservationIds):
-        all_gene_rows = []
-        for k,sample_id in enumerate(otu_table.SampleIds):
-            #Add raw counts for the gene in this sample to a list
-            sample_gene_rows = []
-            for i,otu_id in enumerate(overlapping_ids):
-                otu_gene_count = genome_data[i][j]
-                otu_abundance = otu_data[i][k]
-                contribution =  otu_gene_count * otu_abundance
-                if remove_zero_rows and contribution == 0.0:
-                    #skip zero contributions
-                    continue
-                sample_gene_rows.append([gene_id,sample_id,otu_id,otu_gene_count,otu_abundance,contribution])
-            #Now get the percentage of each genes contribution to the sample overall
-            total_counts =max(epsilon,sum([float(row[-1]) for row in sample_gene_rows]))
-
-            for row in sample_gene_rows:
-                percent_of_sample = float(row[-1])/total_counts
-                row.append(percent_of_sample)
-            all_gene_rows.extend(sample_gene_rows)
-        
-        count_idx = -2 #Counts are now in the next to last position in each row
-        total_counts =max(epsilon,sum([float(row[count_idx]) for row in all_gene_rows]))
+        gene_counts = genome_data[entry_otus,j]
+        contributions = gene_counts * entry_abundances
+        if remove_zero_rows:
+            #skip zero contributions
+            entries = flatnonzero(contributions)
+            if not len(entries):
+                continue
+        else:
+            entries = arange(len(contributions))
+        gene_counts = gene_counts[entries]
+        abundances = entry_abundances[entries]
+        contributions = contributions[entries]
+        samples = entry_samples[entries]
 
-        for row in all_gene_rows:
-            percent_of_sample = float(row[count_idx])/total_counts
-            row.append(percent_of_sample)
-        lines.extend(all_gene_rows)
-    result.extend(lines)
+        #Now get the percentage of each genes contribution to the sample overall
+        sample_totals = maximum(epsilon,\
+          bincount(samples,weights=contributions,minlength=n_samples))
+        percents_of_sample = (contributions/sample_totals[samples]).tolist()
 
-    return result
+        #(cumsum adds in row order, so totals match a running sum exactly)
+        total_counts = max(epsilon,float(cumsum(contributions)[-1]))
+        percents_of_all_samples = (contributions/total_counts).tolist()
 
+        for n,entry in enumerate(entries):
+            yield [gene_id,entry_sample_ids[entry],entry_otu_ids[entry],\
+              gene_counts[n],abundances[n],contributions[n],\
+              percents_of_sample[n],percents_of_all_samples[n]]
+
+def write_metagenome_contributions(rows,out_f,flush_per_gene=True):
+    """Write metagenome contribution rows to an open file as tab-delimited text
+
+    rows -- an iterable of rows, as from yield_metagenome_contributions
+    out_f -- an open (possibly gzipped) file object for the output
+    flush_per_gene -- if True, flush out_f each time a new gene starts,
+    so that complete genes reach the disk as they are calculated
+
+    Rows are written one at a time as they are produced, so memory use
+    does not depend on the number of rows.  The output is the same as
+    joining all rows with tabs and newlines (no trailing newline).
+    """
+    current_gene = None
+    for i,row in enumerate(rows):
+        if i:
+            out_f.write('\n')
+            if flush_per_gene and row[0] != current_gene:
+                out_f.flush()
+        current_gene = row[0]
+        out_f.write('\t'.join(map(str,row)))
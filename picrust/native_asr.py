@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+"""Ancestral state reconstruction with numpy, without R or Java"""
+
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from math import atan, cos, sin, pi
+from numpy import arange, argsort, array, empty, floor, inf, minimum, zeros,\
+  sqrt, round as numpy_round, maximum, log, isnan, isinf, errstate, flatnonzero
+from cogent.util.table import Table
+from picrust.compact_tree import CompactTree
+from picrust.predict_traits import load_trait_matrix_from_file
+
+def load_asr_tree_and_traits(tree_path,trait_table_path):
+    """Load a tree and trait table for ASR, as arrays
+
+    tree_path -- a newick tree filepath.  Internal nodes must be named.
+    trait_table_path -- a trait table filepath, with tips as rows
+
+    Returns the tree as a CompactTree, the trait names, the preorder indices
+    of the tips, and a (tips x traits) matrix of tip values in the same order.
+    Single quotes around names are ignored when matching tips to rows.
+    Raises a ValueError if a tip is missing from the trait table, or an
+    internal node is unnamed.
+    """
+    tree = CompactTree.from_newick(open(tree_path,'U'))
+    trait_ids,row_index,trait_matrix = load_trait_matrix_from_file(trait_table_path)
+    row_index = dict([(str(r).strip("'"),i) for r,i in row_index.items()])
+
+    tip_indices = []
+    tip_rows = []
+    is_tip = tree.get_tip_mask().tolist()
+    for i,name in enumerate(tree.get_node_names()):
+        if not is_tip[i]:
+            if name is None:
+                raise ValueError("All internal nodes in the tree must be named for ASR")
+            continue
+        name = str(name).strip("'")
+        if name not in row_index:
+            raise ValueError("Tip %s is not in the trait table" % name)
+        tip_indices.append(i)
+        tip_rows.append(row_index[name])
+    return tree,trait_ids,array(tip_indices,dtype=int),trait_matrix[tip_rows]
+
+#The standard normal quantile for 95% confidence intervals (R's qnorm(0.975))
+NORMAL_QUANTILE_95 = 1.959963984540054
+
+def make_asr_table(tree,trait_ids,node_values,value_type=None,\
+    postorder=True):
+    """Return a cogent Table of node values for the internal nodes of a tree
+
+    tree -- a CompactTree
+    trait_ids -- the trait names, used as column headers
+    node_values -- a (nodes x traits) array of values, in preorder
+    value_type -- if provided, a function applied to each value (e.g. int)
+    postorder -- if True, rows are in postorder, as the Count app controller
+    gives them.  Otherwise they are in preorder, as the ace app controller
+    gives them.
+    """
+    if postorder:
+        order = tree.postorder
+    else:
+        order = arange(len(tree))
+    order = order[~tree.get_tip_mask()[order]]
+    names = tree.get_node_names()
+    rows = []
+    for i,values in zip(order.tolist(),node_values[order].tolist()):
+        if value_type is not None:
+            values = map(value_type,values)
+        rows.append([names[i]] + values)
+    return Table(header=['nodes'] + list(trait_ids),rows=rows)
+
+def _linear_cost_transform(costs,gain,loss):
+    """Return the lowest cost of a child's subtree for each parent state
+
+    costs -- a (states x traits) array of the cost of the child's subtree
+    for each child state
+
+    Changing from parent state s to child state t costs gain*(t-s) if t > s,
+    and loss*(s-t) otherwise.  The minimum over t <= s of costs[t] - loss*t,
+    plus loss*s, is the cheapest loss, and likewise for gains, so two
+    cumulative minimums over the state axis give the result for all states
+    and traits at once, rather than comparing all pairs of states.
+    """
+    state_range = arange(costs.shape[0])[:,None]
+    from_below = minimum.accumulate(costs - loss * state_range,axis=0)
+    from_below += loss * state_range
+    from_above = minimum.accumulate((costs + gain * state_range)[::-1],\
+      axis=0)[::-1]
+    from_above -= gain * state_range
+    return minimum(from_below,from_above,from_below)
+
+def _argmin_last(values,tolerance=1e-9):
+    """Return the index of the last minimum along the first axis of values
+
+    Values within tolerance (relative to the minimum) of the minimum count
+    as ties, so rounding in sums of non-integer penalties doesn't decide
+    which of two equally good states is chosen.
+    """
+    lowest = values.min(axis=0)
+    is_lowest = values <= lowest + tolerance * maximum(abs(lowest),1.0)
+    return len(values) - 1 - is_lowest[::-1].argmax(axis=0)
+
+def wagner_parsimony(parents,tip_indices,tip_values,gain=1.0,loss=1.0,\
+    max_cells=2**25):
+    """Reconstruct integer traits for every node by Wagner parsimony
+
+    parents -- preorder parent indices (see CompactTree)
+    tip_indices -- the preorder indices of the tips
+    tip_values -- a (tips x traits) array of non-negative integer values
+    gain -- the penalty for each unit increase along a branch
+    loss -- the penalty for each unit decrease along a branch
+    max_cells -- limits memory use: traits are processed in blocks with at
+    most this many (internal node x trait x state) cost cells (8 bytes each)
+
+    Returns a (nodes x traits) integer array of the states of all nodes
+    minimizing the total penalty.  A postorder pass computes, for every
+    node, trait and state, the lowest penalty of the node's subtree, and a
+    preorder pass then chooses each node's state given its parent's.  Ties
+    are broken in favour of the larger state, as in Count.
+
+    Each pass is a Python loop over the nodes, once per block of traits,
+    where each step is a numpy operation on a (states x traits in block)
+    array.  Run time is therefore about blocks x nodes interpreter steps
+    plus nodes x states x traits arithmetic.  Traits are sorted by their
+    largest value and each block takes as many traits as fit in max_cells,
+    so there is a single block unless the tree, the number of traits or
+    the largest counts are large, and traits with high counts don't
+    increase the number of states for all others.
+    """
+    tip_values = array(tip_values,dtype=float)
+    n_nodes = len(parents)
+    n_tips,n_traits = tip_values.shape
+    if n_tips != len(tip_indices):
+        raise ValueError("tip_values must have one row per tip")
+    if (tip_values < 0).any() or (floor(tip_values) != tip_values).any():
+        raise ValueError("Wagner parsimony requires non-negative integer trait values")
+
+    result = zeros((n_nodes,n_traits),dtype=int)
+    if n_traits == 0 or n_tips == 0:
+        return result
+
+    #Only internal nodes have a cost table
+    n_internal = max(n_nodes - n_tips,1)
+    max_values = tip_values.max(axis=0).astype(int)
+    trait_order = argsort(max_values,kind='mergesort')
+    start = 0
+    while start < n_traits:
+        #Traits are sorted, so the block's last trait has the most states
+        n_states = max_values[trait_order[start]] + 1
+        end = start + 1
+        while end < n_traits:
+            states = max_values[trait_order[end]] + 1
+            if (end - start + 1) * states * n_internal > max_cells:
+                break
+            n_states = states
+            end += 1
+        block = trait_order[start:end]
+        result[:,block] = _wagner_parsimony_block(parents,tip_indices,\
+          tip_values[:,block].astype(int),n_states,gain,loss)
+        start = end
+    return result
+
+def _wagner_parsimony_block(parents,tip_indices,tip_values,n_states,gain,loss):
+    """Run wagner_parsimony for a block of traits with at most n_states states"""
+    n_nodes = len(parents)
+    n_traits = tip_values.shape[1]
+    state_range = arange(n_states)
+
+    #Penalty of each change from parent state s (columns) to child state t (rows)
+    change = state_range[:,None] - state_range[None,:]
+    penalties = (change > 0) * change * gain - (change < 0) * change * loss
+
+    states = empty((n_nodes,n_traits),dtype=int)
+    states[tip_indices] = tip_values
+    is_tip = zeros(n_nodes,dtype=bool)
+    is_tip[tip_indices] = True
+    is_tip = is_tip.tolist()
+
+    #Cost of each internal node's subtree for each (state, trait).  Tips
+    #don't need a cost table, as their states are known.
+    cost_rows = {}
+    for i in xrange(n_nodes):
+        if not is_tip[i]:
+            cost_rows[i] = len(cost_rows)
+    costs = zeros((len(cost_rows),n_states,n_traits))
+
+    #Up pass: children come after their parents in preorder
+    parent_list = parents.tolist()
+    for i in xrange(n_nodes-1,0,-1):
+        parent_costs = costs[cost_rows[parent_list[i]]]
+        if is_tip[i]:
+            #the cheapest change from each parent state to the tip's state
+            parent_costs += penalties[states[i],:].T
+        else:
+            parent_costs += _linear_cost_transform(costs[cost_rows[i]],gain,loss)
+
+    #Down pass: pick states top down
+    if not is_tip[0]:
+        states[0] = _argmin_last(costs[0])
+    for i in xrange(1,n_nodes):
+        if not is_tip[i]:
+            states[i] = _argmin_last(costs[cost_rows[i]] +\
+              penalties[:,states[parent_list[i]]])
+    return states
+
+def wagner_native_for_picrust(tree_path,trait_table_path,gain=None,\
+    max_paralogs=None):
+    """Reconstruct traits by Wagner parsimony, as wagner_for_picrust does, but in Python
+
+    tree_path -- a newick tree filepath with named internal nodes
+    trait_table_path -- a trait table filepath, with tips as rows
+    gain -- the gain penalty, relative to a loss penalty of 1 (default 1)
+    max_paralogs -- if provided, tip values are capped at this count
+
+    Returns a Table of integer counts for the internal nodes of the tree.
+    """
+    tree,trait_ids,tip_indices,tip_values =\
+      load_asr_tree_and_traits(tree_path,trait_table_path)
+    if max_paralogs is not None:
+        tip_values = minimum(tip_values,max_paralogs)
+    if gain is None:
+        gain = 1.0
+    node_values = wagner_parsimony(tree.parents,tip_indices,tip_values,gain=gain)
+    return make_asr_table(tree,trait_ids,node_values,value_type=int)
+
+def round_as_r(values,digits=4):
+    """Round an array as ace.R does before writing, so that '%.15g' formats it as R would"""
+    #adding 0.0 turns -0.0 into 0.0, which R writes as 0
+    return numpy_round(values,digits) + 0.0
+
+def format_r_values(values,digits=4):
+    """Return a list of strings for an array, as ace.R writes rounded values (with Inf and NaN)"""
+    formatted = []
+    for value in round_as_r(values,digits).tolist():
+        if isnan(value):
+            formatted.append('NaN')
+        elif isinf(value):
+            formatted.append('Inf' if value > 0 else '-Inf')
+        else:
+            formatted.append('%.15g' % value)
+    return formatted
+
+def make_asr_ci_table(tree,trait_ids,lower,upper,params=[]):
+    """Return a cogent Table of confidence intervals, as ace_for_picrust gives
+
+    tree -- a CompactTree
+    trait_ids -- the trait names, used as column headers
+    lower,upper -- (nodes x traits) arrays of the interval bounds
+    params -- a list of (name, values) for extra rows (e.g. sigma and loglik),
+    where values holds one string per trait
+
+    Internal nodes are listed in preorder, with each interval as 'lower|upper'
+    rounded to 4 decimal places (see parse_asr_confidence_output).
+    """
+    lower = round_as_r(lower)
+    upper = round_as_r(upper)
+    rows = []
+    names = tree.get_node_names()
+    for i in flatnonzero(~tree.get_tip_mask()).tolist():
+        rows.append([names[i]] + ['%.15g|%.15g' % bounds\
+          for bounds in zip(lower[i].tolist(),upper[i].tolist())])
+    for name,values in params:
+        rows.append([name] + list(values))
+    return Table(header=['nodes'] + list(trait_ids),rows=rows)
+
+def pic_reconstruction(parents,lengths,tip_indices,tip_values,\
+    known_indices=None,known_values=None):
+    """Reconstruct traits for every node by phylogenetic independent contrasts
+
+    parents -- preorder parent indices (see CompactTree)
+    lengths -- preorder branch lengths (see CompactTree)
+    tip_indices -- the preorder indices of the tips
+    tip_values -- a (tips x traits) array of trait values
+
+    Returns a (nodes x traits) array of values, and an array of the variance
+    used for each node's confidence interval.  As in ape's ace (method 'pic'),
+    each internal node is estimated from its descendants only, in a single
+    postorder pass: child values are averaged, weighted by the inverse of
+    their (extended) branch lengths, and the node's branch is extended by
+    l1*l2/(l1+l2).  The variance is l1+l2, the variance of the node's contrast.
+
+    The weights depend only on branch lengths, so all traits are updated
+    together with one row operation per branch.  Polytomies are treated as a
+    ladder of zero-length branches, pairing children in order.
+
+    known_indices,known_values -- optionally, the preorder indices of internal
+    nodes whose values are already known (e.g. from a previous reconstruction
+    of a subtree that hasn't changed), and a (nodes x traits) array of their
+    values.  Their subtrees are only walked to extend branch lengths, which
+    don't depend on the traits, so trait values are only calculated for the
+    other nodes.
+    """
+    n_nodes = len(parents)
+    tip_values = array(tip_values,dtype=float)
+    values = zeros((n_nodes,tip_values.shape[1]))
+    values[tip_indices] = tip_values
+    variances = zeros(n_nodes)
+
+    #Nodes below a known node don't contribute to any calculated value
+    skip = [False]*n_nodes
+    if known_indices is not None and len(known_indices):
+        values[known_indices] = known_values
+        is_known = zeros(n_nodes,dtype=bool)
+        is_known[known_indices] = True
+        is_known = is_known.tolist()
+        for i,parent in enumerate(parents.tolist()):
+            if i:
+                skip[i] = skip[parent] or is_known[parent]
+
+    parent_list = parents.tolist()
+    extended = lengths.tolist()
+    #Length of the pseudo-branch from each node to the clade of the children
+    #combined so far, or None if no child has been combined yet
+    combined = [None]*n_nodes
+    is_tip = zeros(n_nodes,dtype=bool)
+    is_tip[tip_indices] = True
+    is_tip = is_tip.tolist()
+
+    for i in xrange(n_nodes-1,-1,-1):
+        if not is_tip[i]:
+            if combined[i] is None:
+                raise ValueError("Internal nodes must have children")
+            #values[i] is complete: extend the node's own branch
+            extended[i] += combined[i]
+        if i == 0:
+            break
+        parent = parent_list[i]
+        length = extended[i]
+        if combined[parent] is None:
+            if not skip[i]:
+                values[parent] = values[i]
+            combined[parent] = length
+            variances[parent] = length
+            continue
+        other = combined[parent]
+        total = other + length
+        if total > 0:
+            if not skip[i]:
+                values[parent] *= length/total
+                values[parent] += values[i]*(other/total)
+            combined[parent] = other*length/total
+        else:
+            if not skip[i]:
+                values[parent] += values[i]
+                values[parent] *= 0.5
+            combined[parent] = 0.0
+        variances[parent] = total
+    return values,variances
+
+def pic_native_for_picrust(tree_path,trait_table_path):
+    """Reconstruct traits by independent contrasts, as ace_for_picrust does with 'pic', but in Python
+
+    tree_path -- a newick tree filepath with named internal nodes
+    trait_table_path -- a trait table filepath, with tips as rows
+
+    Returns a Table of reconstructed values and a Table of 95% confidence
+    intervals for the internal nodes, in the ace_for_picrust format.
+    """
+    tree,trait_ids,tip_indices,tip_values =\
+      load_asr_tree_and_traits(tree_path,trait_table_path)
+    values,variances = pic_reconstruction(tree.parents,tree.get_lengths(),\
+      tip_indices,tip_values)
+    margin = NORMAL_QUANTILE_95*sqrt(variances)[:,None]
+    asr_table = make_asr_table(tree,trait_ids,values,postorder=False)
+    ci_table = make_asr_ci_table(tree,trait_ids,values - margin,values + margin)
+    return asr_table,ci_table
+
+def student_t_quantile(p,df,tolerance=1e-12):
+    """Return the p quantile (0.5 <= p < 1) of Student's t distribution with integer df
+
+    The distribution function is calculated with the finite series for
+    integer degrees of freedom (Abramowitz and Stegun 26.7.3 and 26.7.4),
+    and inverted by bisection.
+    """
+    if df < 1 or int(df) != df:
+        raise ValueError("df must be a positive integer, not %s" % df)
+    if not 0.5 <= p < 1:
+        raise ValueError("p must be at least 0.5 and less than 1, not %s" % p)
+    df = int(df)
+
+    def central_probability(t):
+        """P(|T| < t)"""
+        theta = atan(t/df**0.5)
+        c2 = cos(theta)**2
+        if df % 2:
+            term = cos(theta)
+            total = 0.0
+            if df > 1:
+                total = term
+                for k in xrange(3,df-1,2):
+                    term *= c2*(k-1)/k
+                    total += term
+            return 2/pi*(theta + sin(theta)*total)
+        term = 1.0
+        total = 1.0
+        for k in xrange(2,df-1,2):
+            term *= c2*(k-1)/k
+            total += term
+        return sin(theta)*total
+
+    target = 2*p - 1
+    low,high = 0.0,1.0
+    while central_probability(high) < target:
+        high *= 2
+    while high - low > tolerance*max(1.0,high):
+        mid = (low + high)/2
+        if central_probability(mid) < target:
+            low = mid
+        else:
+            high = mid
+    return (low + high)/2
+
+def brownian_motion_reconstruction(parents,lengths,tip_indices,tip_values,\
+    method='ML',min_length=1e-8):
+    """Reconstruct traits for every node by maximum likelihood under Brownian motion
+
+    parents -- preorder parent indices (see CompactTree)
+    lengths -- preorder branch lengths (see CompactTree)
+    tip_indices -- the preorder indices of the tips
+    tip_values -- a (tips x traits) array of trait values
+    method -- 'ML' or 'REML', as for ape's ace
+    min_length -- shorter branches are given this length, so that the
+    likelihood is defined
+
+    Returns a (nodes x traits) array of values, a (nodes x traits) array of
+    the standard errors of the values, and for each trait, arrays of the 
+    Brownian motion rate (sigma^2), its standard error, and the log 
+    likelihood ('ML') or restricted log likelihood ('REML', computed from
+    the independent contrasts).  These follow
+    the estimates of ape's ace (see ace.R).
+
+    The ML ancestral states are the expected values of the internal nodes
+    given the tips.  Rather than inverting a covariance matrix, they are
+    found with two passes over the tree: a postorder pass combines the
+    information from each node's descendants (as for independent contrasts),
+    and a preorder pass adds the information from the rest of the tree.  The
+    precision of each node's estimate depends only on branch lengths, so all
+    traits are updated together with one row operation per branch.
+    """
+    if method not in ['ML','REML']:
+        raise ValueError("method must be 'ML' or 'REML', not %s" % method)
+    n_nodes = len(parents)
+    tip_values = array(tip_values,dtype=float)
+    n_tips,n_traits = tip_values.shape
+    n_internal = n_nodes - n_tips
+    if n_internal < 1:
+        raise ValueError("The tree must have internal nodes")
+
+    parent_list = parents.tolist()
+    length_list = maximum(lengths,min_length).tolist()
+    is_tip = zeros(n_nodes,dtype=bool)
+    is_tip[tip_indices] = True
+    is_tip = is_tip.tolist()
+
+    #Postorder pass: information from each node's descendants, as the
+    #precision of the estimate (below), and precision weighted sum of values
+    below = [0.0]*n_nodes
+    below_sums = zeros((n_nodes,n_traits))
+    means = zeros((n_nodes,n_traits))
+    means[tip_indices] = tip_values
+    #weight of each node's estimate in its parent's
+    weights = [0.0]*n_nodes
+    #sum of squared standardized contrasts, and of the logs of their
+    #variances, for REML
+    contrasts = zeros(n_traits)
+    log_contrast_variances = 0.0
+    for i in xrange(n_nodes-1,0,-1):
+        if is_tip[i]:
+            weight = 1/length_list[i]
+        else:
+            means[i] = below_sums[i]/below[i]
+            weight = 1/(length_list[i] + 1/below[i])
+        weights[i] = weight
+        parent = parent_list[i]
+        if below[parent] > 0:
+            contrast_variance = 1/weight + 1/below[parent]
+            contrasts += (below_sums[parent]/below[parent] - means[i])**2/\
+              contrast_variance
+            log_contrast_variances += log(contrast_variance)
+        below[parent] += weight
+        below_sums[parent] += weight*means[i]
+    means[0] = below_sums[0]/below[0]
+
+    #Preorder pass: information from outside each node's subtree (above)
+    above = [0.0]*n_nodes
+    above_sums = zeros((n_nodes,n_traits))
+    variances = zeros(n_nodes)
+    variances[0] = 1/below[0]
+    for i in xrange(1,n_nodes):
+        if is_tip[i]:
+            continue
+        parent = parent_list[i]
+        outside = below[parent] + above[parent] - weights[i]
+        if outside > 0:
+            outside_mean = (below_sums[parent] + above_sums[parent] -\
+              weights[i]*means[i])/outside
+            above[i] = 1/(length_list[i] + 1/outside)
+            above_sums[i] = above[i]*outside_mean
+        precision = below[i] + above[i]
+        means[i] = (below_sums[i] + above_sums[i])/precision
+        variances[i] = 1/precision
+
+    #Sum of squared changes along branches, scaled by branch length
+    diffs = means[1:] - means[parents[1:]]
+    changes = (diffs**2/maximum(lengths[1:],min_length)[:,None]).sum(axis=0)
+
+    if method == 'ML':
+        #ace maximizes the likelihood of the changes over the node states
+        #and sigma^2 jointly, and takes errors from its deviance's Hessian
+        sigma2 = changes/(2*n_internal)
+        sigma2_se = sigma2/sqrt(2*n_internal)
+        errors = sqrt(variances[:,None]*sigma2[None,:]/2)
+        #Traits without any variation have sigma^2 = 0, and an infinite
+        #likelihood
+        scaled_changes = changes.copy()
+        varies = sigma2 > 0
+        scaled_changes[varies] /= 2*sigma2[varies]
+        with errstate(divide='ignore'):
+            loglik = -scaled_changes - n_internal*log(sigma2)
+    else:
+        #ace fits sigma^2 to the tips, with the mean at the independent
+        #contrasts root estimate, then fits the node states given sigma^2
+        sigma2 = contrasts/n_tips
+        sigma2_se = sigma2*sqrt(2/n_tips)
+        errors = sqrt(variances[:,None]*sigma2[None,:])
+        #The restricted log likelihood of the tips given sigma^2 and that
+        #mean.  The Mahalanobis distance of the tips is the sum of squared
+        #standardized contrasts, and the log determinant of their covariance
+        #is the sum of the logs of the contrast variances plus that of the
+        #root estimate.
+        scaled_contrasts = contrasts.copy()
+        varies = sigma2 > 0
+        scaled_contrasts[varies] /= sigma2[varies]
+        log_det = log_contrast_variances - log(below[0])
+        with errstate(divide='ignore'):
+            loglik = -(n_tips*log(2*pi) + n_tips*log(sigma2) + log_det +\
+              scaled_contrasts)/2
+    errors[tip_indices] = 0
+    return means,errors,sigma2,sigma2_se,loglik
+
+def bm_native_for_picrust(tree_path,trait_table_path,method='ML'):
+    """Reconstruct traits by Brownian motion, as ace_for_picrust does with 'ML' or 'REML', but in Python
+
+    tree_path -- a newick tree filepath with named internal nodes
+    trait_table_path -- a trait table filepath, with tips as rows
+    method -- 'ML' or 'REML'
+
+    Returns a Table of reconstructed values and a Table of 95% confidence
+    intervals for the internal nodes, followed by 'sigma' (sigma^2 and its
+    standard error) and 'loglik' rows, in the ace_for_picrust format.
+    """
+    tree,trait_ids,tip_indices,tip_values =\
+      load_asr_tree_and_traits(tree_path,trait_table_path)
+    values,errors,sigma2,sigma2_se,loglik = brownian_motion_reconstruction(\
+      tree.parents,tree.get_lengths(),tip_indices,tip_values,method=method)
+    #as in ace, intervals use the t distribution with (internal nodes) df
+    n_internal = len(tree) - len(tip_indices)
+    margin = student_t_quantile(0.975,n_internal)*errors
+    asr_table = make_asr_table(tree,trait_ids,values,postorder=False)
+    sigma = ['%s|%s' % pair for pair in\
+      zip(format_r_values(sigma2),format_r_values(sigma2_se))]
+    ci_table = make_asr_ci_table(tree,trait_ids,values - margin,values + margin,\
+      params=[('sigma',sigma),('loglik',format_r_values(loglik))])
+    return asr_table,ci_table
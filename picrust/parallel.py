@@ -21,9 +21,22 @@ from cogent import LoadTable
 from cogent.util.table import Table
 from cogent.app.util import get_tmp_filename
 from picrust.util import get_picrust_project_dir
-from os.path import join
-from time import sleep
+from os.path import join, split, abspath
+from os import listdir, read, close
+from time import sleep, time
 from itertools import izip_longest
+from select import select
+import struct
+
+#Suffix for the files that record a job's exit status (see wrap_command_with_sentinel)
+SENTINEL_SUFFIX = '.done'
+
+#inotify event masks (from sys/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
 
 def grouper(iterable, n, fillvalue=None):
         args = [iter(iterable)] * n
@@ -58,14 +71,194 @@ def system_call(cmd):
     return stdout, stderr, return_value
     
 
-def wait_for_output_files(files):
-    ''' Function waits until all files exist in the filesystem'''
-    #make a copy of the list
-    waiting_files=list(files)
-
-    #wait until nothing left in the list
-    while(waiting_files):
-        #wait 30 seconds between each check
-        sleep(30)
-        #check each file and keep ones that don't yet exist
-        waiting_files=filter(lambda x: not exists(x),waiting_files)
+def get_sentinel_fp(output_fp):
+    """Return the sentinel filepath for a job that writes output_fp"""
+    return output_fp + SENTINEL_SUFFIX
+
+def wrap_command_with_sentinel(cmd, sentinel_fp):
+    """Return a shell command that runs cmd, then writes its exit status to sentinel_fp
+
+    The status is written to a temporary file which is then renamed, so
+    sentinel_fp appears atomically, with its full contents, once cmd has
+    finished (successfully or not).  cmd is not run in a subshell (job
+    scripts split commands on ';'), so it shouldn't call the shell's exit.
+    """
+    tmp_fp = sentinel_fp + '.tmp'
+    return '%s; echo $? > "%s" && mv "%s" "%s"' % (cmd, tmp_fp, tmp_fp, sentinel_fp)
+
+def read_sentinel_file(sentinel_fp):
+    """Return the exit status recorded in a sentinel file"""
+    status = open(sentinel_fp).read().strip()
+    try:
+        return int(status)
+    except ValueError:
+        raise ValueError("Sentinel file %s does not contain an exit status: %r" %\
+          (sentinel_fp, status))
+
+class InotifyWatcher(object):
+    """Wakes up when files are created in, or moved into, a set of directories
+
+    Uses the Linux inotify API through ctypes.  Raises an OSError on creation
+    if inotify is not available.
+    """
+
+    def __init__(self, dirs):
+        import ctypes, ctypes.util
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("Could not find the C library")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.dirs = {}
+        for d in dirs:
+            wd = libc.inotify_add_watch(self.fd, d,\
+              IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), "Could not watch %s" % d)
+            self.dirs[wd] = d
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events
+
+        Returns a list of (directory, filename) for created files, or None if
+        the kernel's event queue overflowed (so the directories should be 
+        rescanned).
+        """
+        ready = select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return []
+        buf = read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos + INOTIFY_EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT_HEADER.unpack_from(buf, pos)
+            pos += INOTIFY_EVENT_HEADER.size
+            name = buf[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd in self.dirs and name:
+                events.append((self.dirs[wd], name))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            close(self.fd)
+            self.fd = None
+
+def iter_completed_files(files, timeout=None, poll_interval=1.0,\
+    max_poll_interval=30.0, backoff_factor=2.0, use_inotify=True):
+    """Yield each of files as soon as it exists, until all have been yielded
+
+    files -- the filepaths to wait for
+    timeout -- raise a RuntimeError if the files don't all exist after this
+     many seconds (default: wait forever)
+    poll_interval -- seconds to wait between the first checks
+    max_poll_interval -- the longest wait between checks
+    backoff_factor -- the wait between checks is multiplied by this each time
+     nothing new is found (and reset to poll_interval when something is)
+    use_inotify -- where inotify is available, wake up as soon as files are
+     created rather than at the next check
+
+    Directories are listed rather than checking each file, so each check costs
+    one listdir per directory however many files are outstanding.  Checks 
+    still happen when inotify is used, since it doesn't see files written by
+    other hosts on network filesystems.
+    """
+    pending = {}
+    for f in files:
+        d, name = split(abspath(f))
+        pending.setdefault(d, {})[name] = f
+    if not pending:
+        return
+
+    watcher = None
+    if use_inotify:
+        try:
+            watcher = InotifyWatcher(pending.keys())
+        except OSError:
+            watcher = None
+
+    start = time()
+    interval = poll_interval
+    try:
+        rescan = True
+        while pending:
+            completed = []
+            if rescan:
+                for d in pending.keys():
+                    try:
+                        names = listdir(d)
+                    except OSError:
+                        continue
+                    completed.extend([(d, name) for name in names if name in pending[d]])
+            else:
+                completed = events
+            
+            found = False
+            for d, name in completed:
+                if d in pending and name in pending[d]:
+                    found = True
+                    yield pending[d].pop(name)
+                    if not pending[d]:
+                        del pending[d]
+            if not pending:
+                break
+
+            if found:
+                interval = poll_interval
+            elif rescan:
+                interval = min(interval * backoff_factor, max_poll_interval)
+
+            wait = interval
+            if timeout is not None:
+                remaining = timeout - (time() - start)
+                if remaining <= 0:
+                    raise RuntimeError("Timed out after %s seconds waiting for %i files, e.g. %s" %\
+                      (timeout, sum(map(len, pending.values())), pending.values()[0].values()[0]))
+                wait = min(wait, remaining)
+
+            if watcher is None:
+                sleep(wait)
+                rescan = True
+            else:
+                events = watcher.wait(wait)
+                #rescan on timeouts (for network filesystems) and queue overflows
+                rescan = not events
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+def wait_for_output_files(files, **kwargs):
+    """ Function waits until all files exist in the filesystem
+
+    kwargs -- passed to iter_completed_files (timeout, poll_interval, etc.)
+    """
+    for f in iter_completed_files(files, **kwargs):
+        pass
+
+def wait_for_job_sentinels(sentinel_files, verbose=False, **kwargs):
+    """Wait until all jobs have written their sentinel files, and return their exit statuses
+
+    sentinel_files -- the sentinel filepaths (see wrap_command_with_sentinel)
+    kwargs -- passed to iter_completed_files (timeout, poll_interval, etc.)
+
+    Returns a dict of sentinel filepath to exit status.  Raises a RuntimeError
+    as soon as any job reports a non-zero exit status, rather than waiting 
+    for output that will never be written.
+    """
+    statuses = {}
+    for sentinel_fp in iter_completed_files(sentinel_files, **kwargs):
+        status = read_sentinel_file(sentinel_fp)
+        if status != 0:
+            raise RuntimeError("Job for %s failed with exit status %i" %\
+              (sentinel_fp, status))
+        statuses[sentinel_fp] = status
+        if verbose:
+            print "Job finished: %s (%i of %i)" % (sentinel_fp, len(statuses), len(sentinel_files))
+    return statuses
@@ -11,9 +11,16 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 __status__ = "Development"
 
-from numpy import dot, array, around
+from datetime import datetime
+from json import dumps
+from tempfile import TemporaryFile
+from numpy import dot, array, around, asarray, argsort, bincount, cumsum,\
+  repeat, arange, flatnonzero, zeros, concatenate
 from biom.table import table_factory,SparseGeneTable
+from biom.util import get_biom_format_version_string,\
+  get_biom_format_url_string
 from biom.parse import parse_biom_table, get_axis_indices, direct_slice_data, direct_parse_key
+from picrust.util import get_biom_table_nonzero, get_biom_table_type
 
 def get_overlapping_ids(otu_table,genome_table):
     """Get the ids that overlap between the OTU and genome tables"""
@@ -127,6 +134,278 @@ def predict_metagenomes(otu_table,genome_table,verbose=False):
     return result_table
 
 
+def predict_metagenomes_sparse(otu_table,genome_table,verbose=False):
+    """ predict metagenomes from otu table and genome table using sparse arrays
+
+    Gives the same result as predict_metagenomes, but the OTU and genome
+    tables are converted to compressed sparse arrays (see
+    get_sparse_table_arrays) rather than dense lists, and the product is
+    calculated one sample at a time, keeping only non-zero results.  So
+    neither the dense OTU x function nor the dense sample x function matrix
+    is ever built.
+    """
+    get_overlapping_ids(otu_table,genome_table)
+
+    triples = []
+    for start,end,gene_indices,sample_indices,counts in\
+      yield_predicted_metagenome_chunks(otu_table,genome_table):
+        triples.extend(map(list,zip(gene_indices.tolist(),\
+          sample_indices.tolist(),counts.tolist())))
+
+    if not triples:
+        #biom can't build a table from no data, and a dense array of zeros
+        #is converted cell by cell, so give it a single zero instead
+        triples = [[0,0,0.0]]
+
+    result_table = table_factory(triples,otu_table.SampleIds,\
+      genome_table.ObservationIds,constructor=SparseGeneTable,\
+      shape=(len(genome_table.ObservationIds),len(otu_table.SampleIds)))
+
+    #Transfer metadata as for predict_metagenomes
+    result_table = transfer_metadata(otu_table,result_table,\
+      donor_metadata_type='SampleMetadata',\
+      recipient_metadata_type='SampleMetadata',verbose=verbose)
+    result_table = transfer_metadata(genome_table,result_table,\
+      donor_metadata_type='ObservationMetadata',\
+      recipient_metadata_type='ObservationMetadata',verbose=verbose)
+    return result_table
+
+def make_empty_metagenome_table(otu_table,genome_table,verbose=False):
+    """Return an all-zero predicted metagenome table, with metadata
+
+    The table has the shape, ids and metadata of the predict_metagenomes
+    result for these tables, but no data, so it is cheap to build
+    however many samples there are.  Raises a ValueError if the tables
+    have no OTUs in common.
+    """
+    get_overlapping_ids(otu_table,genome_table)
+
+    n_genes = len(genome_table.ObservationIds)
+    n_samples = len(otu_table.SampleIds)
+    #A single zero rather than a dense array of zeros (see
+    #predict_metagenomes_sparse), so no cells are visited
+    result_table = table_factory([[0,0,0.0]],otu_table.SampleIds,\
+      genome_table.ObservationIds,constructor=SparseGeneTable,\
+      shape=(n_genes,n_samples))
+
+    result_table = transfer_metadata(otu_table,result_table,\
+      donor_metadata_type='SampleMetadata',\
+      recipient_metadata_type='SampleMetadata',verbose=verbose)
+    result_table = transfer_metadata(genome_table,result_table,\
+      donor_metadata_type='ObservationMetadata',\
+      recipient_metadata_type='ObservationMetadata',verbose=verbose)
+    return result_table
+
+def yield_predicted_metagenome_chunks(otu_table,genome_table,chunk_size=None):
+    """Yield the predicted metagenome in blocks of samples, as sparse triples
+
+    otu_table -- a biom OTU table
+    genome_table -- a biom table with genomes as samples and genes as
+    observations
+    chunk_size -- the number of samples in each block (None for all
+    samples in a single block)
+
+    Yields (start,end,gene_indices,sample_indices,counts) tuples for
+    the samples with indices start to end-1 in the OTU table.  The three
+    arrays hold the non-zero (rounded) predicted counts of each gene in
+    each sample, ordered by sample.  The genome table is converted to
+    compressed arrays once, so only one block of results is ever held
+    in memory.
+    """
+    n_samples = len(otu_table.SampleIds)
+    if chunk_size is None:
+        chunk_size = max(n_samples,1)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1, not %s" % chunk_size)
+
+    #OTU counts, compressed by sample (i.e. by column)
+    otu_indptr,otu_rows,otu_counts =\
+      get_sparse_table_arrays(otu_table,by_sample=True)
+    #Genome contents, compressed by genome (i.e. by column)
+    genome_indptr,gene_indices,gene_counts =\
+      get_sparse_table_arrays(genome_table,by_sample=True)
+
+    #Map each OTU table observation to its genome table column (-1 if absent)
+    genome_index = dict([(str(genome_id),i) for i,genome_id in\
+      enumerate(genome_table.SampleIds)])
+    otu_to_genome = array([genome_index.get(str(otu_id),-1) for otu_id in\
+      otu_table.ObservationIds],dtype=int)
+
+    n_genes = len(genome_table.ObservationIds)
+    for chunk_start in xrange(0,n_samples,chunk_size):
+        chunk_end = min(chunk_start+chunk_size,n_samples)
+        chunk_genes = []
+        chunk_samples = []
+        chunk_counts = []
+        for sample_index in xrange(chunk_start,chunk_end):
+            start,end = otu_indptr[sample_index],otu_indptr[sample_index+1]
+            genomes = otu_to_genome[otu_rows[start:end]]
+            counts = otu_counts[start:end]
+            in_genome_table = genomes != -1
+            genomes = genomes[in_genome_table]
+            counts = counts[in_genome_table]
+
+            sample_counts = sum_sparse_rows(genome_indptr,gene_indices,\
+              gene_counts,genomes,counts,n_genes)
+            #Round counts to nearest whole numbers
+            sample_counts = around(sample_counts)
+            nonzero = flatnonzero(sample_counts)
+            chunk_genes.append(nonzero)
+            chunk_samples.append(repeat(sample_index,len(nonzero)))
+            chunk_counts.append(sample_counts[nonzero])
+        yield chunk_start,chunk_end,concatenate(chunk_genes),\
+          concatenate(chunk_samples),concatenate(chunk_counts)
+
+def write_metagenome_chunks_as_biom(out_f,result_table,chunks,\
+  generated_by="PI-CRUST " + __version__):
+    """Write sparse biom JSON for a predicted metagenome, one chunk at a time
+
+    out_f -- an open file object for the output
+    result_table -- the (empty) result table providing ids and metadata
+    (see make_empty_metagenome_table)
+    chunks -- an iterable of chunks as from yield_predicted_metagenome_chunks
+
+    The header, rows and columns are written from result_table, and the
+    data of each chunk is written as soon as it is produced, so the whole
+    result matrix is never held in memory.  The output is the same table
+    that format_biom_table gives for the predict_metagenomes result.
+    """
+    n_genes = len(result_table.ObservationIds)
+    n_samples = len(result_table.SampleIds)
+    out_f.write('{"id": "%s",' % str(result_table.TableId))
+    out_f.write('"format": "%s",' % get_biom_format_version_string())
+    out_f.write('"format_url": "%s",' % get_biom_format_url_string())
+    out_f.write('"type": "%s",' % get_biom_table_type(result_table))
+    out_f.write('"generated_by": "%s",' % generated_by)
+    out_f.write('"date": "%s",' % datetime.now().isoformat())
+    out_f.write('"matrix_type": "sparse",')
+    out_f.write('"matrix_element_type": "float",')
+    out_f.write('"shape": [%d, %d],' % (n_genes,n_samples))
+
+    out_f.write('"data": [')
+    have_written = False
+    for start,end,gene_indices,sample_indices,counts in chunks:
+        if not len(counts):
+            continue
+        if have_written:
+            out_f.write(',')
+        out_f.write(','.join(["[%d,%d,%r]" % triple for triple in\
+          zip(gene_indices.tolist(),sample_indices.tolist(),counts.tolist())]))
+        have_written = True
+    out_f.write('],')
+
+    out_f.write('"rows": [')
+    for i,(values,obs_id,metadata) in\
+      enumerate(result_table.iterObservations(conv_to_np=False)):
+        if i:
+            out_f.write(',')
+        out_f.write('{"id": "%s", "metadata": %s}' % (obs_id,dumps(metadata)))
+    out_f.write('],')
+
+    out_f.write('"columns": [')
+    for i,(values,sample_id,metadata) in\
+      enumerate(result_table.iterSamples(conv_to_np=False)):
+        if i:
+            out_f.write(',')
+        out_f.write('{"id": "%s", "metadata": %s}' % (sample_id,dumps(metadata)))
+    out_f.write(']}')
+
+def write_metagenome_chunks_as_tab_delimited(out_f,result_table,chunks,\
+  header_key=None,header_value=None,metadata_formatter=str):
+    """Write a tab-delimited predicted metagenome, one chunk at a time
+
+    out_f -- an open file object for the output
+    result_table -- the (empty) result table providing ids and metadata
+    (see make_empty_metagenome_table)
+    chunks -- an iterable of chunks as from yield_predicted_metagenome_chunks
+    header_key,header_value,metadata_formatter -- as for
+    biom's Table.delimitedSelf
+
+    Genes are rows and samples are columns, so the columns of each chunk
+    are written to a temporary file, and the temporary files are pasted
+    together line by line at the end.  The output is the same as
+    delimitedSelf gives for the predict_metagenomes result.
+    """
+    if (header_key is None) != (header_value is None):
+        raise ValueError("header_key and header_value must be passed together")
+
+    n_genes = len(result_table.ObservationIds)
+    chunk_files = []
+    for start,end,gene_indices,sample_indices,counts in chunks:
+        block = zeros((n_genes,end-start))
+        block[gene_indices,sample_indices-start] = counts
+        chunk_file = TemporaryFile()
+        for row in block:
+            chunk_file.write('\t'.join(map(str,row)) + '\n')
+        chunk_file.seek(0)
+        chunk_files.append(chunk_file)
+
+    header = '#OTU ID\t' + '\t'.join(map(str,result_table.SampleIds))
+    if header_value:
+        header += '\t%s' % header_value
+    out_f.write('# Constructed from biom file\n' + header)
+
+    observation_metadata = result_table.ObservationMetadata
+    for i,obs_id in enumerate(result_table.ObservationIds):
+        fields = [str(obs_id)]
+        fields.extend([chunk_file.readline().rstrip('\n') for\
+          chunk_file in chunk_files])
+        if header_key and observation_metadata is not None:
+            fields.append(metadata_formatter(\
+              observation_metadata[i].get(header_key,None)))
+        out_f.write('\n' + '\t'.join(fields))
+
+    for chunk_file in chunk_files:
+        chunk_file.close()
+
+def get_sparse_table_arrays(table,by_sample=True):
+    """Return compressed sparse (indptr,indices,values) arrays for a biom table
+
+    table -- a sparse or dense biom Table object
+    by_sample -- if True, compress by sample (i.e. the CSC form of the
+    observation x sample matrix), so that the non-zero observations of
+    sample i are indices[indptr[i]:indptr[i+1]].  If False, compress by
+    observation.
+
+    Only non-zero values are visited, so sparse tables are never
+    expanded to dense form (see get_biom_table_nonzero).
+    """
+    obs_indices,sample_indices,values = get_biom_table_nonzero(table)
+
+    if by_sample:
+        major,minor = sample_indices,obs_indices
+        n_major = len(table.SampleIds)
+    else:
+        major,minor = obs_indices,sample_indices
+        n_major = len(table.ObservationIds)
+
+    order = argsort(major,kind='mergesort')
+    indptr = zeros(n_major+1,dtype=int)
+    indptr[1:] = cumsum(bincount(major,minlength=n_major))
+    return indptr,minor[order],values[order]
+
+def sum_sparse_rows(indptr,indices,values,rows,weights,n_cols):
+    """Return the weighted sum of some rows of a compressed sparse matrix, as a dense vector
+
+    indptr,indices,values -- compressed sparse row arrays
+    rows -- the indices of the rows to sum
+    weights -- a weight for each row in rows
+    n_cols -- the number of columns (i.e. the length of the result)
+    """
+    rows = asarray(rows,dtype=int)
+    starts = indptr[rows]
+    lengths = indptr[rows+1] - starts
+    n_values = lengths.sum()
+    if n_values == 0:
+        return zeros(n_cols)
+    #Positions of every value in the selected rows, without a Python loop
+    row_offsets = cumsum(lengths) - lengths
+    positions = arange(n_values) - repeat(row_offsets,lengths) +\
+      repeat(starts,lengths)
+    return bincount(indices[positions],\
+      weights=values[positions]*repeat(asarray(weights,dtype=float),lengths),\
+      minlength=n_cols)
+
 def transfer_metadata(donor_table,recipient_table,\
         donor_metadata_type="ObservationMetadata",recipient_metadata_type="ObservationMetadata",\
         verbose = False):
@@ -11,21 +11,30 @@ __maintainer__ = "Jesse RR Zaneveld"
 __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
 
+import os
 from collections import defaultdict
-from math import e
+from math import e, ceil
+from multiprocessing import Pool
 from copy import copy
 from random import choice
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from numpy.ma import masked_object
 from numpy.ma import array as masked_array
 from numpy import apply_along_axis,array,around,mean,maximum as numpy_max, minimum as numpy_min,\
-  sqrt,sum,amax,amin,where, logical_not, argmin, histogram, add
+  sqrt,sum,amax,amin,where, logical_not, argmin, histogram, add, asarray,\
+  zeros, ones, newaxis, unique, searchsorted, isin, flatnonzero, arange, argsort,\
+  float64, broadcast_arrays, concatenate, errstate, logical_and, exp
 from numpy.random import normal
 from cogent.maths.stats.distribution import z_high
-from cogent.maths.stats.special import ndtri
+from cogent.maths.stats.special import ndtri, polevl, ZT, ZU, ZP, ZQ, ZR, ZS,\
+  MAXLOG, SQRTH
 from cogent import LoadTable
 from warnings import warn
 from biom.table import table_factory,DenseOTUTable,SparseOTUTable
+from picrust.compact_tree import flatten_tree, get_root_distances,\
+  get_nearest_marked_ancestors, get_nearest_marked_nodes,\
+  CompactTree, as_compact_tree
+from picrust.matrix_cache import is_matrix_cache_file, load_matrix_cache
 
 def biom_table_from_predictions(predictions,trait_ids,observation_metadata={},sample_metadata={},convert_to_int=True):
     
@@ -65,11 +74,15 @@ def assign_traits_to_tree(traits, tree,fix_bad_labels=True, trait_label="Reconst
     """Assign a dict of traits to a PyCogent tree
     
     traits -- a dict of traits, keyed by node names
-    tree -- a PyCogent phylonode object
+    tree -- a PyCogent phylonode object, or a CompactTree (see
+    CompactTree.assign_traits)
     trait_label -- a string defining the attribute in which
     traits will be recorded.  For example, if this is set to 'Reconstruction',
     the trait will be attached to node.Reconstruction
     """
+    if isinstance(tree,CompactTree):
+        tree.assign_traits(traits,trait_label,fix_bad_labels=fix_bad_labels)
+        return tree
 
     if fix_bad_labels:
          fixed_traits = {}
@@ -120,6 +133,14 @@ def inverse_variance_weight(d,variance,min_variance=1e-10):
 
     
 
+_confidence_z_scores = {}
+
+def get_confidence_z(confidence):
+    """Return ndtri(confidence), calculating it only once per confidence"""
+    if confidence not in _confidence_z_scores:
+        _confidence_z_scores[confidence] = ndtri(confidence)
+    return _confidence_z_scores[confidence]
+
 def fit_normal_to_confidence_interval(upper,lower,mean=None, confidence = 0.95):
     """Return the mean and variance for  a normal distribution given confidence intervals
     upper -- upper bound
@@ -131,11 +152,15 @@ def fit_normal_to_confidence_interval(upper,lower,mean=None, confidence = 0.95):
 
     confidence -- the confidence for this interval, e.g.
     0.95 for the 95% confidence intervals
+
+    upper, lower and mean may also be numpy arrays (e.g. of all traits of a
+    node, or of many nodes), in which case the variances are calculated
+    elementwise with a single z-score.
     """
 
     #Start by calculating Z-scores using the inverse normal distribution,
     #starting with the given confidence value
-    z = ndtri(confidence)
+    z = get_confidence_z(confidence)
     #print "Z:",z
     #Now we need to fit a normal distribution given the confidence
     #limits
@@ -344,6 +369,136 @@ def get_interval_z_prob(low_z,high_z):
     interval_z_prob = high_prob - low_prob
     return interval_z_prob
 
+def normal_upper_tail(z):
+    """Return the right-hand tail of the standard normal for an array of z >= 0
+
+    Evaluates the same Cephes approximations as z_high (which takes a single
+    z) for a whole array at once, each only on the z values in its range.
+    """
+    y = asarray(z,dtype=float)*SQRTH
+    result = zeros(y.shape)
+    #erf near the mean
+    near = y < 1
+    y_near = y[near]
+    erf = y_near*polevl(y_near*y_near,ZT)/polevl(y_near*y_near,ZU)
+    result[near] = where(y_near < SQRTH,0.5 - 0.5*erf,0.5*(1 - erf))
+    #erfc in the tail, switching approximations at 8 (beyond MAXLOG
+    #the tail underflows to 0)
+    for in_range,P,Q in [((y >= 1) & (y < 8),ZP,ZQ),\
+      ((y >= 8) & (y*y <= MAXLOG),ZR,ZS)]:
+        y_tail = y[in_range]
+        result[in_range] = 0.5*(exp(-y_tail*y_tail)*polevl(y_tail,P)/\
+          polevl(y_tail,Q))
+    return result
+
+def get_brownian_interval_probs(trait_variances,increment=1.0,\
+    trait_prob_cutoff=0.01):
+    """Return the probability of each change in copy number for many variances
+
+    trait_variances -- array of Brownian motion variances along a branch
+      (var*d, as in thresholded_brownian_probability)
+    increment, trait_prob_cutoff -- as for thresholded_brownian_probability
+
+    Returns a 2D array with a row for each variance.  Column 0 is the
+    probability of staying at the start state, and column k the probability
+    of changing by k increments in one direction, calculated on the same
+    intervals as thresholded_brownian_probability.  Changes that it would
+    leave out (from the first one with probability below trait_prob_cutoff)
+    have probability 0, and there are only as many columns as the largest
+    change kept for any variance needs.
+    """
+    if trait_prob_cutoff <= 0:
+        raise ValueError("trait_prob_cutoff must be positive, or the possible changes in copy number are unbounded")
+    std_devs = sqrt(asarray(trait_variances,dtype=float))
+    #No change of k increments is more likely than z_high(k*increment/std_dev),
+    #so changes beyond this are always below the cutoff
+    cutoff_z = max(0.0,-ndtri(min(trait_prob_cutoff,0.5)))
+    max_offset = 1
+    if len(std_devs):
+        max_offset += int(ceil(std_devs.max()*cutoff_z/increment))
+    edges = concatenate([[0.0,increment/2.0],\
+      arange(1,max_offset+2)*increment])
+    with errstate(divide='ignore',invalid='ignore'):
+        z = edges[newaxis,:]/std_devs[:,newaxis]
+    #with no variance, the start state is certain
+    z[:,0] = 0.0
+    tails = normal_upper_tail(z)
+    probs = zeros((len(std_devs),max_offset+1))
+    probs[:,0] = (tails[:,0] - tails[:,1])*2
+    probs[:,1:] = tails[:,2:-1] - tails[:,3:]
+
+    #keep changes while the previous one was above the cutoff, as the
+    #iterative version does
+    kept = ones(probs.shape,dtype=bool)
+    kept[:,1:] = logical_and.accumulate(probs[:,:-1] > trait_prob_cutoff,\
+      axis=1) & (probs[:,1:] >= trait_prob_cutoff)
+    probs[~kept] = 0.0
+    num_kept = kept.sum(1).max() if len(probs) else 1
+    return probs[:,:num_kept]
+
+def thresholded_brownian_probabilities(start_states,variances,distances,\
+    min_val=0.0,increment=1.0,trait_prob_cutoff=0.01,cache=None,\
+    cache_decimals=6):
+    """Calculate thresholded_brownian_probability for many start states at once
+
+    start_states -- array of starting, quantitative trait values (e.g. the
+      predictions for tips x traits)
+    variances -- array of Brownian motion parameters (e.g. one per trait)
+    distances -- array of branch lengths (e.g. one per tip, as a column)
+    start_states, variances and distances are broadcast against each other.
+    min_val, increment, trait_prob_cutoff -- as for
+      thresholded_brownian_probability
+    cache -- an optional dict of change probabilities (as from
+      get_brownian_interval_probs) keyed by the variance along the branch
+      (var*d) rounded to cache_decimals, increment and trait_prob_cutoff.
+      It is filled in as needed, and can be shared between calls.  When it
+      is given, variances along branches are always rounded to
+      cache_decimals, so results don't depend on what was already cached.
+
+    Returns two arrays, values and probs, with the broadcast shape plus a
+    last axis for the possible changes in copy number, from K increments
+    below the start state to K above, where K is the largest change kept for
+    any start state.  values holds the resulting trait values (those below
+    min_val are raised to min_val, so it may appear more than once) and
+    probs their probabilities, with 0 for changes that
+    thresholded_brownian_probability leaves out.  Summing the probs of each
+    distinct value gives the dict thresholded_brownian_probability returns.
+
+    The probabilities only depend on var*d, so they are calculated once per
+    distinct value, for all changes at once.
+    """
+    start_states,variances,distances = broadcast_arrays(\
+      asarray(start_states,dtype=float),asarray(variances,dtype=float),\
+      asarray(distances,dtype=float))
+    trait_variances = (variances*distances).ravel()
+    if cache is not None:
+        trait_variances = around(trait_variances,cache_decimals)
+    unique_variances,positions = unique(trait_variances,return_inverse=True)
+
+    if cache is None:
+        offset_probs = get_brownian_interval_probs(unique_variances,\
+          increment,trait_prob_cutoff)
+    else:
+        keys = [(v,increment,trait_prob_cutoff) for v in unique_variances.tolist()]
+        missing = [i for i,key in enumerate(keys) if key not in cache]
+        if missing:
+            new_probs = get_brownian_interval_probs(unique_variances[missing],\
+              increment,trait_prob_cutoff)
+            for i,row in zip(missing,new_probs):
+                cache[keys[i]] = row[:max(1,(row > 0).sum())]
+        offset_probs = zeros((len(keys),max([len(cache[key]) for key in keys] + [1])))
+        for i,key in enumerate(keys):
+            offset_probs[i,:len(cache[key])] = cache[key]
+
+    max_offset = offset_probs.shape[1] - 1
+    offset_probs = offset_probs[positions]
+    probs = concatenate([offset_probs[:,:0:-1],offset_probs],axis=1)
+    values = start_states.ravel()[:,newaxis] +\
+      arange(-max_offset,max_offset+1)*increment
+    values[:,:max_offset] = numpy_max(min_val,values[:,:max_offset])
+    shape = start_states.shape + (2*max_offset+1,)
+    return values.reshape(shape),probs.reshape(shape)
+
 def brownian_motion_var(d,brownian_motion_parameter):
     """Return the increase in variance due to brownian motion between two nodes
     d -- the distance between the two nodes on the tree
@@ -361,7 +516,7 @@ def weighted_average_variance_prediction(tree, node,\
   most_recent_reconstructed_ancestor=None, ancestral_variance=None,\
   brownian_motion_parameter=None,\
   trait_label="Reconstruction",\
-  weight_fn=linear_weight, verbose=True):
+  weight_fn=linear_weight, verbose=True, ancestor_index=None):
     """Predict the variance of the estimate of node traits
     
     tree -- a PyCogent PhyloNode tree object.   In this case,
@@ -385,6 +540,10 @@ def weighted_average_variance_prediction(tree, node,\
     from the ancestral state reconstruction.  This is distinct from the
     variance in ancestral state estimates due to error in reconstruction,
     and is instead more analagous to a rate of evolution.
+
+    ancestor_index -- optional dict from build_ancestor_index.  If provided,
+    the distance to the reconstructed ancestor is looked up rather than
+    recalculated by walking the tree.
     """
     parent_node =  node.Parent
     most_rec_recon_anc = most_recent_reconstructed_ancestor
@@ -395,7 +554,8 @@ def weighted_average_variance_prediction(tree, node,\
     
     #STEP 1:  Infer traits, weight for most recently 
     #reconstructed ancestral node
-    ancestor_distance =  parent_node.distance(most_rec_recon_anc)
+    ancestor_distance = get_ancestor_distance(parent_node,\
+      most_rec_recon_anc,ancestor_index)
     ancestor_weight = weight_fn(ancestor_distance)
 
     #STEP 2:  Infer Parent node traits
@@ -435,7 +595,7 @@ def weighted_average_variance_prediction(tree, node,\
         
         if len(child_traits) != n_traits:
             raise ValueError("length of ancestral traits [%i] is not equal to the length of traits [%] in node %s" %(n_traits,len(child_traits),child.Name))
-        distance_to_parent = parent_node.distance(child)
+        distance_to_parent = get_branch_length(child)
         
         organism_weight = weight_fn(distance_to_parent)
         #We've calculated a weight for the *organism*
@@ -469,7 +629,7 @@ def weighted_average_variance_prediction(tree, node,\
     
     #This is the variance added due to evolution between the parent and the 
     #predicted node
-    d_node_to_parent = node.distance(parent_node)
+    d_node_to_parent = get_branch_length(node)
     
     parent_to_node_variance = brownian_motion_var(d_node_to_parent,brownian_motion_parameter)
     #We assume variance from the parent to the node is independent of
@@ -480,7 +640,7 @@ def weighted_average_variance_prediction(tree, node,\
 
 def weighted_average_tip_prediction(tree, node,\
   most_recent_reconstructed_ancestor=None, trait_label="Reconstruction",\
-  weight_fn=linear_weight, verbose=False):
+  weight_fn=linear_weight, verbose=False, ancestor_index=None):
     """Predict node traits, combining reconstructions with tip nodes
     
     tree -- a PyCogent PhyloNode tree object.   In this case,
@@ -499,6 +659,10 @@ def weighted_average_tip_prediction(tree, node,\
     linear_weight (equals distance), equal_weight (a fixed value that 
     disregards distance), or neg_exponential_weight (neg. exponential
     weighting by branch length)
+
+    ancestor_index -- optional dict from build_ancestor_index.  If provided,
+    the distance to the reconstructed ancestor is looked up rather than
+    recalculated by walking the tree.
     """
     parent_node =  node.Parent
     
@@ -513,7 +677,8 @@ def weighted_average_tip_prediction(tree, node,\
     
     if most_rec_recon_anc is not None: 
         anc_traits = getattr(most_rec_recon_anc,trait_label,None)
-        ancestor_distance =  parent_node.distance(most_rec_recon_anc)
+        ancestor_distance = get_ancestor_distance(parent_node,\
+          most_rec_recon_anc,ancestor_index)
         ancestor_weight = weight_fn(ancestor_distance)
     else:
         anc_traits = ancestor_distance = ancestor_weight = None
@@ -538,7 +703,7 @@ def weighted_average_tip_prediction(tree, node,\
         if child_traits is None:
             continue
         
-        distance_to_parent = parent_node.distance(child)
+        distance_to_parent = get_branch_length(child)
         weight = weight_fn(distance_to_parent)
         
         if prediction is None and total_weights is None:
@@ -632,14 +797,27 @@ def predict_nearest_neighbor(tree,nodes_to_predict,\
 
     verbose -- output verbose debugging info 
 
+    Nearest neighbors for all nodes are found up front with
+    get_nearest_annotated_neighbors, rather than by searching the
+    tree separately for each node.
     """
     closest_annotated_node = None
     results = {}
     n_traits = None    
+    nearest_neighbors = get_nearest_annotated_neighbors(tree,\
+      trait_label=trait_label, tips_only = tips_only,\
+      include_self = use_self_in_prediction)
+    node_lookup = {}
+    for node in tree.preorder():
+        if node.Name not in node_lookup:
+            node_lookup[node.Name] = node
+
     for node_label in nodes_to_predict:
         if verbose:
             print "Predicting traits for node:",node_label
-        node_to_predict = tree.getNodeMatchingName(node_label)
+        node_to_predict = node_lookup.get(node_label,None)
+        if node_to_predict is None:
+            raise ValueError("Couldn't find node %s on tree" % node_label)
         
         traits = getattr(node_to_predict,trait_label)
         
@@ -655,7 +833,7 @@ def predict_nearest_neighbor(tree,nodes_to_predict,\
                 except TypeError:
                     raise TypeError("Node trait values must be arrays!  Couldn't call len() on %s" % traits)
 
-            if traits and len(traits) != n_traits:
+            if len(traits) and len(traits) != n_traits:
                 raise ValueError(\
                   "The number of traits in the array for node %s (%i) does not match other nodes (%i)" %(\
                    node_to_predict,len(traits),n_traits))
@@ -665,10 +843,7 @@ def predict_nearest_neighbor(tree,nodes_to_predict,\
             # ignore knowledge about self without modifying tree
             traits = None 
        
-        nearest_annotated_neighbor =\
-          get_nearest_annotated_neighbor(tree,node_label,\
-          trait_label=trait_label, tips_only = tips_only,\
-          include_self = use_self_in_prediction)
+        nearest_annotated_neighbor,distance = nearest_neighbors[node_label]
         #print "NAN:", nearest_annotated_neighbor 
         if nearest_annotated_neighbor is None:
             raise ValueError("Couldn't find an annotated nearest neighbor for node %s on tree" % node_label)
@@ -700,7 +875,7 @@ def get_nearest_annotated_neighbor(tree,node_name,\
     for n2 in neighbors:
         traits = getattr(n2,trait_label,None)
         #print n2.Name, traits
-        if not traits:
+        if traits is None or not len(traits):
             continue
         if not include_self and n1.Name == n2.Name:
             continue
@@ -711,10 +886,69 @@ def get_nearest_annotated_neighbor(tree,node_name,\
     return curr_best_match
 
 
+def get_nearest_annotated_neighbors(tree,trait_label="Reconstruction",\
+    tips_only=True, include_self=True):
+    """Return a dict of (nearest annotated node, distance) keyed by node name
+
+    tree -- PhyloNode object, decorated with traits in the
+    attribute specified in trait_label
+    trait_label -- attribute where traits are stored where
+    available
+    tips_only -- if True, consider only extant, tip nodes
+    as neighbors.  if False, allow the nearest neighbor to be
+    ancestral.
+    include_self -- if True, an annotated node is its own nearest
+    neighbor
+
+    Gives the same distances (up to rounding) as calling
+    get_nearest_annotated_neighbor for every node, but uses two linear
+    passes over the tree (see picrust.compact_tree.get_nearest_marked_nodes)
+    rather than a distance calculation for every pair of nodes.  The
+    neighbors match up to ties in floating point distance: branch lengths
+    are summed in a different order than by PhyloNode.distance, so when
+    two neighbors are (nearly) equally close, rounding can make either one
+    the nearest.  Nodes with no annotated neighbor map to (None,None).  If
+    several nodes share a name, the first in preorder is used, as with
+    getNodeMatchingName.
+    """
+    nodes,parents,lengths = flatten_tree(tree)
+    is_candidate = []
+    for n in nodes:
+        traits = getattr(n,trait_label,None)
+        has_traits = traits is not None and len(traits) > 0
+        is_candidate.append(has_traits and (not tips_only or not n.Children))
+
+    nearest,distances = get_nearest_marked_nodes(parents,lengths,\
+      array(is_candidate,dtype=bool),include_self=include_self)
+
+    nearest_neighbors = {}
+    for i,node in enumerate(nodes):
+        if node.Name in nearest_neighbors:
+            continue
+        if nearest[i] == -1:
+            nearest_neighbors[node.Name] = (None,None)
+        else:
+            nearest_neighbors[node.Name] = (nodes[nearest[i]],distances[i])
+    return nearest_neighbors
+
 def calc_nearest_sequenced_taxon_index(tree,limit_to_tips = [],\
-        trait_label="Reconstruction",include_self=True, verbose = True):
-    """Calculate an index of the average distance to the nearest sequenced taxon on the tree"""
-    
+        trait_label="Reconstruction",include_self=True, verbose = True,\
+        method="tree_dp"):
+    """Calculate an index of the average distance to the nearest sequenced taxon on the tree
+
+    method -- "tree_dp" (default) finds each tip's nearest annotated tip
+    with two linear passes over the tree (see
+    picrust.compact_tree.get_nearest_marked_nodes).  "dense" builds the full
+    tip-to-tip distance matrix, which needs O(N^2) memory and is only
+    practical for small trees, but is useful for validation.
+    """
+    if method == "tree_dp":
+        return calc_nearest_sequenced_taxon_index_by_dp(tree,\
+          limit_to_tips=limit_to_tips,trait_label=trait_label,\
+          include_self=include_self,verbose=verbose)
+    elif method != "dense":
+        raise ValueError("Unknown NSTI method '%s'.  Valid methods are 'tree_dp' and 'dense'" % method)
+
     distances = []
     if verbose:
         print "Finding all tree tips (may take a moment for large trees)"
@@ -813,6 +1047,50 @@ def calc_nearest_sequenced_taxon_index(tree,limit_to_tips = [],\
         print "NSTI:",nsti
     return nsti,min_distances
 
+def calc_nearest_sequenced_taxon_index_by_dp(tree,limit_to_tips=[],\
+        trait_label="Reconstruction",include_self=True,verbose=True):
+    """Calculate NSTI in linear time using an up/down pass over the tree
+
+    Arguments and return values are as for
+    calc_nearest_sequenced_taxon_index.  Missing branch lengths are
+    treated as 1.0, matching tipToTipDistances in the dense method.
+    """
+    if verbose:
+        print "Calculating Nearest Sequenced Taxon Index (NTSI) by tree dynamic programming"
+
+    tree = as_compact_tree(tree,[trait_label])
+    names = tree.get_node_names()
+    parents,lengths = tree.parents,tree.get_lengths(default_length=1.0)
+    is_tip = tree.get_tip_mask()
+    is_annotated = tree.get_trait_matrix(trait_label)[0] >= 0
+    nearest,nearest_distances =\
+      get_nearest_marked_nodes(parents,lengths,is_tip & is_annotated,\
+      include_self=include_self)
+
+    if limit_to_tips:
+        limit_to_tips = set(limit_to_tips)
+
+    # Tips without any annotated tip to compare to get the same
+    # non-minimal value used by the dense method
+    big_number = 1e250
+    min_distances = {}
+    for i in flatnonzero(is_tip):
+        name = names[i]
+        if limit_to_tips and name not in limit_to_tips:
+            continue
+        if nearest[i] == -1:
+            min_dist = big_number
+        else:
+            min_dist = nearest_distances[i]
+        if verbose:
+            print name," d(NN):",min_dist
+        min_distances[name] = min_dist
+
+    nsti =  sum(min_distances.values())/float(len(min_distances))
+    if verbose:
+        print "NSTI:",nsti
+    return nsti,min_distances
+
 def get_nn_by_tree_descent(tree,node_of_interest,filter_by_property = "Reconstruction",verbose=False):
     """An alternative method for getting the NN of a node using tree descent
     
@@ -856,9 +1134,9 @@ def get_nn_by_tree_descent(tree,node_of_interest,filter_by_property = "Reconstru
 def get_brownian_motion_param_from_confidence_intervals(tree,\
   upper_bound_trait_label,lower_bound_trait_label,trait_label="Reconstruction",confidence=0.95):
     """Extract a Brownian motion parameter for a trait from confidence interval output
-    tree -- PhyloNode tree object, decorated with confidence interval data
+    tree -- PhyloNode tree object or CompactTree, decorated with confidence interval data
     upper_bound_trait_label -- the PhyloNode Property in which the upper bound for 95% CIs are stored
-    upper_bound_trait_label -- the PhyloNode Property in which the upper lower bound for 95% CIs are stored
+    lower_bound_trait_label -- the PhyloNode Property in which the lower bound for 95% CIs are stored
     
     The function infers a brownian motion parameter (sigma) for pic ASR data where only
     95% CIs are available using an approximate, quick and dirty method applicable to large trees with
@@ -868,75 +1146,53 @@ def get_brownian_motion_param_from_confidence_intervals(tree,\
     to its parent is used to calibrate the decrease in confidence over branch length.
     
     Procedure:
-    - Iterate over all the tips in the tree
-    - If it has a trait value, it must be a sequenced genome/characterized organism
-        - Get its parent
-        - If the parent has multiple sequenced children, ignore it
-        - If the parent has only one sequenced child, calculate the brownian motion parameter
+    - Find the tips with trait values (sequenced genomes/characterized organisms)
+    - Ignore those whose parent has multiple annotated children, or no
+      reconstruction and confidence intervals
+    - Calculate the brownian motion parameter for all traits at once from
+      the first remaining tip (in preorder).  Empirically these are
+      invariant by tip, so just one example is used.
 
     """
-    #variances = []  # holds arrays of variances across traits for each sequenced tip
-    #distances = []  # holds a single distnace for each sequenced tip to its parent
-    tips_with_traits = 0
-    for tip in tree.iterTips():
-        if getattr(tip,trait_label,None) is not None:
-            tips_with_traits += 1
-            # In a characterized tip
-            tip_parent = tip.Parent
-            more_than_one_annotated_child = False
-            for c in tip_parent.Children:
-                #TODO: Should this just be the weighted average variance of 
-                #children?
-                if c.Name == tip.Name:
-                    continue
-                else:
-                   if getattr(c,trait_label,None):
-                       more_than_one_annotated_child = True
-                       break
-            if more_than_one_annotated_child:
-                #print "Skipping node...multiple annotated children"
-                continue
-
-            dist = tip.distance(tip_parent)
-            #parent_variance = tip_parent.distance(tip)
-            upper_bounds = getattr(tip_parent,upper_bound_trait_label)
-            lower_bounds = getattr(tip_parent,lower_bound_trait_label)
-            traits = getattr(tip_parent,trait_label)
-            if traits is None:
-                #print "Skipping node...no ASR value for parent"
-                continue
-                #raise ValueError("No reconstructed trait values available for internal node.  Cannot infer brownian motion parameter from confidence intervals")
-            per_trait_variances = []
-            #print "LEN TRAITS:",len(traits)
-            #print "upper_bounds:",upper_bounds
-            #print "lower_bounds:",lower_bounds
-            for i in range(len(traits)):
-                #print "Finding variance for trait %i of tip %s" %(i,tip.Name)
-                means, var = fit_normal_to_confidence_interval(upper_bounds[i],lower_bounds[i],\
-                    mean=traits[i], confidence = 0.95)
-                per_trait_variances.append(var)
-            #print tip.Name,"\tPER TRAIT VARIANCES:\t",per_trait_variances
-            #Empirically these are invariant by tip, so just take one example 
-            variances=array(per_trait_variances)
-            distances=dist
-            break
-    if tips_with_traits == 0:
+    tree = as_compact_tree(tree,\
+      [trait_label,upper_bound_trait_label,lower_bound_trait_label])
+    parents,lengths = tree.parents,tree.get_lengths()
+    is_tip = tree.get_tip_mask()
+    trait_rows,trait_matrix = tree.get_trait_matrix(trait_label)
+    upper_rows,upper_matrix = tree.get_trait_matrix(upper_bound_trait_label)
+    lower_rows,lower_matrix = tree.get_trait_matrix(lower_bound_trait_label)
+    has_traits = trait_rows >= 0
+    has_bounds = (upper_rows >= 0) & (lower_rows >= 0)
+
+    tips_with_traits = flatnonzero(is_tip & has_traits)
+    if len(tips_with_traits) == 0:
         raise ValueError("No tips have trait values annotated under label:"+trait_label)
-    #now just average variances/d for all examples to get the brownian motion param
-    #print "variances:", variances
-    #print "distances:", distances
-    #Length should be # of traits
-    #brownian_motion_params = array([v/(distances[i]+eps) for i,v in enumerate(variances)])
+
+    #Count the annotated children of every node
+    annotated_children = zeros(len(parents),dtype=int)
+    annotated = flatnonzero(has_traits)
+    annotated = annotated[parents[annotated] >= 0]
+    add.at(annotated_children,parents[annotated],1)
+
+    tip_parents = parents[tips_with_traits]
+    usable = (tip_parents >= 0)
+    usable[usable] = (annotated_children[tip_parents[usable]] == 1) &\
+      has_traits[tip_parents[usable]] & has_bounds[tip_parents[usable]]
+    if not usable.any():
+        raise ValueError("No tip with trait values has a reconstructed parent (with confidence intervals) and no other annotated children, so a Brownian motion parameter can't be inferred from confidence intervals")
+    tip = tips_with_traits[flatnonzero(usable)[0]]
+    tip_parent = parents[tip]
+
+    means, variances = fit_normal_to_confidence_interval(\
+      upper_matrix[upper_rows[tip_parent]],\
+      lower_matrix[lower_rows[tip_parent]],\
+      mean=trait_matrix[trait_rows[tip_parent]],confidence=confidence)
+
+    #now just divide the variances by the distance to get the brownian motion param
     eps = 1e-10 # to avoid divide by zero errors
+    dist = lengths[tip]
     brownian_motion_params = array(variances/(dist+eps))
-    #print "brownian motion parameters:",brownian_motion_params
-    #Length of each per tip brownian_motion_params entry should equal # of traits
-    # Now average the per-tip arrays to get the array for the traits overall
-    
-    #average_brownian_motion_params = mean(brownian_motion_params,axis=1,keepdims=True) 
-    #print "average axis0:",average_brownian_motion_params
-    #print "average axis1:",mean(brownian_motion_params,axis=1) 
-    #return average_brownian_motion_params
+    #Length should be # of traits
     return brownian_motion_params
 
 
@@ -945,7 +1201,8 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
     trait_label="Reconstruction",\
     weight_fn=linear_weight, verbose = False,\
     calc_confidence_intervals=False,brownian_motion_parameter=None,\
-    upper_bound_trait_label=None,lower_bound_trait_label=None):
+    upper_bound_trait_label=None,lower_bound_trait_label=None,\
+    ancestor_index=None):
     """Predict node traits given labeled ancestral states
     
     tree -- a PyCogent phylonode object, with each node decorated with the 
@@ -977,6 +1234,9 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
 
     lower_bound_trait_label -- as upper_bound_trait_label, but for the lower 
     confidence limit
+
+    ancestor_index -- optional precomputed result of build_ancestor_index
+    for this tree and trait_label (built here if not provided)
     
     Output depends on whether calculate_confidence_intervals is True.
     If False:
@@ -1014,6 +1274,11 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
     node_lookup = dict([(n.Name,n) for n in tree.tips() \
                          if n.Name in nodes_to_predict])
 
+    # index reconstructed ancestors and root distances in one pass,
+    # rather than walking the ancestors of every tip
+    if ancestor_index is None:
+        ancestor_index = build_ancestor_index(tree,trait_label)
+
     print_this_node = False
     for i,node_label in enumerate(nodes_to_predict):
         if verbose:
@@ -1041,7 +1306,7 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
                 except TypeError:
                     raise TypeError("Node trait values must be arrays!  Couldn't call len() on %s" % traits)
 
-            if traits and len(traits) != n_traits:
+            if len(traits) and len(traits) != n_traits:
                 raise ValueError(\
                   "The number of traits in the array for node %s (%i) does not match other nodes (%i)" %(\
                    node_to_predict,len(traits),n_traits))
@@ -1061,11 +1326,13 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
             ancestral_states,ancestral_variance =\
               get_most_recent_ancestral_states(node_to_predict,trait_label,\
               upper_bound_trait_label=upper_bound_trait_label,\
-              lower_bound_trait_label=lower_bound_trait_label)
+              lower_bound_trait_label=lower_bound_trait_label,\
+              ancestor_index=ancestor_index)
         
         #Find most recent ancestral node with ASR values      
         most_recent_reconstructed_ancestor =\
-            get_most_recent_reconstructed_ancestor(node_to_predict,trait_label)  
+            get_most_recent_reconstructed_ancestor(node_to_predict,trait_label,\
+            ancestor_index=ancestor_index)
         #print "Calc_confidence_intervals:",calc_confidence_intervals
         #print "most_recent_reconstructed_ancestor",most_recent_reconstructed_ancestor
         #Perform point estimate of trait values using weighted-average
@@ -1074,7 +1341,7 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
               weighted_average_tip_prediction(tree,node_to_predict,\
               most_recent_reconstructed_ancestor =\
               most_recent_reconstructed_ancestor,\
-              weight_fn = weight_fn)
+              weight_fn = weight_fn, ancestor_index=ancestor_index)
         #round all predictions to whole numbers
         prediction=around(prediction)
         results[node_label] = prediction
@@ -1087,7 +1354,8 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
               most_recent_reconstructed_ancestor =\
               most_recent_reconstructed_ancestor,\
               ancestral_variance=ancestral_variance,\
-              brownian_motion_parameter=brownian_motion_parameter)
+              brownian_motion_parameter=brownian_motion_parameter,\
+              ancestor_index=ancestor_index)
             
             #lower_95_CI,upper_95_CI =\
             #      calc_confidence_interval_95(prediction,variances)     
@@ -1118,13 +1386,395 @@ def predict_traits_from_ancestors(tree,nodes_to_predict,\
     else:
         return results
 
+def partition_nodes_to_predict(nodes_to_predict,n_partitions):
+    """Split nodes_to_predict into n_partitions lists of nearly equal size
+
+    Nodes are dealt out in turn (node i goes to partition i % n_partitions),
+    so that runs of neighbouring tips, which may be costly to predict
+    together, are spread over all partitions.  Empty partitions are dropped.
+    """
+    if n_partitions < 1:
+        raise ValueError("n_partitions must be at least 1, not %s" % n_partitions)
+    nodes_to_predict = list(nodes_to_predict)
+    partitions = [nodes_to_predict[i::n_partitions] for i in range(n_partitions)]
+    return [p for p in partitions if p]
+
+#Arguments for predict_traits_from_ancestors_in_parallel workers.  These are
+#set before the worker pool is created, so forked workers share the tree and
+#its trait arrays with the parent (copy-on-write) rather than unpickling them
+_PARALLEL_PREDICTION_ARGS = None
+
+def _predict_traits_for_partition(partition_index):
+    """Predict traits for one partition of tips (worker process function)"""
+    tree,partitions,kwargs = _PARALLEL_PREDICTION_ARGS
+    return predict_traits_from_ancestors(tree,partitions[partition_index],\
+      **kwargs)
+
+def predict_traits_from_ancestors_in_parallel(tree,nodes_to_predict,\
+    num_processes=2,trait_label="Reconstruction",verbose=False,**kwargs):
+    """Predict node traits as for predict_traits_from_ancestors, using several processes
+
+    tree,nodes_to_predict,trait_label -- as for predict_traits_from_ancestors
+    num_processes -- the number of worker processes to use
+    kwargs -- other arguments for predict_traits_from_ancestors
+    (weight_fn, calc_confidence_intervals, etc.)
+
+    nodes_to_predict is split into balanced partitions (see
+    partition_nodes_to_predict), one per process, and each partition is
+    predicted in a multiprocessing pool.  Workers are forked after the tree
+    is set up, so they share the decorated tree and trait arrays read-only
+    instead of each receiving a copy.  Results (and variances and
+    confidence intervals, if calculated) are merged in partition order, so
+    the output is the same as predict_traits_from_ancestors gives.
+
+    Falls back to a single process where fork is not available.
+    """
+    global _PARALLEL_PREDICTION_ARGS
+
+    partitions = partition_nodes_to_predict(nodes_to_predict,num_processes)
+    #Built once here, rather than once per worker
+    kwargs['ancestor_index'] = build_ancestor_index(tree,trait_label)
+    kwargs['trait_label'] = trait_label
+    if len(partitions) < 2 or not hasattr(os,'fork'):
+        return predict_traits_from_ancestors(tree,nodes_to_predict,\
+          verbose=verbose,**kwargs)
+
+    if verbose:
+        print "Predicting traits for %i nodes in %i processes..." %\
+          (len(nodes_to_predict),len(partitions))
+
+    _PARALLEL_PREDICTION_ARGS = (tree,partitions,kwargs)
+    pool = Pool(len(partitions))
+    try:
+        partition_results = pool.map(_predict_traits_for_partition,\
+          range(len(partitions)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _PARALLEL_PREDICTION_ARGS = None
+
+    if verbose:
+        print "Merging predictions from %i processes..." % len(partitions)
+
+    #Insert nodes in the order predict_traits_from_ancestors visits them,
+    #so that the merged dicts iterate (and are written out) in that order
+    if not kwargs.get('calc_confidence_intervals'):
+        partition_results = [(p,{},{}) for p in partition_results]
+    results = {}
+    variance_result = {}
+    confidence_interval_results = defaultdict(dict)
+    partition_lookup = dict([(node_label,i) for i,partition in\
+      enumerate(partitions) for node_label in partition])
+    for node_label in set(nodes_to_predict):
+        predictions,variances,confidence_intervals =\
+          partition_results[partition_lookup[node_label]]
+        results[node_label] = predictions[node_label]
+        if node_label in variances:
+            variance_result[node_label] = variances[node_label]
+        if node_label in confidence_intervals:
+            confidence_interval_results[node_label] =\
+              confidence_intervals[node_label]
+
+    if kwargs.get('calc_confidence_intervals'):
+        return results,variance_result,confidence_interval_results
+    return results
+
+def get_weights_for_distances(weight_fn,distances):
+    """Return an array of weights for an array of distances
+
+    weight_fn -- a weight function, as for predict_traits_from_ancestors
+    distances -- a numpy array of distances on the tree
+
+    The weight functions in this module take a single distance, but most
+    also work elementwise on numpy arrays.  Constant results (e.g. from
+    equal_weight) are broadcast to the shape of distances, and functions
+    that can't handle arrays are applied one distance at a time.
+    """
+    distances = asarray(distances,dtype=float)
+    try:
+        weights = asarray(weight_fn(distances),dtype=float)
+    except (TypeError,ValueError):
+        weights = array([weight_fn(d) for d in distances],dtype=float)
+
+    if weights.shape != distances.shape:
+        weights = weights*ones(distances.shape)
+    return weights
+
+def predict_traits_from_arrays(parents,lengths,trait_rows,trait_matrix,\
+    node_indices,weight_fn=linear_weight,verbose=False,overwrite_known=True):
+    """Predict traits for many nodes at once from flattened tree arrays
+
+    parents -- preorder parent indices for every node in the tree
+      (see picrust.compact_tree.flatten_tree)
+    lengths -- preorder branch lengths for every node in the tree
+    trait_rows -- for each node, the row of trait_matrix holding its
+      traits, or -1 if the node has no traits
+    trait_matrix -- a 2D float array with one row per annotated node
+    node_indices -- preorder indices of the nodes to predict
+    weight_fn -- a weight function, as for predict_traits_from_ancestors
+    overwrite_known -- if False, return the weighted average for nodes with
+      known traits too (e.g. to calculate confidence intervals around it)
+
+    Returns a 2D array with one row of predicted traits for each entry
+    in node_indices.
+
+    The method is the same as predict_traits_from_ancestors:  each prediction
+    is the rounded, weighted average of the most recent reconstructed ancestor
+    and the annotated children of the node's parent, and nodes with known
+    traits are returned unchanged.  Children are added in the same order as
+    in weighted_average_tip_prediction so the floating point sums match.
+    """
+    node_indices = asarray(node_indices,dtype=int)
+    if trait_matrix.size == 0:
+        raise ValueError("No nodes in the tree have trait values, so no predictions can be made")
+    n_traits = trait_matrix.shape[1]
+    has_traits = trait_rows >= 0
+
+    if verbose:
+        print "Indexing root distances and reconstructed ancestors..."
+    root_distances = get_root_distances(parents,lengths)
+    ancestors = get_nearest_marked_ancestors(parents,has_traits)
+
+    node_parents = parents[node_indices]
+    if (node_parents < 0).any():
+        raise ValueError("Can't predict traits for the root of the tree")
+
+    #STEP 1: weighted traits of the most recent reconstructed ancestors
+    node_ancestors = ancestors[node_indices]
+    has_ancestor = node_ancestors >= 0
+    ancestor_distances = where(has_ancestor,\
+      root_distances[node_parents] - root_distances[node_ancestors],0.0)
+    ancestor_weights = where(has_ancestor,\
+      get_weights_for_distances(weight_fn,ancestor_distances),0.0)
+
+    predictions = zeros((len(node_indices),n_traits))
+    predictions[has_ancestor] =\
+      trait_matrix[trait_rows[node_ancestors[has_ancestor]]]*\
+      ancestor_weights[has_ancestor,newaxis]
+    total_weights = ancestor_weights.copy()
+    has_information = has_ancestor.copy()
+
+    #STEP 2: add the annotated children of each parent
+    if verbose:
+        print "Summing weighted traits of annotated children..."
+    for valid,children in iter_annotated_children_by_rank(parents,\
+      has_traits,node_parents):
+        child_weights = get_weights_for_distances(weight_fn,lengths[children])
+        predictions[valid] += trait_matrix[trait_rows[children]]*child_weights[:,newaxis]
+        total_weights[valid] += child_weights
+        has_information[valid] = True
+
+    if not has_information.all():
+        raise ValueError("No reconstructed ancestors or annotated relatives were found for node index %i" % node_indices[flatnonzero(logical_not(has_information))[0]])
+
+    #STEP 3: weighted average, rounded to whole numbers
+    predictions = around(predictions/total_weights[:,newaxis])
+
+    #Known traits (e.g. sequenced genomes) overwrite predictions
+    if overwrite_known:
+        known = trait_rows[node_indices] >= 0
+        predictions[known] = trait_matrix[trait_rows[node_indices[known]]]
+    return predictions
+
+def iter_annotated_children_by_rank(parents,has_traits,node_parents):
+    """Yield the annotated children of each node's parent, one sibling at a time
+
+    parents -- preorder parent indices for every node in the tree
+    has_traits -- a boolean array flagging the nodes with traits
+    node_parents -- the parent index of each node of interest
+
+    Yields (valid,children) pairs, for the first annotated child of every
+    parent, then the second, and so on:  valid is a boolean mask over
+    node_parents of the nodes whose parent has a child of this rank, and
+    children holds that child's index for each of them.  Children are ranked
+    in preorder (i.e. parent.Children order), so sums accumulated over the
+    ranks add terms in the same order as a loop over parent.Children.
+    """
+    unique_parents = unique(node_parents)
+    parent_positions = searchsorted(unique_parents,node_parents)
+    children = flatnonzero(has_traits & isin(parents,unique_parents))
+    child_positions = searchsorted(unique_parents,parents[children])
+
+    order = argsort(child_positions,kind='mergesort')
+    sorted_positions = child_positions[order]
+    child_ranks = arange(len(order)) -\
+      searchsorted(sorted_positions,sorted_positions)
+
+    max_rank = child_ranks.max()+1 if len(child_ranks) else 0
+    for rank in range(max_rank):
+        in_rank = order[child_ranks == rank]
+        rank_children = -ones(len(unique_parents),dtype=int)
+        rank_children[child_positions[in_rank]] = children[in_rank]
+        node_children = rank_children[parent_positions]
+        valid = node_children >= 0
+        yield valid,node_children[valid]
+
+def predict_variances_from_arrays(parents,lengths,trait_rows,trait_matrix,\
+    upper_bound_rows,upper_bound_matrix,lower_bound_rows,lower_bound_matrix,\
+    node_indices,brownian_motion_parameter,weight_fn=linear_weight,\
+    verbose=False):
+    """Predict the variance of trait predictions for many nodes at once
+
+    parents, lengths, trait_rows, trait_matrix, node_indices and weight_fn
+    are as for predict_traits_from_arrays.
+    upper_bound_rows,upper_bound_matrix -- per-node rows of, and the
+      matrix of, the upper 95% confidence limits of the reconstruction
+    lower_bound_rows,lower_bound_matrix -- as above, for the lower limits
+    brownian_motion_parameter -- a float, or an array with one value per trait
+
+    Returns a 2D array with one row of variances for each entry in
+    node_indices, calculated as weighted_average_variance_prediction does
+    for a single node, but for all nodes and traits with whole-array
+    operations.
+    """
+    node_indices = asarray(node_indices,dtype=int)
+    brownian_motion_parameter = asarray(brownian_motion_parameter,dtype=float)
+    has_traits = trait_rows >= 0
+    root_distances = get_root_distances(parents,lengths)
+    ancestors = get_nearest_marked_ancestors(parents,has_traits)
+
+    node_parents = parents[node_indices]
+    if (node_parents < 0).any():
+        raise ValueError("Can't predict traits for the root of the tree")
+    node_ancestors = ancestors[node_indices]
+    if (node_ancestors < 0).any():
+        raise ValueError("No reconstructed ancestor was found for node index %i, so the variance of its prediction can't be estimated" % node_indices[flatnonzero(node_ancestors < 0)[0]])
+
+    #STEP 1: the variance of each reconstructed ancestor, from its confidence
+    #interval (once per ancestor), plus evolution down to the node's parent
+    if verbose:
+        print "Estimating variances of reconstructed ancestors..."
+    unique_ancestors,ancestor_positions = unique(node_ancestors,return_inverse=True)
+    ancestor_upper_rows = upper_bound_rows[unique_ancestors]
+    ancestor_lower_rows = lower_bound_rows[unique_ancestors]
+    missing = (ancestor_upper_rows < 0) | (ancestor_lower_rows < 0)
+    if missing.any():
+        raise ValueError("Reconstructed ancestor (node index %i) has no confidence interval" % unique_ancestors[flatnonzero(missing)[0]])
+    means,ancestral_variances = fit_normal_to_confidence_interval(\
+      upper_bound_matrix[ancestor_upper_rows],\
+      lower_bound_matrix[ancestor_lower_rows],\
+      mean=trait_matrix[trait_rows[unique_ancestors]],confidence=0.95)
+
+    ancestor_distances = root_distances[node_parents] -\
+      root_distances[node_ancestors]
+    ancestor_weights = get_weights_for_distances(weight_fn,ancestor_distances)
+    ancestor_variances = ancestral_variances[ancestor_positions] +\
+      ancestor_distances[:,newaxis]*brownian_motion_parameter
+
+    #STEP 2: the variance of the weighted mean at the parent, adding the
+    #annotated children of the parent in order
+    if verbose:
+        print "Summing variances of annotated children..."
+    weighted_variances = (ancestor_weights**2)[:,newaxis]*ancestor_variances
+    for valid,children in iter_annotated_children_by_rank(parents,\
+      has_traits,node_parents):
+        child_weights = get_weights_for_distances(weight_fn,lengths[children])
+        weighted_variances[valid] += (child_weights**2)[:,newaxis]*\
+          (lengths[children][:,newaxis]*brownian_motion_parameter)
+
+    #STEP 3: add evolution between the parent and the node
+    return sqrt(weighted_variances) +\
+      lengths[node_indices][:,newaxis]*brownian_motion_parameter
+
+def predict_traits_from_ancestors_vectorized(tree,nodes_to_predict,\
+    trait_label="Reconstruction",weight_fn=linear_weight,verbose=False,\
+    calc_confidence_intervals=False,brownian_motion_parameter=None,\
+    upper_bound_trait_label=None,lower_bound_trait_label=None):
+    """Predict node traits given labeled ancestral states, for all nodes at once
+
+    tree -- a PyCogent phylonode object, with each node decorated with the
+    attribute defined in trait label (e.g. node.Reconstruction = [0,1,1,0]),
+    or a CompactTree with traits assigned under trait_label
+
+    nodes_to_predict -- a list of tip names for which a trait
+    prediction should be generated
+
+    trait_label -- a string defining the attribute in which the
+    trait to be reconstructed is stored.
+
+    weight_fn -- a weight function, as for predict_traits_from_ancestors
+
+    verbose -- output verbose debugging info
+
+    calc_confidence_intervals, brownian_motion_parameter,
+    upper_bound_trait_label, lower_bound_trait_label -- as for
+    predict_traits_from_ancestors
+
+    Produces the same predictions (and variances and confidence intervals)
+    as predict_traits_from_ancestors, but flattens the tree and traits into
+    arrays once and predicts every tip with a few numpy operations (see
+    predict_traits_from_arrays and predict_variances_from_arrays) rather
+    than walking the tree for each tip.  Returns a dict of trait arrays keyed
+    by node name, or with calc_confidence_intervals, that plus the dicts of
+    variances and confidence intervals that predict_traits_from_ancestors
+    returns.
+    """
+    if calc_confidence_intervals:
+        if upper_bound_trait_label is None or lower_bound_trait_label is None \
+          or brownian_motion_parameter is None:
+            raise ValueError("predict_traits_from_ancestors_vectorized: you must specify upper_bound_trait_label, lower_bound_trait_label, and brownian_motion_parameter in order to calculate confidence intervals for the prediction")
+        bound_labels = [upper_bound_trait_label,lower_bound_trait_label]
+    else:
+        bound_labels = []
+
+    if verbose and not isinstance(tree,CompactTree):
+        print "Flattening tree and traits into arrays..."
+    tree = as_compact_tree(tree,[trait_label] + bound_labels)
+    names = tree.get_node_names()
+    parents,lengths = tree.parents,tree.get_lengths()
+    is_tip = tree.get_tip_mask().tolist()
+    trait_rows,trait_matrix = tree.get_trait_matrix(trait_label)
+    bounds = [tree.get_trait_matrix(label) for label in bound_labels]
+
+    nodes_to_predict = set(nodes_to_predict)
+    tip_lookup = dict([(name,i) for i,name in enumerate(names) \
+      if is_tip[i] and name in nodes_to_predict])
+    node_labels = list(nodes_to_predict)
+    node_indices = array([tip_lookup[node_label] for node_label in node_labels],\
+      dtype=int)
+
+    if verbose:
+        print "Predicting traits for %i nodes..." % len(node_labels)
+    predictions = predict_traits_from_arrays(parents,lengths,trait_rows,\
+      trait_matrix,node_indices,weight_fn=weight_fn,verbose=verbose,\
+      overwrite_known=not calc_confidence_intervals)
+
+    if not calc_confidence_intervals:
+        return dict(zip(node_labels,predictions))
+
+    (upper_rows,upper_matrix),(lower_rows,lower_matrix) = bounds
+    variances = predict_variances_from_arrays(parents,lengths,trait_rows,\
+      trait_matrix,upper_rows,upper_matrix,lower_rows,lower_matrix,\
+      node_indices,brownian_motion_parameter,weight_fn=weight_fn,\
+      verbose=verbose)
+    #Intervals are around the weighted average, even for known nodes
+    lower_95_CI,upper_95_CI = calc_confidence_interval_95(predictions,variances)
+    known = trait_rows[node_indices] >= 0
+    predictions[known] = trait_matrix[trait_rows[node_indices[known]]]
+
+    variance_result = {}
+    confidence_interval_results = defaultdict(dict)
+    for i,node_label in enumerate(node_labels):
+        variance_result[node_label] = {"variance":variances[i].tolist()}
+        confidence_interval_results[node_label]['lower_CI'] = lower_95_CI[i]
+        confidence_interval_results[node_label]['upper_CI'] = upper_95_CI[i]
+    return dict(zip(node_labels,predictions)),variance_result,\
+      confidence_interval_results
+
 def calc_confidence_interval_95(predictions,variances,round_CI=True,\
         min_val=None,max_val=None):
-    """Calc the 95% confidence interval given predictions and variances"""
+    """Calc the 95% confidence interval given predictions and variances
+
+    predictions and variances may be 1D (traits of one node) or 2D (nodes x
+    traits) arrays.
+    """
     stdev = sqrt(variances)
     pred = predictions
     CI_95 =  1.96*stdev
-    lower_95_CI = numpy_max([0.0]*len(pred),pred - CI_95)
+    lower_95_CI = numpy_max(0.0,pred - CI_95)
     upper_95_CI = around(pred + CI_95)
     if round_CI:
         lower_95_CI = around(lower_95_CI)
@@ -1169,29 +1819,37 @@ def fill_unknown_traits(traits_to_update, new_traits):
     return array(result)
 
 def get_most_recent_ancestral_states(node,trait_label,\
-    upper_bound_trait_label=None, lower_bound_trait_label=None):
+    upper_bound_trait_label=None, lower_bound_trait_label=None,\
+    ancestor_index=None):
     """Traverse ancestors of node until a reconstructed value is found
     
     node -- a PhyloNode object
     trait_label -- the trait attribute corresponding to 
-    
+    ancestor_index -- optional dict from build_ancestor_index.  If
+    provided, the most recent reconstructed ancestor is looked up
+    rather than found by traversing the ancestors of node.
     
     """
-    for ancestor in node.ancestors():
+    if ancestor_index is not None:
+        ancestors = [ancestor_index[node][0]]
+    else:
+        ancestors = node.ancestors()
+
+    for ancestor in ancestors:
+        if ancestor is None:
+            break
         trait = getattr(ancestor,trait_label)
         if trait is not None:
             if not upper_bound_trait_label and not lower_bound_trait_label:
                 return trait
             else:
-                upper_bound = list(getattr(ancestor,upper_bound_trait_label,None))
-                lower_bound = list(getattr(ancestor,lower_bound_trait_label,None))
-                ancestral_variances = []
-                for i in range(len(upper_bound)):
-                    mu, var = \
-                      fit_normal_to_confidence_interval(upper_bound[i],\
-                      lower_bound[i],mean=trait[i], confidence = 0.95)
-                    ancestral_variances.append(var)
-                return trait, array(ancestral_variances)
+                upper_bound = asarray(getattr(ancestor,upper_bound_trait_label,None),dtype=float)
+                lower_bound = asarray(getattr(ancestor,lower_bound_trait_label,None),dtype=float)
+                #All traits at once
+                mu, ancestral_variances = \
+                  fit_normal_to_confidence_interval(upper_bound,\
+                  lower_bound,mean=asarray(trait,dtype=float), confidence = 0.95)
+                return trait, ancestral_variances
                 
                 
     # If we get through all ancestors, and no traits are found,
@@ -1199,14 +1857,19 @@ def get_most_recent_ancestral_states(node,trait_label,\
     return None
     
     
-def get_most_recent_reconstructed_ancestor(node,trait_label="Reconstruction"):
+def get_most_recent_reconstructed_ancestor(node,trait_label="Reconstruction",\
+    ancestor_index=None):
     """Traverse ancestors of node until a reconstructed value is found
     
     node -- a PhyloNode object
     trait_label -- the trait attribute corresponding to 
-    
+    ancestor_index -- optional dict from build_ancestor_index.  If
+    provided, the ancestor is looked up in constant time.
     
     """
+    if ancestor_index is not None:
+        return ancestor_index[node][0]
+
     for ancestor in node.ancestors():
         trait = getattr(ancestor,trait_label)
         if trait is not None:
@@ -1215,6 +1878,56 @@ def get_most_recent_reconstructed_ancestor(node,trait_label="Reconstruction"):
     # then there are no most recent reconstructed ancestors
     return None 
 
+def build_ancestor_index(tree,trait_label="Reconstruction"):
+    """Return a dict of (most recent reconstructed ancestor, root distance) for each node
+
+    tree -- a PhyloNode tree, decorated with traits in trait_label
+    trait_label -- the trait attribute that marks reconstructed nodes
+
+    The index is built in a single preorder pass:  each node inherits
+    its parent as the most recent reconstructed ancestor if the parent
+    has traits, and otherwise inherits its parent's entry.  Distances from
+    the root are accumulated the same way, so the distance between a node
+    and any of its ancestors is just a subtraction (see
+    get_ancestor_distance).  Nodes without a reconstructed ancestor are
+    assigned None.
+    """
+    ancestor_index = {}
+    for node in tree.preorder():
+        if node is tree:
+            ancestor_index[node] = (None,0.0)
+            continue
+        parent = node.Parent
+        parent_ancestor,parent_distance = ancestor_index[parent]
+        if getattr(parent,trait_label,None) is not None:
+            most_recent_ancestor = parent
+        else:
+            most_recent_ancestor = parent_ancestor
+        ancestor_index[node] = (most_recent_ancestor,\
+          parent_distance + get_branch_length(node))
+    return ancestor_index
+
+def get_ancestor_distance(node,ancestor,ancestor_index=None):
+    """Return the distance between a node and one of its ancestors
+
+    node -- a PhyloNode object
+    ancestor -- a PhyloNode that is an ancestor of (or the same as) node
+    ancestor_index -- optional dict from build_ancestor_index.  If not
+    provided, the distance is calculated with PhyloNode.distance
+    """
+    if ancestor_index is None:
+        return node.distance(ancestor)
+    return ancestor_index[node][1] - ancestor_index[ancestor][1]
+
+def get_branch_length(node):
+    """Return the length of the branch to node's parent (0.0 if unset)
+
+    Equivalent to node.distance(node.Parent), without walking the tree.
+    """
+    if not node.Length:
+        return 0.0
+    return node.Length
+
 def update_trait_dict_from_file(table_file, header = [],input_sep="\t"):
     """Update a trait dictionary from a table file
 
@@ -1232,13 +1945,7 @@ def update_trait_dict_from_file(table_file, header = [],input_sep="\t"):
 
     #do some extra stuff to match columns if a header is provided
     if header:
-        #error checking to make sure traits in ASR table are a subset of traits in genome table
-        if set(header) != set(table.Header[1:]):
-            if set(header).issubset(set(table.Header[1:])):
-                diff_traits = set(table.Header[1:]).difference(set(header))
-                warn("Missing traits in given ASR table with labels:{0}. Predictions will not be produced for these traits.".format(list(diff_traits))) 
-            else:
-                raise RuntimeError("Given ASR trait table contains one or more traits that do not exist in given genome trait table. Predictions can not be made.")
+        check_trait_table_header(table.Header[1:],header)
             
         #Note: keep the first column heading at the beginning not sorted (this is the name for the row ids
         sorted_header=[table.Header[0]]
@@ -1256,6 +1963,126 @@ def update_trait_dict_from_file(table_file, header = [],input_sep="\t"):
        
     return table.Header[1:],traits
 
+def check_trait_table_header(table_header,header):
+    """Check that the traits in header can be taken from a table's header
+
+    table_header -- the trait (column) names in a trait table
+    header -- the trait names required, e.g. from the ASR table
+
+    Warns if some traits in the table are not in header, and raises
+    a RuntimeError if header contains traits that are not in the table.
+    """
+    #error checking to make sure traits in ASR table are a subset of traits in genome table
+    if set(header) != set(table_header):
+        if set(header).issubset(set(table_header)):
+            diff_traits = set(table_header).difference(set(header))
+            warn("Missing traits in given ASR table with labels:{0}. Predictions will not be produced for these traits.".format(list(diff_traits))) 
+        else:
+            raise RuntimeError("Given ASR trait table contains one or more traits that do not exist in given genome trait table. Predictions can not be made.")
+
+def load_trait_matrix_from_file(table_file,header=[],input_sep="\t",\
+    dtype=float64,chunk_size=10000):
+    """Load a trait table into a numpy matrix, with an index of row ids
+
+    table_file -- File name of a trait table, laid out as for
+    update_trait_dict_from_file
+    header -- if provided, the trait columns to keep, in order (see
+    update_trait_dict_from_file)
+    dtype -- numpy dtype of the result (e.g. float32 to halve memory use)
+    chunk_size -- the number of rows to convert to numbers at a time
+
+    Returns the trait names, a dict mapping each row id to its row in
+    the matrix, and the (ids x traits) matrix.  The file is read once
+    to count rows, so that the matrix can be preallocated, and then
+    parsed in chunks of rows, so only chunk_size rows of strings are
+    held in memory at a time.  Unlike update_trait_dict_from_file, ids
+    are always kept as strings.
+
+    table_file may also be a matrix cache file (see
+    picrust.matrix_cache), in which case the matrix is memory-mapped
+    rather than parsed.
+    """
+    if is_matrix_cache_file(table_file):
+        return load_trait_matrix_from_matrix_cache(table_file,header,dtype)
+
+    table = open(table_file,"U")
+    table_header = [h.strip() for h in table.readline().rstrip("\n").split(input_sep)]
+    n_rows = 0
+    for line in table:
+        if line.strip():
+            n_rows += 1
+    table.close()
+
+    trait_ids = table_header[1:]
+    if header:
+        check_trait_table_header(trait_ids,header)
+        trait_ids = list(header)
+    column_lookup = dict([(t,i) for i,t in enumerate(table_header[1:])])
+    columns = array([column_lookup[t] for t in trait_ids],dtype=int)
+
+    trait_matrix = zeros((n_rows,len(trait_ids)),dtype=dtype)
+    row_index = {}
+    chunk = []
+    start = 0
+    table = open(table_file,"U")
+    table.readline()
+    for line in table:
+        if not line.strip():
+            continue
+        fields = line.rstrip("\n").split(input_sep)
+        row_index[fields[0].strip()] = start + len(chunk)
+        chunk.append(fields[1:])
+        if len(chunk) == chunk_size:
+            fill_trait_matrix_rows(trait_matrix,start,chunk,columns)
+            start += len(chunk)
+            chunk = []
+    table.close()
+    if chunk:
+        fill_trait_matrix_rows(trait_matrix,start,chunk,columns)
+
+    return trait_ids,row_index,trait_matrix
+
+def load_trait_matrix_from_matrix_cache(cache_file,header=[],dtype=float64):
+    """Load a trait matrix from a matrix cache file
+
+    Arguments and return values are as for load_trait_matrix_from_file.
+    When all columns are kept in their stored order and dtype, the
+    returned matrix is the memory-mapped array itself, so nothing is copied.
+    """
+    cache = load_matrix_cache(cache_file)
+    trait_ids = list(cache.column_ids)
+    trait_matrix = cache.to_dense()
+    if header:
+        check_trait_table_header(trait_ids,header)
+        column_lookup = dict([(t,i) for i,t in enumerate(trait_ids)])
+        columns = array([column_lookup[t] for t in header],dtype=int)
+        if len(columns) != len(trait_ids) or (columns != arange(len(columns))).any():
+            trait_matrix = trait_matrix[:,columns]
+        trait_ids = list(header)
+    if trait_matrix.dtype != dtype:
+        trait_matrix = trait_matrix.astype(dtype)
+    return trait_ids,cache.get_row_index(),trait_matrix
+
+def fill_trait_matrix_rows(trait_matrix,start,rows,columns):
+    """Convert rows of string fields into trait_matrix, starting at row start
+
+    trait_matrix -- the preallocated matrix to fill
+    start -- the index of the first matrix row to fill
+    rows -- a list of lists of string trait values
+    columns -- the index of each matrix column in the rows
+    """
+    try:
+        values = array(rows,dtype=str)[:,columns]
+        trait_matrix[start:start+len(rows)] = values.astype(trait_matrix.dtype)
+    except (ValueError,IndexError):
+        #Ragged or unparseable rows: fall back to one row at a time
+        #to find (and report) the bad row
+        for i,fields in enumerate(rows):
+            try:
+                trait_matrix[start+i] = [float(fields[j]) for j in columns]
+            except (ValueError,IndexError):
+                raise ValueError("Could not convert trait table fields:'%s' to float" %(fields))
+
 def normal_product_monte_carlo(mean1,variance1,mean2,variance2,confidence =0.95, n_trials = 5000):
     """Estimate the lower & upper confidence limits for the product of two normal distributions
     
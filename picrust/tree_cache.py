@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+"""A cache of trees decorated with traits, for repeated predict_traits.py runs"""
+
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from os import makedirs, rename, getpid
+from os.path import join, isdir, dirname
+from hashlib import md5
+from json import dumps
+from numpy import array, load, savez
+from picrust.asr_cache import get_file_md5
+from picrust.compact_tree import CompactTree
+
+TREE_CACHE_VERSION = 1
+
+def get_tree_cache_key(input_fps,params=None):
+    """Return a cache key for a decorated tree
+
+    input_fps -- the input filepaths (None for inputs that weren't given),
+    in a fixed order
+    params -- optional dict of options that affect the decorated tree
+    """
+    file_md5s = [get_file_md5(fp) if fp else None for fp in input_fps]
+    return md5(dumps([TREE_CACHE_VERSION,file_md5s,\
+      sorted((params or {}).items())])).hexdigest()
+
+def get_tree_cache_fp(cache_dir,key):
+    """Return the filepath of a cache entry"""
+    return join(cache_dir,key + '.npz')
+
+def save_decorated_tree(fp,tree,trait_ids,brownian_motion_parameter=None):
+    """Save a decorated CompactTree, its trait names and Brownian motion parameter
+
+    fp -- the cache entry filepath (see get_tree_cache_fp).  Its directory
+    is created if needed.
+    tree -- a CompactTree, with traits assigned
+    trait_ids -- the trait names, in the order of the trait arrays
+    brownian_motion_parameter -- a float or array, or None
+    """
+    cache_dir = dirname(fp) or '.'
+    if not isdir(cache_dir):
+        try:
+            makedirs(cache_dir)
+        except OSError:
+            #created by another process in the meantime
+            if not isdir(cache_dir):
+                raise
+    arrays = tree.to_arrays()
+    arrays['trait_ids'] = array(trait_ids,dtype=str)
+    if brownian_motion_parameter is not None:
+        arrays['brownian_motion_parameter'] =\
+          array(brownian_motion_parameter,dtype=float)
+    tmp_fp = '%s.%i.tmp' % (fp,getpid())
+    f = open(tmp_fp,'wb')
+    savez(f,**arrays)
+    f.close()
+    rename(tmp_fp,fp)
+
+def load_decorated_tree(fp):
+    """Load a decorated tree saved by save_decorated_tree
+
+    Returns the CompactTree, the list of trait names, and the Brownian motion
+    parameter (a float or array, as it was saved, or None).
+    """
+    npz = load(fp)
+    arrays = dict([(name,npz[name]) for name in npz.files])
+    npz.close()
+    tree = CompactTree.from_arrays(arrays)
+    trait_ids = arrays['trait_ids'].tolist()
+    brownian_motion_parameter = arrays.get('brownian_motion_parameter')
+    if brownian_motion_parameter is not None and\
+      brownian_motion_parameter.ndim == 0:
+        brownian_motion_parameter = float(brownian_motion_parameter)
+    return tree,trait_ids,brownian_motion_parameter
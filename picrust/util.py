@@ -14,12 +14,13 @@ __status__ = "Development"
 from os.path import abspath, dirname, isdir
 from os import mkdir,makedirs
 from cogent.core.tree import PhyloNode, TreeError
-from numpy import array
+from numpy import array, asarray, flatnonzero, concatenate, repeat
+from biom import __version__ as biom_version
 from biom.table import SparseOTUTable, DenseOTUTable, SparsePathwayTable, \
   DensePathwayTable, SparseFunctionTable, DenseFunctionTable, \
   SparseOrthologTable, DenseOrthologTable, SparseGeneTable, \
   DenseGeneTable, SparseMetaboliteTable, DenseMetaboliteTable,\
-  SparseTaxonTable, DenseTaxonTable, table_factory
+  SparseTaxonTable, DenseTaxonTable, SparseTable, table_factory
 from biom.parse import parse_biom_table, convert_biom_to_table, \
   convert_table_to_biom
 from subprocess import Popen, PIPE, STDOUT
@@ -183,6 +184,61 @@ def format_biom_table(biom_table):
     generated_by_str = "PI-CRUST " + __version__
     return biom_table.getBiomFormatJsonString(generated_by_str)
 
+BIOM_TABLE_TYPES = [('OTU table',(SparseOTUTable,DenseOTUTable)),
+  ('Pathway table',(SparsePathwayTable,DensePathwayTable)),
+  ('Function table',(SparseFunctionTable,DenseFunctionTable)),
+  ('Ortholog table',(SparseOrthologTable,DenseOrthologTable)),
+  ('Gene table',(SparseGeneTable,DenseGeneTable)),
+  ('Metabolite table',(SparseMetaboliteTable,DenseMetaboliteTable)),
+  ('Taxon table',(SparseTaxonTable,DenseTaxonTable))]
+
+def is_sparse_biom_table(biom_table):
+    """Return True if biom_table is a sparse biom Table object"""
+    return isinstance(biom_table,SparseTable)
+
+def get_biom_table_type(biom_table):
+    """Return the BIOM type of a biom Table object (e.g. 'Gene table'), or None"""
+    for table_type,constructors in BIOM_TABLE_TYPES:
+        if isinstance(biom_table,constructors):
+            return table_type
+    return None
+
+def get_biom_table_nonzero(biom_table):
+    """Return arrays of the observation indices, sample indices and values of a table's non-zero entries
+
+    Sparse tables from biom 1.x store their values in a dict-like object
+    keyed by (observation index, sample index), which is read directly so
+    that only the non-zero values are visited.  This is the only place that
+    relies on that; dense tables, and tables from other biom versions, are
+    read one observation at a time with iterObservationData.
+    """
+    data = getattr(biom_table,'_data',None)
+    if is_sparse_biom_table(biom_table) and biom_version.startswith('1.') and\
+      hasattr(data,'iteritems'):
+        obs_indices = []
+        sample_indices = []
+        values = []
+        for (obs_index,sample_index),value in data.iteritems():
+            if value == 0:
+                continue
+            obs_indices.append(obs_index)
+            sample_indices.append(sample_index)
+            values.append(value)
+        return asarray(obs_indices,dtype=int),\
+          asarray(sample_indices,dtype=int),asarray(values,dtype=float)
+
+    obs_indices = [asarray([],dtype=int)]
+    sample_indices = [asarray([],dtype=int)]
+    values = [asarray([],dtype=float)]
+    for obs_index,obs_values in enumerate(biom_table.iterObservationData()):
+        obs_values = asarray(obs_values,dtype=float).ravel()
+        nonzero = flatnonzero(obs_values)
+        obs_indices.append(repeat(obs_index,len(nonzero)))
+        sample_indices.append(nonzero)
+        values.append(obs_values[nonzero])
+    return concatenate(obs_indices),concatenate(sample_indices),\
+      concatenate(values)
+
 def make_output_dir(dirpath, strict=False):
     """Make an output directory if it doesn't exist
     
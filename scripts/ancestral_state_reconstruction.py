@@ -13,9 +13,10 @@ __status__ = "Development"
 
 
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
-from picrust.count import wagner_for_picrust
-from picrust.ace import ace_for_picrust
-from picrust.ancestral_state_reconstruction import run_asr_in_parallel
+from picrust.ancestral_state_reconstruction import run_asr_in_parallel,\
+  run_asr_for_picrust
+from picrust.incremental import update_pic_reconstruction_for_picrust,\
+  INCREMENTAL_ASR_METHODS
 from picrust.util import make_output_dir_for_file,make_output_dir
 
 script_info = {}
@@ -30,24 +31,36 @@ script_info['required_options'] = [\
 make_option('-t','--input_tree_fp',type="existing_filepath",help='the tree to use for ASR'),\
 make_option('-i','--input_trait_table_fp',type="existing_filepath",help='the trait table to use for ASR'),\
 ]
-asr_method_choices=['ace_ml','ace_reml','ace_pic','wagner']
-parallel_method_choices=['sge','torque','multithreaded']
+asr_method_choices=['ace_ml','ace_reml','ace_pic','wagner','wagner_native','pic_native','ml_native','reml_native']
+parallel_method_choices=['sge','torque','multithreaded','local_pool']
 
 script_info['optional_options'] = [\
 make_option('-m','--asr_method',type='choice',
                 help='Method for ancestral state reconstruction. Valid choices are: '+\
-                ', '.join(asr_method_choices) + ' [default: %default]',\
+                ', '.join(asr_method_choices) + '. wagner_native, pic_native, ml_native and reml_native are the same as wagner, ace_pic, ace_ml and ace_reml, but run in Python without Java or R [default: %default]',\
                 choices=asr_method_choices,default='ace_pic'),\
 make_option('-o','--output_fp',type="new_filepath",help='output trait table [default:%default]',default='asr_counts.tab'),\
 make_option('-c','--output_ci_fp',type="new_filepath",help='output table containing 95% confidence intervals, loglik, and brownian motion parameters for each asr prediction [default:%default]',default='asr_ci.tab'),\
 make_option('-p','--parallel',action="store_true",help='allow parallelization of asr',default=False),\
 make_option('-j','--parallel_method',type='choice',
                 help='Method for parallelizaation. Valid choices are: '+\
-                ', '.join(parallel_method_choices) + ' [default: %default]',\
+                ', '.join(parallel_method_choices) + '. local_pool runs the jobs in a pool of processes on this machine, without job or output files [default: %default]',\
                 choices=parallel_method_choices,default='sge'),\
 make_option('-n','--num_jobs',action='store',type='int',\
-                help='Number of jobs to be submitted (if --parallel). [default: %default]',\
+                help='Number of jobs to be submitted (if --parallel). For local_pool, the number of processes (at most the number of cpus). [default: %default]',\
                 default=100),\
+make_option('--traits_per_job',action='store',type='int',\
+                help='Number of traits reconstructed together by each job (if --parallel), so that each job loads the tree and starts the ASR application once for a block of traits. [default: enough traits for each of --num_jobs to get one block]',\
+                default=None),\
+make_option('--cache_dir',type="new_dirpath",\
+                help='Directory of cached reconstructions. Traits already reconstructed with the same tree, method and tip values are read from the cache rather than reconstructed again, and new reconstructions are added to it [default: no caching]',\
+                default=None),\
+make_option('--previous_trait_table_fp',type="existing_filepath",\
+                help='the trait table of a previous reconstruction with the same traits. If passed with --previous_asr_fp, the previous reconstruction is updated for tips that were added to the trait table (or whose values changed), and only the nodes on their paths to the root are reconstructed again. Only for ace_pic and pic_native; the result is as from pic_native [default: %default]',\
+                default=None),\
+make_option('--previous_asr_fp',type="existing_filepath",\
+                help='the output trait table of the previous reconstruction (see --previous_trait_table_fp) [default: %default]',\
+                default=None),\
 make_option('-d','--debug',action="store_true",help='To aid with debugging; get the command that the app controller is going to run',default=False),\
 ]
 
@@ -57,31 +70,32 @@ script_info['version'] = __version__
 def main():
     option_parser, opts, args =\
                    parse_command_line_parameters(**script_info)
-    
-    if(opts.parallel):
+
+    if (opts.previous_trait_table_fp is None) != (opts.previous_asr_fp is None):
+        option_parser.error("--previous_trait_table_fp and --previous_asr_fp must be passed together.")
+
+    if opts.previous_asr_fp:
+        if opts.asr_method not in INCREMENTAL_ASR_METHODS:
+            option_parser.error("Only %s reconstructions can be updated with --previous_asr_fp." %\
+              ', '.join(INCREMENTAL_ASR_METHODS))
+        asr_table,ci_table = update_pic_reconstruction_for_picrust(opts.input_tree_fp,\
+          opts.input_trait_table_fp,opts.previous_trait_table_fp,opts.previous_asr_fp,\
+          verbose=opts.verbose)
+    elif(opts.parallel):
         tmp_dir='jobs/'
         make_output_dir(tmp_dir)
-        asr_table, ci_table =run_asr_in_parallel(tree=opts.input_tree_fp,table=opts.input_trait_table_fp,asr_method=opts.asr_method,parallel_method=opts.parallel_method, num_jobs=opts.num_jobs,tmp_dir=tmp_dir,verbose=opts.verbose)
+        asr_table, ci_table =run_asr_in_parallel(tree=opts.input_tree_fp,table=opts.input_trait_table_fp,asr_method=opts.asr_method,parallel_method=opts.parallel_method, num_jobs=opts.num_jobs,traits_per_job=opts.traits_per_job,tmp_dir=tmp_dir,verbose=opts.verbose,cache_dir=opts.cache_dir)
     else:
         #call the apporpriate ASR app controller 
-        if(opts.asr_method == 'wagner'):
-            asr_table = wagner_for_picrust(opts.input_tree_fp,opts.input_trait_table_fp,HALT_EXEC=opts.debug)
-        elif(opts.asr_method == 'bayestraits'):
-            pass
-        elif(opts.asr_method == 'ace_ml'):
-            asr_table,ci_table = ace_for_picrust(opts.input_tree_fp,opts.input_trait_table_fp,'ML',HALT_EXEC=opts.debug)
-        elif(opts.asr_method == 'ace_pic'):
-            asr_table,ci_table = ace_for_picrust(opts.input_tree_fp,opts.input_trait_table_fp,'pic',HALT_EXEC=opts.debug)
-        elif(opts.asr_method == 'ace_reml'):
-            asr_table,ci_table = ace_for_picrust(opts.input_tree_fp,opts.input_trait_table_fp,'REML',HALT_EXEC=opts.debug)
+        asr_table,ci_table = run_asr_for_picrust(opts.input_tree_fp,opts.input_trait_table_fp,opts.asr_method,HALT_EXEC=opts.debug,cache_dir=opts.cache_dir)
 
 
     #output the table to file
     make_output_dir_for_file(opts.output_fp)
     asr_table.writeToFile(opts.output_fp,sep='\t')
 
-    #output the CI file (unless the method is wagner)
-    if not (opts.asr_method == 'wagner'):
+    #output the CI file (unless the method has no CIs, e.g. wagner)
+    if ci_table is not None:
         make_output_dir_for_file(opts.output_ci_fp)
         ci_table.writeToFile(opts.output_ci_fp,sep='\t')
         
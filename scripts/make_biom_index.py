@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from os import path
+from cogent.util.option_parsing import parse_command_line_parameters, make_option
+from picrust.biom_index import write_biom_index, get_biom_index_fp
+from picrust.util import make_output_dir_for_file
+import gzip
+
+script_info = {}
+script_info['brief_description'] = "Build a sidecar index for fast loading of a subset of organisms from a precalculated biom table"
+script_info['script_description'] = "predict_metagenomes.py normally decompresses and scans the whole precalculated gene content table to load the organisms in an OTU table.  This script writes an index next to the table (by default, the table's filepath plus '.idx') that lets the organisms be read directly.  predict_metagenomes.py uses the index automatically when it is present and up to date with the table; if the table changes, the index is ignored until it is rebuilt."
+script_info['script_usage'] = [\
+("","Index precalculated KO counts (written to ko_precalculated.biom.gz.idx):","%prog -i ko_precalculated.biom.gz")]
+script_info['output_description']= "A BIOM index file"
+script_info['required_options'] = [
+ make_option('-i','--input_table',type="existing_filepath",help='the input sparse biom table, with organisms as samples (can be gzipped)')
+]
+script_info['optional_options'] = [
+ make_option('-o','--output_fp',type="new_filepath",default=None,help='the output index filepath.  Note that predict_metagenomes.py only finds indices at the default location [default: the input table filepath plus .idx]')
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args =\
+       parse_command_line_parameters(**script_info)
+
+    output_fp = opts.output_fp or get_biom_index_fp(opts.input_table)
+    make_output_dir_for_file(output_fp)
+
+    if opts.verbose:
+        print "Loading table:",opts.input_table
+
+    ext=path.splitext(opts.input_table)[1]
+    if (ext == '.gz'):
+        biom_str = gzip.open(opts.input_table,'rb').read()
+    else:
+        biom_str = open(opts.input_table,'U').read()
+
+    n_samples = write_biom_index(biom_str,output_fp,source_fp=opts.input_table)
+    if opts.verbose:
+        print "Indexed %i organisms in: %s" %(n_samples,output_fp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from os import path
+from numpy import float32, float64
+from cogent.util.option_parsing import parse_command_line_parameters, make_option
+from biom.parse import parse_biom_table
+from picrust.predict_traits import load_trait_matrix_from_file
+from picrust.matrix_cache import write_matrix_cache,\
+  biom_table_to_matrix_cache, MATRIX_TYPES
+from picrust.util import make_output_dir_for_file
+import gzip
+
+INPUT_FORMAT_CHOICES = ['biom','trait_table']
+MATRIX_TYPE_CHOICES = ['auto'] + MATRIX_TYPES
+DTYPE_CHOICES = ['float64','float32']
+
+script_info = {}
+script_info['brief_description'] = "Convert a biom table or trait table into a binary, memory-mappable matrix cache file"
+script_info['script_description'] = "Large tables (e.g. precalculated gene content, or ASR and genome trait tables) take a long time to parse as text.  This script converts them, once, to a binary matrix cache file.  The cache file can then be passed in place of the original table to predict_traits.py (-i, -r), predict_metagenomes.py (-c) and normalize_by_copy_number.py (-c), which will memory-map it rather than parsing it.  Multiple processes reading the same cache file share memory through the operating system's page cache."
+script_info['script_usage'] = [\
+("","Convert precalculated KO counts (biom, may be gzipped) to a cache file:","%prog -i ko_precalculated.biom.gz -o ko_precalculated.pmc"),\
+("","Convert a tab-delimited ASR table to a cache file:","%prog -f trait_table -i asr_counts.tab -o asr_counts.pmc")]
+script_info['output_description']= "A binary matrix cache file"
+script_info['required_options'] = [
+ make_option('-i','--input_table',type="existing_filepath",help='the input table, either in biom format (can be gzipped) or a tab-delimited trait table (see -f)'),
+ make_option('-o','--output_fp',type="new_filepath",help='the output matrix cache filepath')
+]
+script_info['optional_options'] = [
+ make_option('-f','--input_format',default='biom',type="choice",choices=INPUT_FORMAT_CHOICES,help='the format of the input table. Valid choices are: '+', '.join(INPUT_FORMAT_CHOICES)+'.  "biom": a biom table, with organisms as samples (e.g. precalculated genome tables).  "trait_table": a tab-delimited table with organisms as rows (e.g. ASR or genome tables for predict_traits.py) [default: %default]'),
+ make_option('-m','--matrix_type',default='auto',type="choice",choices=MATRIX_TYPE_CHOICES,help='how to store the matrix. Valid choices are: '+', '.join(MATRIX_TYPE_CHOICES)+'.  "dense": every value is stored.  "csr": only non-zero values are stored (compressed sparse rows), which is much smaller for sparse tables such as gene content.  "auto": csr for sparse biom tables, dense otherwise [default: %default]'),
+ make_option('--dtype',default='float64',type="choice",choices=DTYPE_CHOICES,help='the numeric type used to store values. Valid choices are: '+', '.join(DTYPE_CHOICES)+' [default: %default]')
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args =\
+       parse_command_line_parameters(**script_info)
+
+    dtype = {'float64':float64,'float32':float32}[opts.dtype]
+    matrix_type = opts.matrix_type
+    if matrix_type == 'auto':
+        matrix_type = None
+
+    make_output_dir_for_file(opts.output_fp)
+
+    if opts.verbose:
+        print "Loading table:",opts.input_table
+
+    if opts.input_format == 'biom':
+        ext=path.splitext(opts.input_table)[1]
+        if (ext == '.gz'):
+            table = parse_biom_table(gzip.open(opts.input_table,'rb'))
+        else:
+            table = parse_biom_table(open(opts.input_table,'U'))
+        if opts.verbose:
+            print "Writing %i organisms x %i traits to: %s" %\
+              (len(table.SampleIds),len(table.ObservationIds),opts.output_fp)
+        biom_table_to_matrix_cache(table,opts.output_fp,\
+          matrix_type=matrix_type,dtype=dtype)
+    else:
+        trait_ids,row_index,trait_matrix =\
+          load_trait_matrix_from_file(opts.input_table,dtype=dtype)
+        row_ids = sorted(row_index.keys(),key=row_index.get)
+        if opts.verbose:
+            print "Writing %i organisms x %i traits to: %s" %\
+              (len(row_ids),len(trait_ids),opts.output_fp)
+        write_matrix_cache(opts.output_fp,row_ids,trait_ids,\
+          (trait_matrix[row_index[r]] for r in row_ids),\
+          matrix_type=matrix_type or 'dense',dtype=dtype)
+
+if __name__ == "__main__":
+    main()
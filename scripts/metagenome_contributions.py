@@ -16,21 +16,23 @@ __status__ = "Development"
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from biom.parse import parse_biom_table
 from picrust.predict_metagenomes import predict_metagenomes, calc_nsti
-from picrust.metagenome_contributions import partition_metagenome_contributions
+from picrust.metagenome_contributions import yield_metagenome_contributions,\
+  write_metagenome_contributions
 from picrust.util import make_output_dir_for_file
-from os import path
+from os import path, getpid, remove, rename
 import gzip
 
 script_info = {}
 script_info['brief_description'] = "This script partitions metagenome functional contributions according to function, OTU, and sample, for a given OTU table."
 script_info['script_description'] = ""
 script_info['script_usage'] = [("","Partition the predicted contribution to the  metagenomes from each organism in otus.biom, using the predicted genes for each organism in genes.biom.","%prog -i otus.biom -c KEGG_acepic__predict_traits_97.biom.gz -o predicted_metagenomes.biom"),
-                               ("","Change output format to plain tab-delimited:","%prog -f -i otus.biom -c KEGG_acepic_predict_traits_97.biom.gz -o predicted_metagenomes.tab")]
+                               ("","Change output format to plain tab-delimited:","%prog -f -i otus.biom -c KEGG_acepic_predict_traits_97.biom.gz -o predicted_metagenomes.tab"),
+                               ("","Write gzipped output (rows are streamed to the file as they are calculated, so large outputs do not need to fit in memory):","%prog -i otus.biom -c KEGG_acepic_predict_traits_97.biom.gz -o metagenome_contributions.tab.gz")]
 script_info['output_description']= "Output is a table of function counts (e.g. KEGG KOs) by sample ids."
 script_info['required_options'] = [
  make_option('-i','--input_otu_table',type='existing_filepath',help='the input otu table in biom format'),
  make_option('-c','--input_count_table',type="existing_filepath",help='the input trait counts on per otu basis in biom format (can be gzipped)'),
- make_option('-o','--output_metagenome_table',type="new_filepath",help='the output file for the predicted metagenome')
+ make_option('-o','--output_metagenome_table',type="new_filepath",help='the output file for the predicted metagenome.  If the filename ends in .gz, the output is gzipped')
 ]
 script_info['optional_options'] = [\
         make_option('-a','--accuracy_metrics',default=None,type="new_filepath",help='If provided, calculate accuracy metrics for the predicted metagenome.  NOTE: requires that per-genome accuracy metrics were calculated using predict_traits.py during genome prediction (e.g. there are "NSTI" values in the genome .biom file metadata)'), 
@@ -67,13 +69,28 @@ def main():
     if opts.verbose:
         print "Predicting the metagenome..."
     
-    partitioned_metagenomes = partition_metagenome_contributions(otu_table,genome_table,limit_to_functions=limit_to_functions)
-    output_text = "\n".join(["\t".join(map(str,i)) for i in partitioned_metagenomes])
+    #Rows are calculated one gene at a time and written as they are
+    #produced, so the full result is never held in memory
+    partitioned_metagenomes = yield_metagenome_contributions(otu_table,genome_table,limit_to_functions=limit_to_functions,verbose=opts.verbose)
     if opts.verbose:
         print "Writing results to output file: ",opts.output_metagenome_table
         
+    #Write to a temporary name and rename at the end, so a failed run
+    #doesn't leave a truncated output file
     make_output_dir_for_file(opts.output_metagenome_table)
-    open(opts.output_metagenome_table,'w').write(output_text)
+    tmp_fp = '%s.%i.tmp' % (opts.output_metagenome_table,getpid())
+    if path.splitext(opts.output_metagenome_table)[1] == '.gz':
+        out_f = gzip.open(tmp_fp,'wb')
+    else:
+        out_f = open(tmp_fp,'w')
+    try:
+        write_metagenome_contributions(partitioned_metagenomes,out_f)
+        out_f.close()
+    except:
+        out_f.close()
+        remove(tmp_fp)
+        raise
+    rename(tmp_fp,opts.output_metagenome_table)
 
 if __name__ == "__main__":
     main()
@@ -19,6 +19,7 @@ from biom.table import table_factory,DenseOTUTable
 from picrust.predict_metagenomes import transfer_observation_metadata,\
   transfer_sample_metadata
 from picrust.util import make_output_dir_for_file
+from picrust.matrix_cache import is_matrix_cache_file, load_matrix_cache
 from os import path
 from os.path import join
 from picrust.util import get_picrust_project_dir
@@ -38,7 +39,7 @@ script_info['required_options'] = [
  make_option('-o','--output_otu_fp',type="new_filepath",help='the output otu table filepath in biom format'),
 ]
 script_info['optional_options'] = [
- make_option('-c','--input_count_fp',default=join(get_picrust_project_dir(),'picrust','data','16S_precalculated.biom.gz'),type="existing_filepath",help='the input marker gene counts on per otu basis in biom format (can be gzipped) [default: %default]'),
+ make_option('-c','--input_count_fp',default=join(get_picrust_project_dir(),'picrust','data','16S_precalculated.biom.gz'),type="existing_filepath",help='the input marker gene counts on per otu basis in biom format (can be gzipped), or a matrix cache file made from one with make_matrix_cache.py [default: %default]'),
  make_option('--metadata_identifer',
              default='CopyNumber',
              help='identifier for copy number entry as observation metadata [default: %default]'),
@@ -61,7 +62,13 @@ def main():
             raise ValueError("Error loading OTU table! If not in BIOM format use '-f' option.\n")
 
     ext=path.splitext(opts.input_count_fp)[1]
-    if (ext == '.gz'):
+    if is_matrix_cache_file(opts.input_count_fp):
+        #Only load copy numbers for OTUs that are in the OTU table
+        count_cache = load_matrix_cache(opts.input_count_fp)
+        cached_ids = set(count_cache.row_ids)
+        count_table = count_cache.to_biom_table([str(i) for i in\
+          otu_table.ObservationIds if str(i) in cached_ids])
+    elif (ext == '.gz'):
         count_table = parse_biom_table(gzip.open(opts.input_count_fp,'rb'))
     else:
         count_table = parse_biom_table(open(opts.input_count_fp,'U'))
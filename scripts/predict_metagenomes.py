@@ -16,8 +16,13 @@ from cStringIO import StringIO
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from biom.parse import parse_biom_table
 from picrust.predict_metagenomes import predict_metagenomes, calc_nsti,\
-  load_subset_from_biom_str
+  load_subset_from_biom_str, predict_metagenomes_sparse,\
+  make_empty_metagenome_table, yield_predicted_metagenome_chunks,\
+  write_metagenome_chunks_as_biom, write_metagenome_chunks_as_tab_delimited
 from picrust.util import make_output_dir_for_file,format_biom_table
+from picrust.matrix_cache import is_matrix_cache_file, load_matrix_cache
+from picrust.biom_index import get_biom_index_fp, biom_index_is_current,\
+  load_subset_from_biom_index
 from os import path
 from os.path import join
 from picrust.util import get_picrust_project_dir
@@ -35,6 +40,7 @@ script_info['required_options'] = [
  make_option('-o','--output_metagenome_table',type="new_filepath",help='the output file for the predicted metagenome')
 ]
 type_of_prediction_choices=['KO','COG']
+engine_choices=['dense','sparse']
 
 script_info['optional_options'] = [\
     make_option('-t','--type_of_prediction',default='KO',type="choice",\
@@ -42,8 +48,14 @@ script_info['optional_options'] = [\
                     help='Type of functional predictions. Valid choices are: '+\
                     ', '.join(type_of_prediction_choices)+\
                     ' [default: %default]'),
-    make_option('-c','--input_count_table',default=None,type="existing_filepath",help='Precalculated function predictions on per otu basis in biom format (can be gzipped). Note: using this option overrides --type_of_prediction. [default: %default]'),
+    make_option('-c','--input_count_table',default=None,type="existing_filepath",help='Precalculated function predictions on per otu basis in biom format (can be gzipped), or a matrix cache file made from one with make_matrix_cache.py. If an up to date index made with make_biom_index.py is found next to the table, only the organisms in the OTU table are read from it. Note: using this option overrides --type_of_prediction. [default: %default]'),
     make_option('-a','--accuracy_metrics',default=None,type="new_filepath",help='If provided, calculate accuracy metrics for the predicted metagenome.  NOTE: requires that per-genome accuracy metrics were calculated using predict_traits.py during genome prediction (e.g. there are "NSTI" values in the genome .biom file metadata)'),
+    make_option('--engine',default='dense',type="choice",\
+                    choices=engine_choices,\
+                    help='How to multiply the OTU and genome tables. Valid choices are: '+\
+                    ', '.join(engine_choices)+\
+                    '.  "dense": convert both tables to dense arrays.  "sparse": work with compressed sparse arrays and keep only non-zero results, which uses much less memory for large, mostly empty tables (same output). [default: %default]'),
+    make_option('--chunk_samples',default=None,type="int",help='If provided, predict the metagenome for this many samples at a time and write each block of samples to the output as soon as it is predicted, so that memory use depends on the block size rather than the number of samples in the study.  Uses the sparse engine.  Useful for studies with very many samples. [default: %default]'),
     make_option('--suppress_subset_loading',default=False,action="store_true",help='Normally, only counts for OTUs present in the sample are loaded.  If this flag is passed, the full biom table is loaded.  This makes no difference for the analysis, but may result in faster load times (at the cost of more memory usage)'),
   make_option('-f','--format_tab_delimited',action="store_true",default=False,help='output the predicted metagenome table in tab-delimited format [default: %default]')]
 script_info['version'] = __version__
@@ -72,8 +84,16 @@ def main():
 
     
     ext=path.splitext(input_count_table)[1]
+    biom_index_fp = get_biom_index_fp(input_count_table)
+    use_biom_index = not opts.suppress_subset_loading and\
+      biom_index_is_current(biom_index_fp,input_count_table)
+    if opts.verbose and path.exists(biom_index_fp) and not use_biom_index\
+      and not opts.suppress_subset_loading:
+        print "Ignoring out of date index (rebuild it with make_biom_index.py): ",biom_index_fp
     
-    if (ext == '.gz'):
+    if is_matrix_cache_file(input_count_table) or use_biom_index:
+        genome_table_str = None
+    elif (ext == '.gz'):
         genome_table_str = gzip.open(input_count_table,'rb').read()
     else:
         genome_table_str = open(input_count_table,'U').read()
@@ -81,7 +101,22 @@ def main():
     #In the genome/trait table genomes are the samples and 
     #genes are the observations
     
-    if not opts.suppress_subset_loading:
+    if use_biom_index:
+        #The index lets us read the counts for just the OTUs in the
+        #OTU table, without decompressing or scanning the whole table
+        ids_to_load = otu_table.ObservationIds
+        if opts.verbose:
+            print "Loading traits for %i organisms using the index: %s" %(len(ids_to_load),biom_index_fp)
+        genome_table = load_subset_from_biom_index(biom_index_fp,ids_to_load)
+    elif genome_table_str is None:
+        #Matrix caches are memory-mapped, so only the rows for
+        #OTUs in the OTU table are read from disk
+        if opts.suppress_subset_loading:
+            ids_to_load = None
+        else:
+            ids_to_load = otu_table.ObservationIds
+        genome_table = load_matrix_cache(input_count_table).to_biom_table(ids_to_load)
+    elif not opts.suppress_subset_loading:
         #Now we want to use the OTU table information
         #to load only rows in the count table corresponding
         #to relevant OTUs
@@ -126,10 +161,31 @@ def main():
             print "Writing accuracy information to file:", opts.accuracy_metrics
         open(opts.accuracy_metrics,'w').writelines(sorted(lines))
 
+    if opts.chunk_samples is not None:
+        if opts.chunk_samples < 1:
+            option_parser.error("--chunk_samples must be at least 1")
+        if opts.verbose:
+            print "Predicting the metagenome and writing it to %s in blocks of %i samples..." %(opts.output_metagenome_table,opts.chunk_samples)
+        result_table = make_empty_metagenome_table(otu_table,genome_table)
+        chunks = yield_predicted_metagenome_chunks(otu_table,genome_table,\
+          chunk_size=opts.chunk_samples)
+        out_f = open(opts.output_metagenome_table,'w')
+        if opts.format_tab_delimited:
+            write_metagenome_chunks_as_tab_delimited(out_f,result_table,chunks,\
+              header_key="KEGG Pathways",header_value="KEGG Pathways",\
+              metadata_formatter=lambda s: '|'.join(['; '.join(l) for l in s]))
+        else:
+            write_metagenome_chunks_as_biom(out_f,result_table,chunks)
+        out_f.close()
+        return
+
     if opts.verbose:
         print "Predicting the metagenome..."
         
-    predicted_metagenomes = predict_metagenomes(otu_table,genome_table)
+    if opts.engine == 'sparse':
+        predicted_metagenomes = predict_metagenomes_sparse(otu_table,genome_table)
+    else:
+        predicted_metagenomes = predict_metagenomes(otu_table,genome_table)
 
     if opts.verbose:
         print "Writing results to output file: ",opts.output_metagenome_table
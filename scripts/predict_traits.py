@@ -15,22 +15,28 @@ __status__ = "Development"
 
 from warnings import warn
 from math import e
-from os.path import splitext
+from os.path import splitext, exists
 from numpy import array
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from cogent import LoadTree
 from picrust.parse import parse_trait_table, extract_ids_from_table,\
   parse_asr_confidence_output
 from picrust.predict_traits import assign_traits_to_tree,\
-  predict_traits_from_ancestors, update_trait_dict_from_file,\
+  predict_traits_from_ancestors,\
   make_neg_exponential_weight_fn, biom_table_from_predictions,\
   predict_random_neighbor,predict_nearest_neighbor,\
   calc_nearest_sequenced_taxon_index,calc_confidence_interval_95,\
-  weighted_average_variance_prediction, get_brownian_motion_param_from_confidence_intervals
+  weighted_average_variance_prediction, get_brownian_motion_param_from_confidence_intervals,\
+  predict_traits_from_ancestors_vectorized, load_trait_matrix_from_file,\
+  predict_traits_from_ancestors_in_parallel
 from biom.table import table_factory
 from cogent.util.table import Table
-from picrust.util import make_output_dir_for_file, format_biom_table
+from picrust.util import make_output_dir_for_file, format_biom_table, PicrustNode
 from picrust.format_tree_and_trait_table import load_picrust_tree, set_label_conversion_fns
+from picrust.incremental import get_nodes_to_repredict, load_predictions_from_biom
+from picrust.compact_tree import CompactTree
+from picrust.tree_cache import get_tree_cache_key, get_tree_cache_fp,\
+  save_decorated_tree, load_decorated_tree
 
 script_info = {}
 script_info['brief_description'] = "Given a tree and a set of known character states (observed traits and reconstructions), output predictions for unobserved character states"
@@ -57,6 +63,8 @@ METHOD_CHOICES = ['asr_and_weighting','nearest_neighbor','asr_only','weighting_o
   'random_neighbor']
 WEIGHTING_CHOICES = ['exponential','linear','equal']
 CONFIDENCE_FORMAT_CHOICES = ['sigma','confidence_interval']
+ENGINE_CHOICES = ['iterative','vectorized']
+NSTI_METHOD_CHOICES = ['tree_dp','dense']
 
 #Add script information
 script_info['script_usage'] = [\
@@ -76,18 +84,37 @@ script_info['optional_options'] = [\
    default='predicted_states.tsv',help='the output filepath for trait predictions [default: %default]'),\
  make_option('-a','--output_accuracy_metrics',type="new_filepath",\
    default=None,help='if specified, calculate accuracy metrics (i.e. how accurate does PICRUSt expect its predictions to be?) and output them to this filepath [default: %default]'),\
+ make_option('--nsti_method',default='tree_dp',choices=NSTI_METHOD_CHOICES,help='Specify how the Nearest Sequenced Taxon Index is calculated when -a is passed.  Valid choices are:'+",".join(NSTI_METHOD_CHOICES)+'.  "tree_dp": find the nearest sequenced tip for every tip with two linear-time passes over the tree (recommended).  "dense": build the full tip-to-tip distance matrix (uses memory quadratic in the number of tips; only useful for validation on small trees).  [default: %default]'),\
 
  make_option('-m','--prediction_method',default='asr_and_weighting',choices=METHOD_CHOICES,help='Specify prediction method to use.  The recommended prediction method is set as default, so other options are primarily useful for control experiments and methods validation, not typical use.  Valid choices are:'+",".join(METHOD_CHOICES)+'.  "asr_and_weighting"(recommended): use ancestral state reconstructions plus local weighting with known tip nodes.  "nearest_neighbor": predict the closest tip on the tree with trait information.  "random_annotated_neighbor": predict a random tip on the tree with trait information. "asr_only": predict the traits of the last reconstructed ancestor, without weighting. "weighting_only": weight all genomes by distance, to the organism of interest using the specified weighting function and predict the weighted average.   [default: %default]'),\
 
  make_option('-w','--weighting_method',default='exponential',choices=WEIGHTING_CHOICES,help='Specify prediction the weighting function to use.  This only applies to prediction methods that incorporate local weighting ("asr_and_weighting" or "weighting_only")  The recommended weighting  method is set as default, so other options are primarily useful for control experiments and methods validation, not typical use.  Valid choices are:'+",".join(WEIGHTING_CHOICES)+'.  "exponential"(recommended): weight genomes as a negative exponent of distance.  That is 2^-d, where d is the tip-to-tip distance from the genome to the tip.  "linear": weight tips as a linear function of weight, normalized to the maximum possible distance (max_d -d)/d. "equal_weights": set all weights to a constant (ignoring branch length).   [default: %default]'),\
  
  
+ make_option('--engine',default='iterative',choices=ENGINE_CHOICES,help='Specify the prediction engine used by the "asr_and_weighting" method.  Valid choices are:'+",".join(ENGINE_CHOICES)+'.  "iterative": walk the tree separately for each tip to be predicted.  "vectorized": keep the tree and traits in flat arrays (see picrust.compact_tree.CompactTree), and predict all tips at once using matrix operations (much faster and smaller on large trees, same output).  [default: %default]'),\
+
+ make_option('--num_processes',type="int",default=1,help='Specify the number of processes used to predict tips with the "iterative" engine of the "asr_and_weighting" method.  Tips to predict are split into this many balanced partitions, which are predicted in parallel (same output).  [default: %default]'),\
+
  make_option('-l','--limit_predictions_by_otu_table',type="existing_filepath",help='Specify a valid path to a legacy QIIME OTU table to perform predictions only for tips that are listed in the OTU table (regardless of abundance)'),\
  make_option('-g','--limit_predictions_to_organisms',help='Limit predictions to specific, comma-separated organims ids. (Generally only useful for lists of < 10 organism ids, for example when performing leave-one-out cross-validation).'),\
  make_option('-r','--reconstructed_trait_table',\
    type="existing_filepath",default=None,\
    help='the input trait table describing reconstructed traits (from ancestral_state_reconstruction.py) in tab-delimited format [default: %default]'),\
 
+ make_option('--tree_cache_dir',\
+   type="new_dirpath",default=None,\
+   help='a directory in which to cache the tree decorated with traits (and confidence intervals), keyed by the contents of the input files.  Later runs with the same -t, -i, -r, -c and --confidence_format load the decorated tree from here and skip straight to prediction, so e.g. different -l, -g or -w options are much faster.  Created if needed. [default: %default]'),\
+
+ make_option('--previous_predictions',\
+   type="existing_filepath",default=None,\
+   help='the .biom output of a previous run with the same tree and options, but fewer or different genomes.  Only tips whose most recent reconstructed ancestor or annotated relatives changed are predicted again; the others keep their previous predictions.  Requires --previous_observed_trait_table (and --previous_reconstructed_trait_table with -r).  Only for the asr_and_weighting method, without -c. [default: %default]'),\
+ make_option('--previous_observed_trait_table',\
+   type="existing_filepath",default=None,\
+   help='the observed trait table (-i) of the run that produced --previous_predictions [default: %default]'),\
+ make_option('--previous_reconstructed_trait_table',\
+   type="existing_filepath",default=None,\
+   help='the reconstructed trait table (-r) of the run that produced --previous_predictions [default: %default]'),\
+
  make_option('--confidence_format',\
    choices=CONFIDENCE_FORMAT_CHOICES,default='sigma',\
    help='the format for the confidence intervals from ancestral state reconstruction. Only needed if passing a reconstruction confidence file with -c or --reconstruction_confidence.  These are typically sigma values for maximum likelihood ASR  methods, but 95% confidence intervals for phylogenetic independent contrasts (e.g. from the ape R packages ace function with pic as the reconstruction method).  Valid choices are:'+",".join(CONFIDENCE_FORMAT_CHOICES)+'. [default: %default]'),\
@@ -129,86 +156,141 @@ def main():
     option_parser, opts, args =\
        parse_command_line_parameters(**script_info)
     
-    if opts.verbose:
-        print "Loading tree from file:", opts.tree
+    if opts.num_processes < 1:
+        option_parser.error("--num_processes must be at least 1")
+    if opts.num_processes > 1 and opts.engine != 'iterative':
+        option_parser.error("--num_processes only applies to --engine iterative.")
+    if opts.previous_predictions:
+        if opts.prediction_method != 'asr_and_weighting' or opts.reconstruction_confidence:
+            option_parser.error("--previous_predictions only applies to the asr_and_weighting method, without -c.")
+        if not opts.previous_observed_trait_table:
+            option_parser.error("--previous_predictions requires --previous_observed_trait_table.")
+        if bool(opts.reconstructed_trait_table) != bool(opts.previous_reconstructed_trait_table):
+            option_parser.error("Pass --previous_reconstructed_trait_table if and only if -r is passed.")
+
+    #Keep the tree and traits in flat arrays rather than node objects
+    compact = opts.engine == 'vectorized' and\
+      opts.prediction_method == 'asr_and_weighting' and\
+      not (opts.output_accuracy_metrics and opts.nsti_method == 'dense')
+
+    # Specify the attribute where we'll store the reconstructions
+    trait_label = "Reconstruction"
+    trait_labels = [trait_label]
+    if opts.reconstruction_confidence:
+        trait_labels.extend(["lower_bound","upper_bound"])
+
+    #The decorated tree only depends on the input files, so can be cached
+    tree_cache_fp = None
+    if opts.tree_cache_dir:
+        tree_cache_key = get_tree_cache_key([opts.tree,\
+          opts.observed_trait_table,opts.reconstructed_trait_table,\
+          opts.reconstruction_confidence],\
+          params={'confidence_format':opts.confidence_format})
+        tree_cache_fp = get_tree_cache_fp(opts.tree_cache_dir,tree_cache_key)
+
+    if tree_cache_fp and exists(tree_cache_fp):
+        if opts.verbose:
+            print "Loading decorated tree from cache:",tree_cache_fp
+        tree,table_headers,brownian_motion_parameter =\
+          load_decorated_tree(tree_cache_fp)
+        if not compact:
+            tree = tree.to_phylo_node(constructor=PicrustNode,\
+              trait_labels=trait_labels)
+    else:
+        if opts.verbose:
+            print "Loading tree from file:", opts.tree
     
-    # Load Tree
-    #tree = LoadTree(opts.tree)
-    tree = load_picrust_tree(opts.tree, opts.verbose)
-
-    table_headers =[]
-    traits={}
-    #load the asr trait table using the previous list of functions to order the arrays
-    if opts.reconstructed_trait_table:
-        table_headers,traits =\
-                update_trait_dict_from_file(opts.reconstructed_trait_table)
-
-        #Only load confidence intervals on the reconstruction
-        #If we actually have ASR values in the analysis
-        if opts.reconstruction_confidence:
-            if opts.verbose:
-                print "Loading ASR confidence data from file:",\
-                opts.reconstruction_confidence
-                print "Assuming confidence data is of type:",opts.confidence_format
+        # Load Tree
+        #tree = LoadTree(opts.tree)
+        tree = load_picrust_tree(opts.tree, opts.verbose, compact=compact)
+
+        table_headers =[]
+        traits={}
+        brownian_motion_parameter = None
+        #load the asr trait table using the previous list of functions to order the arrays
+        if opts.reconstructed_trait_table:
+            table_headers,asr_row_index,asr_matrix =\
+                    load_trait_matrix_from_file(opts.reconstructed_trait_table)
+            #traits are views into the matrix rows, so no per-value copies
+            traits = dict([(organism,asr_matrix[row]) for organism,row in\
+              asr_row_index.iteritems()])
+
+            #Only load confidence intervals on the reconstruction
+            #If we actually have ASR values in the analysis
+            if opts.reconstruction_confidence:
+                if opts.verbose:
+                    print "Loading ASR confidence data from file:",\
+                    opts.reconstruction_confidence
+                    print "Assuming confidence data is of type:",opts.confidence_format
             
-            asr_confidence_output = open(opts.reconstruction_confidence)
-            asr_min_vals,asr_max_vals, params,column_mapping =\
-              parse_asr_confidence_output(asr_confidence_output,format=opts.confidence_format)
-            if 'sigma' in params:
-                brownian_motion_parameter = params['sigma'][0]
-                brownian_motion_error = params['sigma'][1]
+                asr_confidence_output = open(opts.reconstruction_confidence)
+                asr_min_vals,asr_max_vals, params,column_mapping =\
+                  parse_asr_confidence_output(asr_confidence_output,format=opts.confidence_format)
+                if 'sigma' in params:
+                    brownian_motion_parameter = params['sigma'][0]
+                    brownian_motion_error = params['sigma'][1]
+                else:
+                    brownian_motion_parameter = None
+                 
+                if opts.verbose:
+                    print "Done. Loaded %i confidence interval values." %(len(asr_max_vals))
+                    print "Brownian motion parameter:",brownian_motion_parameter
             else:
                 brownian_motion_parameter = None
-                 
-            if opts.verbose:
-                print "Done. Loaded %i confidence interval values." %(len(asr_max_vals))
-                print "Brownian motion parameter:",brownian_motion_parameter
-        else:
-            brownian_motion_parameter = None
 
-    #load the trait table into a dict with organism names as keys and arrays as functions
-    table_headers,genome_traits =\
-            update_trait_dict_from_file(opts.observed_trait_table,table_headers)
+        #load the trait table into a dict with organism names as keys and arrays as functions
+        table_headers,genome_row_index,genome_matrix =\
+                load_trait_matrix_from_file(opts.observed_trait_table,table_headers)
+        genome_traits = dict([(organism,genome_matrix[row]) for organism,row in\
+          genome_row_index.iteritems()])
 
 
-    #Combine the trait tables overwriting the asr ones if they exist in the genome trait table.
-    traits.update(genome_traits)
+        #Combine the trait tables overwriting the asr ones if they exist in the genome trait table.
+        traits.update(genome_traits)
         
-    # Specify the attribute where we'll store the reconstructions
-    trait_label = "Reconstruction"
-   
-    if opts.verbose:
-        print "Assigning traits to tree..."
+        if opts.verbose:
+            print "Assigning traits to tree..."
 
-    # Decorate tree using the traits
-    tree = assign_traits_to_tree(traits,tree, trait_label=trait_label)
+        # Decorate tree using the traits
+        tree = assign_traits_to_tree(traits,tree, trait_label=trait_label)
 
     
-    if opts.reconstruction_confidence: 
-        if opts.verbose:
-            print "Assigning trait confidence intervals to tree..."
-        tree = assign_traits_to_tree(asr_min_vals,tree,\
-            trait_label="lower_bound")
+        if opts.reconstruction_confidence: 
+            if opts.verbose:
+                print "Assigning trait confidence intervals to tree..."
+            tree = assign_traits_to_tree(asr_min_vals,tree,\
+                trait_label="lower_bound")
 
-        tree = assign_traits_to_tree(asr_max_vals,tree,\
-            trait_label="upper_bound")
+            tree = assign_traits_to_tree(asr_max_vals,tree,\
+                trait_label="upper_bound")
 
-        if brownian_motion_parameter is None:
+            if brownian_motion_parameter is None:
              
-             if opts.verbose: 
-                 print "No Brownian motion parameters loaded. Inferring these from 95% confidence intervals..."
-             brownian_motion_parameter = get_brownian_motion_param_from_confidence_intervals(tree,\
-                      upper_bound_trait_label="upper_bound",\
-                      lower_bound_trait_label="lower_bound",\
-                      trait_label=trait_label,\
-                      confidence=0.95)
-             if opts.verbose:
-                 print "Inferred the following rate parameters:",brownian_motion_parameter
+                 if opts.verbose: 
+                     print "No Brownian motion parameters loaded. Inferring these from 95% confidence intervals..."
+                 brownian_motion_parameter = get_brownian_motion_param_from_confidence_intervals(tree,\
+                          upper_bound_trait_label="upper_bound",\
+                          lower_bound_trait_label="lower_bound",\
+                          trait_label=trait_label,\
+                          confidence=0.95)
+                 if opts.verbose:
+                     print "Inferred the following rate parameters:",brownian_motion_parameter
+
+        if tree_cache_fp:
+            if opts.verbose:
+                print "Saving decorated tree to cache:",tree_cache_fp
+            if compact:
+                compact_tree = tree
+            else:
+                compact_tree = CompactTree.from_phylo_node(tree,\
+                  trait_labels=trait_labels)
+            save_decorated_tree(tree_cache_fp,compact_tree,table_headers,\
+              brownian_motion_parameter)
     if opts.verbose:
         print "Collecting list of nodes to predict..."
 
     #Start by predict all tip nodes.
-    nodes_to_predict = [tip.Name for tip in tree.tips()]
+    nodes_to_predict = tree.getTipNames()
     
     if opts.verbose:
         print "Found %i nodes to predict." % len(nodes_to_predict)
@@ -235,7 +317,7 @@ def main():
 
         if not nodes_to_predict:
             raise RuntimeError(\
-              "Filtering by user-specified ids resulted in an empty set of nodes to predict.   Are the ids on the commmand-line and tree ids in the same format?  Example tree tip name: %s, example OTU id name: %s" %([tip.Name for tip in tree.tips()][0],ok_organism_ids[0]))
+              "Filtering by user-specified ids resulted in an empty set of nodes to predict.   Are the ids on the commmand-line and tree ids in the same format?  Example tree tip name: %s, example OTU id name: %s" %(tree.getTipNames()[0],ok_organism_ids[0]))
         
         if opts.verbose:
             print "After filtering organisms to predict by the ids specified on the commandline, %i nodes remain to be predicted" %(len(nodes_to_predict))
@@ -260,7 +342,7 @@ def main():
 
         if not nodes_to_predict:
             raise RuntimeError(\
-              "Filtering by OTU table resulted in an empty set of nodes to predict.   Are the OTU ids and tree ids in the same format?  Example tree tip name: %s, example OTU id name: %s" %([tip.Name for tip in tree.tips()][0],otu_ids[0]))
+              "Filtering by OTU table resulted in an empty set of nodes to predict.   Are the OTU ids and tree ids in the same format?  Example tree tip name: %s, example OTU id name: %s" %(tree.getTipNames()[0],otu_ids[0]))
         
         if opts.verbose:
             print "After filtering by OTU table, %i nodes remain to be predicted" %(len(nodes_to_predict))
@@ -278,7 +360,8 @@ def main():
             nsti_result,min_distances =\
                 calc_nearest_sequenced_taxon_index(tree,\
                 limit_to_tips = nodes_to_predict,\
-                trait_label = trait_label, verbose=opts.verbose)
+                trait_label = trait_label, verbose=opts.verbose,\
+                method = opts.nsti_method)
             
             #accuracy_metric_results['NSTI'] = nsti_result
             for organism in min_distances.keys():
@@ -301,6 +384,40 @@ def main():
         f.close()
 
 
+    previous_predictions = {}
+    if opts.previous_predictions:
+        if opts.verbose:
+            print "Loading previous predictions from file:",opts.previous_predictions
+        previous_predictions = load_predictions_from_biom(opts.previous_predictions,\
+          table_headers)
+
+        #Decorate the tree with the traits the previous predictions were made from
+        previous_traits = {}
+        if opts.previous_reconstructed_trait_table:
+            previous_headers,previous_row_index,previous_matrix =\
+              load_trait_matrix_from_file(opts.previous_reconstructed_trait_table,table_headers)
+            previous_traits.update([(organism,previous_matrix[row]) for organism,row in\
+              previous_row_index.iteritems()])
+        previous_headers,previous_row_index,previous_matrix =\
+          load_trait_matrix_from_file(opts.previous_observed_trait_table,table_headers)
+        previous_traits.update([(organism,previous_matrix[row]) for organism,row in\
+          previous_row_index.iteritems()])
+        tree = assign_traits_to_tree(previous_traits,tree,\
+          trait_label="previous_Reconstruction")
+
+        all_nodes_to_predict = nodes_to_predict
+        nodes_to_predict = get_nodes_to_repredict(tree,nodes_to_predict,\
+          trait_label=trait_label,previous_trait_label="previous_Reconstruction")
+        #Nodes without previous predictions are always predicted
+        repredicted = set(nodes_to_predict)
+        nodes_to_predict.extend([n for n in all_nodes_to_predict\
+          if n not in previous_predictions and n not in repredicted])
+        previous_predictions = dict([(n,previous_predictions[n]) for n in\
+          all_nodes_to_predict if n in previous_predictions])
+        if opts.verbose:
+            print "%i of %i nodes need to be predicted again" %(len(nodes_to_predict),\
+              len(all_nodes_to_predict))
+
     if opts.verbose:
         print "Generating predictions using method:",opts.prediction_method
 
@@ -316,10 +433,34 @@ def main():
     variances=None #Overwritten by methods that calc variance
     confidence_intervals=None #Overwritten by methods that calc variance
 
-    if opts.prediction_method == 'asr_and_weighting': 
+    if opts.previous_predictions and not nodes_to_predict:
+        predictions = {}
+
+    elif opts.prediction_method == 'asr_and_weighting': 
         # Perform predictions using reconstructed ancestral states
   
-        if opts.reconstruction_confidence:
+        if opts.reconstruction_confidence and opts.engine == 'vectorized':
+            predictions,variances,confidence_intervals =\
+              predict_traits_from_ancestors_vectorized(tree,nodes_to_predict,\
+              trait_label=trait_label,\
+              lower_bound_trait_label="lower_bound",\
+              upper_bound_trait_label="upper_bound",\
+              calc_confidence_intervals = True,\
+              brownian_motion_parameter=brownian_motion_parameter,\
+              weight_fn =weight_fn,verbose=opts.verbose)
+
+        elif opts.reconstruction_confidence and opts.num_processes > 1:
+            predictions,variances,confidence_intervals =\
+              predict_traits_from_ancestors_in_parallel(tree,nodes_to_predict,\
+              num_processes=opts.num_processes,\
+              trait_label=trait_label,\
+              lower_bound_trait_label="lower_bound",\
+              upper_bound_trait_label="upper_bound",\
+              calc_confidence_intervals = True,\
+              brownian_motion_parameter=brownian_motion_parameter,\
+              weight_fn =weight_fn,verbose=opts.verbose)
+
+        elif opts.reconstruction_confidence:
             predictions,variances,confidence_intervals =\
               predict_traits_from_ancestors(tree,nodes_to_predict,\
               trait_label=trait_label,\
@@ -329,6 +470,19 @@ def main():
               brownian_motion_parameter=brownian_motion_parameter,\
               weight_fn =weight_fn,verbose=opts.verbose)
     
+        elif opts.engine == 'vectorized':
+             predictions =\
+              predict_traits_from_ancestors_vectorized(tree,nodes_to_predict,\
+              trait_label=trait_label,\
+              weight_fn =weight_fn,verbose=opts.verbose)
+
+        elif opts.num_processes > 1:
+             predictions =\
+              predict_traits_from_ancestors_in_parallel(tree,nodes_to_predict,\
+              num_processes=opts.num_processes,\
+              trait_label=trait_label,\
+              weight_fn =weight_fn,verbose=opts.verbose)
+
         else:
              predictions =\
               predict_traits_from_ancestors(tree,nodes_to_predict,\
@@ -360,6 +514,11 @@ def main():
         error_text = error_template %(opts.prediction_method,\
           ", ".join(METHOD_CHOICES))
 
+    if opts.previous_predictions:
+        #Keep the previous predictions that are still valid
+        previous_predictions.update(predictions)
+        predictions = previous_predictions
+
     if opts.verbose:
         print "Converting results to .biom format for output..."
     #convert to biom format (and transpose)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from os import listdir, rmdir
+from tempfile import mkdtemp
+from cogent import LoadTable
+from cogent.util.table import Table
+from cogent.util.unit_test import main,TestCase
+from cogent.app.util import get_tmp_filename
+from cogent.util.misc import remove_files
+from picrust.ancestral_state_reconstruction import ASR_METHODS,\
+  run_asr_in_parallel, run_asr_for_picrust, combine_asr_table_objects,\
+  get_trait_blocks
+
+"""
+Tests for ancestral_state_reconstruction.py
+"""
+
+def fake_asr(tree,table,HALT_EXEC=False):
+    """Fake asr method: the 'root' gets the sum of the tips, with a ci of +/- 1"""
+    table = LoadTable(filename=table,header=True,sep='\t')
+    traits = table.Header[1:]
+    totals = [sum(row) for row in zip(*table.getRawData())[1:]]
+    asr_table = Table(header=['nodes']+traits,rows=[['root']+totals])
+    ci_table = Table(header=['nodes']+traits,\
+      rows=[['root']+['%s|%s' % (t-1,t+1) for t in totals]])
+    return asr_table,ci_table
+
+def failing_asr(tree,table,HALT_EXEC=False):
+    raise RuntimeError("ASR failed")
+
+class TestAncestralStateReconstruction(TestCase):
+    """Tests of ancestral_state_reconstruction.py"""
+
+    def setUp(self):
+        ASR_METHODS['fake'] = fake_asr
+        ASR_METHODS['failing'] = failing_asr
+        self.trait_table_fp = get_tmp_filename(prefix='ASR_Tests',suffix='.tab')
+        open(self.trait_table_fp,'w').write(trait_table1)
+        self.tmp_dir = mkdtemp(prefix='ASR_Tests')
+
+    def tearDown(self):
+        del ASR_METHODS['fake']
+        del ASR_METHODS['failing']
+        remove_files([self.trait_table_fp],error_on_missing=False)
+        rmdir(self.tmp_dir)
+
+    def test_combine_asr_table_objects(self):
+        """combine_asr_table_objects should join the 2nd column of each table"""
+        tables = [Table(header=['nodes','A'],rows=[['x',1],['y',2]]),\
+          Table(header=['nodes','B'],rows=[['x',3],['y',4]])]
+        self.assertEqual(combine_asr_table_objects(tables),\
+          [['nodes','A','B'],['x',1,3],['y',2,4]])
+
+        #Tables with blocks of traits are joined too
+        tables.append(Table(header=['nodes','C','D'],rows=[['x',5,7],['y',6,8]]))
+        self.assertEqual(combine_asr_table_objects(tables),\
+          [['nodes','A','B','C','D'],['x',1,3,5,7],['y',2,4,6,8]])
+
+    def test_get_trait_blocks(self):
+        """get_trait_blocks should split trait columns into consecutive blocks"""
+        self.assertEqual(get_trait_blocks(5,2),[[1,2],[3,4],[5]])
+        self.assertEqual(get_trait_blocks(3,1),[[1],[2],[3]])
+        self.assertEqual(get_trait_blocks(3,10),[[1,2,3]])
+        self.assertRaises(ValueError,get_trait_blocks,3,0)
+
+    def test_run_asr_in_parallel_local_pool(self):
+        """run_asr_in_parallel with local_pool should combine results in trait order"""
+        for num_jobs,traits_per_job in [(1,None),(2,1),(100,2),(2,3)]:
+            asr_table,ci_table = run_asr_in_parallel('tree.newick',\
+              self.trait_table_fp,'fake',parallel_method='local_pool',\
+              tmp_dir=self.tmp_dir,num_jobs=num_jobs,\
+              traits_per_job=traits_per_job)
+            self.assertEqual(asr_table.Header,['nodes','K1','K2','K3'])
+            self.assertEqual(asr_table.getRawData(),[['root',3,0,6]])
+            self.assertEqual(ci_table.Header,['nodes','K1','K2','K3'])
+            self.assertEqual(ci_table.getRawData(),[['root','2|4','-1|1','5|7']])
+            #No temporary files are left behind
+            self.assertEqual(listdir(self.tmp_dir),[])
+
+        self.assertRaises(RuntimeError,run_asr_in_parallel,'tree.newick',\
+          self.trait_table_fp,'failing',parallel_method='local_pool',\
+          tmp_dir=self.tmp_dir)
+        self.assertEqual(listdir(self.tmp_dir),[])
+        self.assertRaises(ValueError,run_asr_in_parallel,'tree.newick',\
+          self.trait_table_fp,'bad',parallel_method='local_pool',\
+          tmp_dir=self.tmp_dir)
+        self.assertRaises(ValueError,run_asr_in_parallel,'tree.newick',\
+          self.trait_table_fp,'fake',parallel_method='local_pool',\
+          tmp_dir=self.tmp_dir,num_jobs=0)
+
+    def test_run_asr_for_picrust(self):
+        """run_asr_for_picrust should dispatch to the asr method"""
+        asr_table,ci_table = run_asr_for_picrust('tree.newick',\
+          self.trait_table_fp,'fake')
+        self.assertEqual(asr_table.getRawData(),[['root',3,0,6]])
+        self.assertRaises(ValueError,run_asr_for_picrust,'tree.newick',\
+          self.trait_table_fp,'bad')
+
+trait_table1 = """nodes\tK1\tK2\tK3
+A\t1\t0\t2
+B\t2\t0\t4
+"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import join
+from cogent import LoadTable
+from cogent.util.unit_test import main,TestCase
+from picrust.asr_cache import get_asr_cache_keys, get_file_md5,\
+  load_cached_asr_columns, run_asr_with_cache
+from picrust.ancestral_state_reconstruction import run_asr_for_picrust
+from picrust.native_asr import pic_native_for_picrust,\
+  wagner_native_for_picrust
+
+"""
+Tests for asr_cache.py
+"""
+
+class TestAsrCache(TestCase):
+    """Tests of asr_cache.py"""
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='ASR_Cache_Tests')
+        self.cache_dir = join(self.tmp_dir,'cache')
+        self.tree_fp = join(self.tmp_dir,'tree.newick')
+        open(self.tree_fp,'w').write(in_tree1)
+        self.trait_table_fp = join(self.tmp_dir,'traits.tab')
+        open(self.trait_table_fp,'w').write(in_trait1)
+        self.calls = []
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def run_pic(self,table_fp):
+        """Run pic_native, recording the traits that were reconstructed"""
+        self.calls.append(LoadTable(filename=table_fp,header=True,sep='\t').Header[1:])
+        return pic_native_for_picrust(self.tree_fp,table_fp)
+
+    def test_get_asr_cache_keys(self):
+        """get_asr_cache_keys should depend on the tree, method and tip values"""
+        table = LoadTable(filename=self.trait_table_fp,header=True,sep='\t')
+        keys = get_asr_cache_keys('abc','ace_pic',table)
+        self.assertEqual(len(keys),3)
+        #trait1 and trait3 have the same values, under different names
+        self.assertEqual(keys[0],keys[2])
+        self.assertNotEqual(keys[0],keys[1])
+
+        self.assertNotEqual(get_asr_cache_keys('abd','ace_pic',table),keys)
+        self.assertNotEqual(get_asr_cache_keys('abc','ace_ml',table),keys)
+        self.assertNotEqual(get_asr_cache_keys('abc','ace_pic',table,\
+          params={'gain':2}),keys)
+
+        #Row order doesn't matter
+        reordered = table.sorted(columns='trait2')
+        self.assertNotEqual(reordered.getRawData(),table.getRawData())
+        self.assertEqual(get_asr_cache_keys('abc','ace_pic',reordered),keys)
+
+    def test_run_asr_with_cache(self):
+        """run_asr_with_cache should only reconstruct traits that aren't cached"""
+        exp_asr,exp_ci = pic_native_for_picrust(self.tree_fp,self.trait_table_fp)
+
+        asr_table,ci_table = run_asr_with_cache(self.tree_fp,self.trait_table_fp,\
+          'pic_native',self.cache_dir,self.run_pic,tmp_dir=self.tmp_dir)
+        self.assertEqual(asr_table.Header,exp_asr.Header)
+        self.assertEqual(asr_table.getRawData(),exp_asr.getRawData())
+        self.assertEqual(ci_table.getRawData(),exp_ci.getRawData())
+        #trait3 is the same as trait1, so is only reconstructed once
+        self.assertEqual(self.calls,[['trait1','trait2']])
+
+        #Everything is cached the second time
+        asr_table,ci_table = run_asr_with_cache(self.tree_fp,self.trait_table_fp,\
+          'pic_native',self.cache_dir,self.run_pic,tmp_dir=self.tmp_dir)
+        self.assertEqual(self.calls,[['trait1','trait2']])
+        self.assertEqual(asr_table.getRawData(),exp_asr.getRawData())
+        self.assertEqual(ci_table.getRawData(),exp_ci.getRawData())
+
+        #Only new traits are reconstructed
+        open(self.trait_table_fp,'w').write(in_trait2)
+        exp_asr,exp_ci = pic_native_for_picrust(self.tree_fp,self.trait_table_fp)
+        asr_table,ci_table = run_asr_with_cache(self.tree_fp,self.trait_table_fp,\
+          'pic_native',self.cache_dir,self.run_pic,tmp_dir=self.tmp_dir)
+        self.assertEqual(self.calls,[['trait1','trait2'],['trait4']])
+        self.assertEqual(asr_table.Header,exp_asr.Header)
+        self.assertEqual(asr_table.getRawData(),exp_asr.getRawData())
+        self.assertEqual(ci_table.getRawData(),exp_ci.getRawData())
+
+        #A different tree invalidates the cache
+        open(self.tree_fp,'w').write(in_tree1.replace('0.8','0.9'))
+        run_asr_with_cache(self.tree_fp,self.trait_table_fp,\
+          'pic_native',self.cache_dir,self.run_pic,tmp_dir=self.tmp_dir)
+        self.assertEqual(len(self.calls),3)
+
+    def test_run_asr_for_picrust_cache_dir(self):
+        """run_asr_for_picrust should use the cache for methods without CIs"""
+        exp = wagner_native_for_picrust(self.tree_fp,self.trait_table_fp)
+        for i in range(2):
+            asr_table,ci_table = run_asr_for_picrust(self.tree_fp,\
+              self.trait_table_fp,'wagner_native',cache_dir=self.cache_dir)
+            self.assertEqual(ci_table,None)
+            self.assertEqual(asr_table.getRawData(),exp.getRawData())
+
+        table = LoadTable(filename=self.trait_table_fp,header=True,sep='\t')
+        keys = get_asr_cache_keys(get_file_md5(self.tree_fp),'wagner_native',table)
+        cached = load_cached_asr_columns(self.cache_dir,keys)
+        self.assertEqual(sorted(cached),sorted(set(keys)))
+        self.assertEqual(cached[keys[1]]['ci'],None)
+        self.assertEqual(cached[keys[1]]['asr'],\
+          [[row[0],row[2]] for row in exp.getRawData()])
+
+in_tree1 = """(((1:0.1,2:0.2)11:0.6,3:0.8)12:0.2,(4:0.3,D:0.4)10:0.5)14;"""
+
+in_trait1 = """tips\ttrait1\ttrait2\ttrait3
+1\t1\t3\t1
+2\t0\t3\t0
+3\t2\t3\t2
+4\t5\t2\t5
+D\t5\t2\t5
+"""
+
+in_trait2 = """tips\ttrait2\ttrait4\ttrait1
+1\t3\t0\t1
+2\t3\t0\t0
+3\t3\t1\t2
+4\t2\t1\t5
+D\t2\t1\t5
+"""
+
+if __name__ == "__main__":
+    main()
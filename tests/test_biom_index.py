@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from cogent.util.unit_test import main,TestCase
+from cogent.app.util import get_tmp_filename
+from cogent.util.misc import remove_files
+from picrust.biom_index import write_biom_index, read_biom_index_header,\
+  biom_index_is_current, load_subset_from_biom_index, get_biom_index_fp
+from picrust.predict_metagenomes import load_subset_from_biom_str
+
+"""
+Tests for biom_index.py
+"""
+
+class TestBiomIndex(TestCase):
+    """Tests of biom_index.py"""
+
+    def setUp(self):
+        self.table_fp = get_tmp_filename(prefix='Biom_Index_Tests',suffix='.biom')
+        open(self.table_fp,'w').write(genome_table1)
+        self.index_fp = get_biom_index_fp(self.table_fp)
+        self.files_to_remove = [self.table_fp,self.index_fp]
+
+    def tearDown(self):
+        remove_files(self.files_to_remove,error_on_missing=False)
+
+    def test_write_biom_index(self):
+        """write_biom_index should index each sample of the table"""
+        self.assertEqual(self.index_fp,self.table_fp + '.idx')
+        n = write_biom_index(genome_table1,self.index_fp,source_fp=self.table_fp)
+        self.assertEqual(n,4)
+        header,records_start = read_biom_index_header(self.index_fp)
+        self.assertEqual(header['column_ids'],\
+          ['GG_OTU_1','GG_OTU_3','GG_OTU_2','GG_OTU_4'])
+        self.assertEqual(header['shape'],[3,4])
+
+        #Each record holds one sample's non-zero values, in table order
+        index_f = open(self.index_fp)
+        index_f.seek(records_start + header['offsets'][0][0])
+        record = index_f.read(header['offsets'][0][1])
+        self.assertEqual(record.split('\t')[1],'0,1.0;2,0.5\n')
+        index_f.seek(records_start + header['offsets'][3][0])
+        record = index_f.read(header['offsets'][3][1])
+        self.assertEqual(record.split('\t')[1],'\n')
+
+        self.assertRaises(ValueError,write_biom_index,dense_table1,self.index_fp)
+        self.assertRaises(ValueError,write_biom_index,"not biom",self.index_fp)
+
+    def test_load_subset_from_biom_index(self):
+        """load_subset_from_biom_index should match load_subset_from_biom_str"""
+        write_biom_index(genome_table1,self.index_fp,source_fp=self.table_fp)
+        for ids in [['GG_OTU_2'],['GG_OTU_2','GG_OTU_1'],\
+          ['GG_OTU_1','GG_OTU_2','GG_OTU_3','GG_OTU_4']]:
+            exp = load_subset_from_biom_str(genome_table1,ids)
+            obs = load_subset_from_biom_index(self.index_fp,ids,\
+              source_fp=self.table_fp)
+            self.assertEqual(obs,exp)
+            self.assertEqual(obs.SampleIds,exp.SampleIds)
+            self.assertEqual(obs.SampleMetadata,exp.SampleMetadata)
+            self.assertEqual(obs.ObservationMetadata,exp.ObservationMetadata)
+            self.assertEqual(obs._biom_type,exp._biom_type)
+
+        #Samples without any non-zero values can be loaded
+        #(load_subset_from_biom_str fails for these)
+        obs = load_subset_from_biom_index(self.index_fp,['GG_OTU_4'])
+        self.assertEqual(obs.SampleIds,('GG_OTU_4',))
+        self.assertEqual(obs.SampleMetadata[0]['NSTI'],0.3)
+        self.assertEqual(obs.sum(),0)
+
+        self.assertRaises(KeyError,load_subset_from_biom_index,\
+          self.index_fp,['GG_OTU_1','GG_OTU_5'])
+
+    def test_biom_index_is_current(self):
+        """biom_index_is_current should detect missing and stale indices"""
+        self.assertFalse(biom_index_is_current(self.index_fp,self.table_fp))
+        write_biom_index(genome_table1,self.index_fp,source_fp=self.table_fp)
+        self.assertTrue(biom_index_is_current(self.index_fp,self.table_fp))
+
+        open(self.table_fp,'w').write(genome_table1.replace('0.5','0.25'))
+        self.assertFalse(biom_index_is_current(self.index_fp,self.table_fp))
+        self.assertRaises(ValueError,load_subset_from_biom_index,\
+          self.index_fp,['GG_OTU_1'],source_fp=self.table_fp)
+
+        #Edits that keep the size of a large table are detected too
+        large_table = genome_table1.replace('PI-CRUST 0.9.1-dev','x'*100000).\
+          replace('with a comma','x'*100000)
+        open(self.table_fp,'w').write(large_table)
+        write_biom_index(large_table,self.index_fp,source_fp=self.table_fp)
+        self.assertTrue(biom_index_is_current(self.index_fp,self.table_fp))
+        open(self.table_fp,'w').write(large_table.replace('[0,1,2.0]','[0,1,4.0]'))
+        self.assertFalse(biom_index_is_current(self.index_fp,self.table_fp))
+
+        #Files that aren't indices are never current
+        self.assertFalse(biom_index_is_current(self.table_fp,self.table_fp))
+
+genome_table1 = """{"id": "None","format": "Biological Observation Matrix 1.0.0","format_url": "http://biom-format.org","type": "Gene table","generated_by": "PI-CRUST 0.9.1-dev","date": "2013-03-08T10:15:02.181093","matrix_type": "sparse","matrix_element_type": "float","shape": [3, 4],"data": [[0,0,1.0],[0,1,2.0],[0,2,3.0],[1,1,1.0],[2,0,0.5],[2,2,1.0]],"rows": [{"id": "f1", "metadata": {"KEGG_Description": "ko00100    Steroid biosynthesis, with a comma"}},{"id": "f2", "metadata": null},{"id": "f3", "metadata": null}],"columns": [{"id": "GG_OTU_1", "metadata": {"NSTI": 0.1}},{"id": "GG_OTU_3", "metadata": {"NSTI": 0.0}},{"id": "GG_OTU_2", "metadata": {"NSTI": 0.25}},{"id": "GG_OTU_4", "metadata": {"NSTI": 0.3}}]}"""
+
+dense_table1 = """{"rows": [{"id": "f1", "metadata": null}], "format": "Biological Observation Matrix v0.9", "data": [[1.0, 2.0]], "columns": [{"id": "GG_OTU_1", "metadata": null}, {"id": "GG_OTU_2", "metadata": null}], "generated_by": "QIIME 1.4.0-dev, svn revision 2753", "matrix_type": "dense", "shape": [1, 2], "format_url": "http://www.qiime.org/svn_documentation/documentation/biom_format.html", "date": "2012-02-22T20:49:58.258296", "type": "Gene table", "id": null, "matrix_element_type": "float"}"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from cogent.util.unit_test import main,TestCase
+from cogent.parse.tree import DndParser
+from numpy import array, isnan
+from picrust.compact_tree import flatten_tree, get_root_distances,\
+  get_nearest_marked_ancestors, get_trait_matrix, get_nearest_marked_nodes,\
+  get_ancestor_mask, CompactTree, parse_newick, as_compact_tree
+from picrust.format_tree_and_trait_table import set_label_conversion_fns,\
+  fix_tree_labels
+from picrust.predict_traits import assign_traits_to_tree,\
+  predict_traits_from_ancestors_vectorized,\
+  calc_nearest_sequenced_taxon_index_by_dp
+
+"""
+Tests for compact_tree.py
+"""
+
+class TestCompactTree(TestCase):
+    """Tests of compact_tree.py"""
+
+    def setUp(self):
+        self.SimpleTree = \
+          DndParser("((A:0.02,B:0.01)E:0.05,(C:0.01,D:0.01)F:0.05)root;")
+
+    def test_flatten_tree(self):
+        """flatten_tree returns preorder nodes, parents and branch lengths"""
+        nodes,parents,lengths = flatten_tree(self.SimpleTree)
+        self.assertEqual([n.Name for n in nodes],\
+          ['root','E','A','B','F','C','D'])
+        self.assertEqual(parents,array([-1,0,1,1,0,4,4]))
+        self.assertFloatEqual(lengths,\
+          array([0.0,0.05,0.02,0.01,0.05,0.01,0.01]))
+
+        #Missing branch lengths take the default length
+        tree = DndParser("((A,B:0.01)E:0.05,C:0.1)root;")
+        nodes,parents,lengths = flatten_tree(tree,default_length=1.0)
+        self.assertFloatEqual(lengths,array([1.0,0.05,1.0,0.01,0.1]))
+
+    def test_get_root_distances(self):
+        """get_root_distances matches PhyloNode.distance to the root"""
+        nodes,parents,lengths = flatten_tree(self.SimpleTree)
+        obs = get_root_distances(parents,lengths)
+        exp = array([n.distance(self.SimpleTree) for n in nodes])
+        self.assertFloatEqual(obs,exp)
+
+    def test_get_nearest_marked_ancestors(self):
+        """get_nearest_marked_ancestors finds the closest marked ancestor"""
+        tree = DndParser("(((A:1,B:1)I3:1,C:1)I2:1,D:1)I1;")
+        nodes,parents,lengths = flatten_tree(tree)
+        #preorder: I1,I2,I3,A,B,C,D
+        is_marked = array([n.Name in ['I1','I3'] for n in nodes])
+        obs = get_nearest_marked_ancestors(parents,is_marked)
+        self.assertEqual(obs,array([-1,0,0,2,2,0,0]))
+
+    def test_get_ancestor_mask(self):
+        """get_ancestor_mask flags nodes and their paths to the root"""
+        tree = DndParser("(((A:1,B:1)I3:1,C:1)I2:1,D:1)I1;")
+        nodes,parents,lengths = flatten_tree(tree)
+        #preorder: I1,I2,I3,A,B,C,D
+        self.assertEqual(get_ancestor_mask(parents,[3]),\
+          array([True,True,True,True,False,False,False]))
+        self.assertEqual(get_ancestor_mask(parents,[5,6]),\
+          array([True,True,False,False,False,True,True]))
+        self.assertEqual(get_ancestor_mask(parents,[]),array([False]*7))
+
+    def test_get_trait_matrix(self):
+        """get_trait_matrix collects node traits into a single matrix"""
+        nodes,parents,lengths = flatten_tree(self.SimpleTree)
+        traits = {'E':[1.0,2.0],'D':[0.0,3.0]}
+        for n in nodes:
+            n.Reconstruction = traits.get(n.Name,None)
+        trait_rows,trait_matrix = get_trait_matrix(nodes)
+        self.assertEqual(trait_rows,array([-1,0,-1,-1,-1,-1,1]))
+        self.assertFloatEqual(trait_matrix,array([[1.0,2.0],[0.0,3.0]]))
+
+        #Ragged trait arrays are an error
+        nodes[2].Reconstruction = [1.0]
+        self.assertRaises(ValueError,get_trait_matrix,nodes)
+
+    def test_get_nearest_marked_nodes(self):
+        """get_nearest_marked_nodes finds the closest marked node to each node"""
+        nodes,parents,lengths = flatten_tree(self.SimpleTree)
+        #preorder: root,E,A,B,F,C,D
+        is_marked = array([n.Name in ['A','D'] for n in nodes])
+        nearest,distances = get_nearest_marked_nodes(parents,lengths,is_marked)
+        self.assertEqual(nearest,array([6,2,2,2,6,6,6]))
+        self.assertFloatEqual(distances,\
+          array([0.06,0.02,0.0,0.03,0.01,0.02,0.0]))
+
+        #Without self, marked nodes must look elsewhere
+        nearest,distances = get_nearest_marked_nodes(parents,lengths,\
+          is_marked,include_self=False)
+        self.assertEqual(nearest[[2,6]],array([6,2]))
+        self.assertFloatEqual(distances[[2,6]],array([0.13,0.13]))
+        self.assertEqual(nearest[[3,5]],array([2,6]))
+
+        #Ties go to the first node in preorder
+        tree = DndParser("((A:1,B:1)E:1,(C:1,D:1)F:1)root;")
+        nodes,parents,lengths = flatten_tree(tree)
+        is_marked = array([n.Name in ['A','B','C'] for n in nodes])
+        nearest,distances = get_nearest_marked_nodes(parents,lengths,\
+          is_marked,include_self=False)
+        self.assertEqual(nearest,array([2,2,3,2,5,2,5]))
+
+        #Nodes with nothing to find get -1
+        is_marked = array([n.Name == 'A' for n in nodes])
+        nearest,distances = get_nearest_marked_nodes(parents,lengths,\
+          is_marked,include_self=False)
+        self.assertEqual(nearest[2],-1)
+        self.assertEqual(distances[2],float('inf'))
+
+    def test_compact_tree(self):
+        """CompactTree stores preorder arrays matching the PhyloNode tree"""
+        tree = CompactTree.from_phylo_node(self.SimpleTree)
+        self.assertEqual(len(tree),7)
+        self.assertEqual(tree.get_node_names(),\
+          ['root','E','A','B','F','C','D'])
+        self.assertEqual(tree.parents,array([-1,0,1,1,0,4,4]))
+        self.assertFloatEqual(tree.get_lengths(),\
+          array([0.0,0.05,0.02,0.01,0.05,0.01,0.01]))
+        self.assertEqual(tree.get_tip_mask(),\
+          array([False,False,True,True,False,True,True]))
+        self.assertEqual(tree.get_children(0),[1,4])
+        self.assertEqual(tree.get_children(2),[])
+        self.assertEqual(tree.getTipNames(),self.SimpleTree.getTipNames())
+        self.assertEqual(tree.get_node_index()['F'],4)
+
+        #postorder matches PhyloNode.postorder
+        names = tree.get_node_names()
+        self.assertEqual([names[i] for i in tree.postorder],\
+          [n.Name for n in self.SimpleTree.postorder()])
+
+        #Missing lengths and names survive a round trip
+        newick = "((A,B:0.01):0.05,(C:0.1)F)root;"
+        tree = CompactTree.from_phylo_node(DndParser(newick))
+        self.assertFloatEqual(tree.get_lengths(default_length=1.0),\
+          array([1.0,0.05,1.0,0.01,1.0,0.1]))
+        self.assertEqual(tree.get_node_names()[1],None)
+        self.assertEqual(tree.to_phylo_node().getNewick(with_distances=True),\
+          DndParser(newick).getNewick(with_distances=True))
+
+        #Nodes must be in preorder
+        self.assertRaises(ValueError,CompactTree,[-1,2,0],[0,1,1],['a','b','c'])
+        self.assertRaises(ValueError,CompactTree,[-1,0],[0],['a','b'])
+
+    def test_compact_tree_assign_traits(self):
+        """CompactTree.assign_traits matches assign_traits_to_tree"""
+        tree = CompactTree.from_phylo_node(\
+          DndParser("((A:0.02,'B':0.01)E:0.05,(C:0.01,D:0.01)F:0.05)root;"))
+        rows,matrix = tree.get_trait_matrix()
+        self.assertEqual(rows,array([-1]*7))
+
+        traits = {'E':[1.0,2.0],'B':[0.0,3.0],'root':[5.0,5.0]}
+        self.assertTrue(assign_traits_to_tree(traits,tree) is tree)
+        rows,matrix = tree.get_trait_matrix()
+        self.assertEqual(rows,array([0,1,-1,2,-1,-1,-1]))
+        self.assertFloatEqual(matrix,array([[5.0,5.0],[1.0,2.0],[0.0,3.0]]))
+        #Other labels are stored separately
+        self.assertEqual(tree.get_trait_matrix('lower_bound')[0],array([-1]*7))
+
+        traits['B'] = [1.0]
+        self.assertRaises(ValueError,tree.assign_traits,traits)
+
+    def test_compact_tree_predictions(self):
+        """Vectorized predictions and NSTI are the same for CompactTree"""
+        traits = {'A':array([1.0,2.0]),'D':array([0.0,3.0]),\
+          'root':array([1.0,1.0])}
+        tips = ['A','B','C','D']
+        tree = CompactTree.from_phylo_node(self.SimpleTree)
+        assign_traits_to_tree(traits,tree)
+        assign_traits_to_tree(traits,self.SimpleTree)
+
+        exp = predict_traits_from_ancestors_vectorized(self.SimpleTree,tips)
+        obs = predict_traits_from_ancestors_vectorized(tree,tips)
+        self.assertEqual(sorted(obs),tips)
+        for tip in tips:
+            self.assertFloatEqual(obs[tip],exp[tip])
+
+        exp = calc_nearest_sequenced_taxon_index_by_dp(self.SimpleTree,\
+          limit_to_tips=tips,verbose=False)
+        obs = calc_nearest_sequenced_taxon_index_by_dp(tree,\
+          limit_to_tips=tips,verbose=False)
+        self.assertFloatEqual(obs[0],exp[0])
+        self.assertEqual(sorted(obs[1]),sorted(exp[1]))
+        for tip in exp[1]:
+            self.assertFloatEqual(obs[1][tip],exp[1][tip])
+
+    def test_compact_tree_phylo_node_traits(self):
+        """CompactTree converts traits to and from PhyloNode attributes"""
+        traits = {'E':array([1.0,2.0]),'D':array([0.0,3.0])}
+        assign_traits_to_tree(traits,self.SimpleTree)
+        tree = CompactTree.from_phylo_node(self.SimpleTree,\
+          trait_labels=['Reconstruction','lower_bound'])
+        rows,matrix = tree.get_trait_matrix()
+        self.assertEqual(rows,array([-1,0,-1,-1,-1,-1,1]))
+        self.assertFloatEqual(matrix,array([[1.0,2.0],[0.0,3.0]]))
+        self.assertEqual(tree.get_trait_matrix('lower_bound')[0],array([-1]*7))
+
+        obs = tree.to_phylo_node(trait_labels=['Reconstruction'])
+        for exp_node,obs_node in zip(self.SimpleTree.preorder(),obs.preorder()):
+            if exp_node.Reconstruction is None:
+                self.assertEqual(obs_node.Reconstruction,None)
+            else:
+                self.assertFloatEqual(obs_node.Reconstruction,\
+                  exp_node.Reconstruction)
+
+    def test_as_compact_tree(self):
+        """as_compact_tree converts PhyloNode trees and keeps CompactTrees"""
+        assign_traits_to_tree({'E':array([1.0,2.0])},self.SimpleTree)
+        tree = as_compact_tree(self.SimpleTree,['Reconstruction'])
+        self.assertEqual(tree.get_node_names(),\
+          [n.Name for n in self.SimpleTree.preorder()])
+        self.assertEqual(tree.get_trait_matrix()[0],array([-1,0,-1,-1,-1,-1,-1]))
+        self.assertTrue(as_compact_tree(tree) is tree)
+
+    def test_parse_newick(self):
+        """parse_newick reads the same trees as DndParser"""
+        parents,lengths,names = parse_newick(\
+          "((A:0.02,B:0.01)E:0.05,(C:0.01,D:0.01)F:0.05)root;")
+        self.assertEqual(parents,[-1,0,1,1,0,4,4])
+        self.assertEqual(names,['root','E','A','B','F','C','D'])
+        self.assertFloatEqual(lengths[1:],[0.05,0.02,0.01,0.05,0.01,0.01])
+        self.assertTrue(isnan(lengths[0]))
+
+        #Lines of a file are joined, and text before the tree is ignored
+        self.assertEqual(parse_newick(["tree = (A,\n","B)R;\n"])[2],\
+          ['R','A','B'])
+
+        for newick in ["(A,,B);","((,),(A,));","( A , B ) R ;",\
+          "('a b,c':1,'x:y'D:2)'q r';","((A,B)'I 1',(C,D)I2)'ro''ot';",\
+          "(A B:1e-3,'C_D':-2)X:0.5;","(A,(B,(C,(D))));"]:
+            for fns in [[],set_label_conversion_fns()]:
+                exp = fix_tree_labels(DndParser(newick),fns)
+                obs = CompactTree.from_newick(newick,fns).to_phylo_node()
+                self.assertEqual(obs.getNewick(with_distances=True),\
+                  exp.getNewick(with_distances=True))
+                self.assertEqual([n.Name for n in obs.preorder()],\
+                  [n.Name for n in exp.preorder()])
+
+        #Label cleanup is applied as names are read
+        self.assertEqual(parse_newick("('a b':1,'c;d':2)'R';",\
+          set_label_conversion_fns())[2],['R','a_b','c_d'])
+
+        #Deep trees need no recursion
+        depth = 20000
+        tree = CompactTree.from_newick('('*depth + 'A' + ')'*depth + ';')
+        self.assertEqual(len(tree),depth + 1)
+        self.assertEqual(tree.parents[-1],depth - 1)
+        self.assertEqual(tree.postorder[-1],0)
+
+        for newick in ["((A,B);","(A,B));","A,B;","",")(A,B"]:
+            self.assertRaises(ValueError,parse_newick,newick)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,9 @@ __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
 
 
+from os import remove
 from cogent.util.unit_test import main, TestCase
+from cogent.app.util import get_tmp_filename
 from cogent import LoadTree
 from cogent.parse.tree import DndParser
 from picrust.format_tree_and_trait_table import reformat_tree_and_trait_table,\
@@ -20,7 +22,8 @@ from picrust.format_tree_and_trait_table import reformat_tree_and_trait_table,\
   yield_trait_table_fields,ensure_root_is_bifurcating,\
   filter_tree_tips_by_presence_in_table,print_node_summary_table,\
   add_to_filename,make_id_mapping_dict,make_translate_conversion_fn,\
-  make_char_translation_fn,remove_spaces, format_tree_node_names
+  make_char_translation_fn,remove_spaces, format_tree_node_names,\
+  load_picrust_tree
 
 
 """
@@ -66,6 +69,22 @@ class TestFormat(TestCase):
 
 
 
+    def test_load_picrust_tree(self):
+        """load_picrust_tree cleans labels, and can return a CompactTree"""
+        tree_fp = get_tmp_filename(prefix='load_picrust_tree_',suffix='.nwk')
+        open(tree_fp,'w').write(\
+          "(('E coli':0.02,'S;typhimurium':0.01)'Gamma':0.05,C:0.1)root;")
+        try:
+            tree = load_picrust_tree(tree_fp)
+            compact_tree = load_picrust_tree(tree_fp,compact=True)
+        finally:
+            remove(tree_fp)
+        exp = ['root','Gamma','E_coli','S_typhimurium','C']
+        self.assertEqual([n.Name for n in tree.preorder()],exp)
+        self.assertEqual(compact_tree.get_node_names(),exp)
+        self.assertEqual(compact_tree.to_phylo_node().getNewick(with_distances=True),\
+          tree.getNewick(with_distances=True))
+
     def test_nexus_lines_from_tree(self):
         """Nexus lines from tree should return NEXUS formatted lines..."""
         obs =  nexus_lines_from_tree(self.SimpleTree)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import join
+from numpy import array
+from cogent.parse.tree import DndParser
+from cogent.util.unit_test import main,TestCase
+from picrust.incremental import update_pic_reconstruction_for_picrust,\
+  get_nodes_to_repredict, load_predictions_from_biom
+from picrust.native_asr import pic_native_for_picrust
+from picrust.predict_traits import assign_traits_to_tree,\
+  predict_traits_from_ancestors, biom_table_from_predictions
+from picrust.util import format_biom_table
+
+"""
+Tests for incremental.py
+"""
+
+class TestIncremental(TestCase):
+    """Tests of incremental.py"""
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='Incremental_Tests')
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def write(self,name,data):
+        fp = join(self.tmp_dir,name)
+        open(fp,'w').write(data)
+        return fp
+
+    def test_update_pic_reconstruction_for_picrust(self):
+        """update_pic_reconstruction_for_picrust should match a full reconstruction"""
+        old_tree_fp = self.write('old.newick',old_tree)
+        old_traits_fp = self.write('old.tab',old_traits)
+        old_asr,old_ci = pic_native_for_picrust(old_tree_fp,old_traits_fp)
+        old_asr_fp = join(self.tmp_dir,'old_asr.tab')
+        old_asr.writeToFile(old_asr_fp,sep='\t')
+
+        new_tree_fp = self.write('new.newick',new_tree)
+        new_traits_fp = self.write('new.tab',new_traits)
+        exp_asr,exp_ci = pic_native_for_picrust(new_tree_fp,new_traits_fp)
+        obs_asr,obs_ci = update_pic_reconstruction_for_picrust(new_tree_fp,\
+          new_traits_fp,old_traits_fp,old_asr_fp)
+        self.assertEqual(obs_asr.getRawData(),exp_asr.getRawData())
+        self.assertEqual(obs_ci.getRawData(),exp_ci.getRawData())
+
+        #Values of nodes off the paths to the root come from the old table
+        #(preorder: 14,12,11,13,10, of which 14, 12 and 13 are recalculated)
+        data = open(old_asr_fp).read().replace('\n10\t','\n10\t1')
+        open(old_asr_fp,'w').write(data)
+        obs_asr,obs_ci = update_pic_reconstruction_for_picrust(new_tree_fp,\
+          new_traits_fp,old_traits_fp,old_asr_fp)
+        self.assertFloatEqual(obs_asr.getRawData()[4][1],15.0)
+        self.assertEqual(obs_asr.getRawData()[1:4],exp_asr.getRawData()[1:4])
+
+        #Removed tips can't be updated
+        self.assertRaises(ValueError,update_pic_reconstruction_for_picrust,\
+          old_tree_fp,old_traits_fp,new_traits_fp,old_asr_fp)
+
+    def test_get_nodes_to_repredict(self):
+        """get_nodes_to_repredict should find tips whose inputs changed"""
+        tree = DndParser(ref_tree)
+        old = {'I1':array([1.0]),'I2':array([2.0]),'A':array([1.0])}
+        assign_traits_to_tree(old,tree,trait_label='previous_Reconstruction')
+        tips = ['A','B','C','D','E','F']
+
+        assign_traits_to_tree(old,tree)
+        self.assertEqual(get_nodes_to_repredict(tree,tips),[])
+
+        #C is a new genome: C and its sibling D are affected
+        new = dict(old)
+        new['C'] = array([3.0])
+        assign_traits_to_tree(new,tree)
+        self.assertEqual(get_nodes_to_repredict(tree,tips),['C','D'])
+
+        #I2 changed: the tips with I2 as their nearest reconstructed ancestor
+        new = dict(old)
+        new['I2'] = array([4.0])
+        assign_traits_to_tree(new,tree)
+        self.assertEqual(get_nodes_to_repredict(tree,tips),['A','B'])
+
+        #I1 changed: the tips without a closer reconstructed ancestor
+        new = dict(old)
+        new['I1'] = array([4.0])
+        assign_traits_to_tree(new,tree)
+        self.assertEqual(get_nodes_to_repredict(tree,tips),['C','D','E','F'])
+
+        #I3 is newly reconstructed: C and D have a new nearest ancestor
+        new = dict(old)
+        new['I3'] = array([2.0])
+        assign_traits_to_tree(new,tree)
+        self.assertEqual(get_nodes_to_repredict(tree,tips),['C','D'])
+
+        #Predictions for the other tips are unchanged
+        exp = predict_traits_from_ancestors(tree,tips)
+        assign_traits_to_tree(old,tree)
+        previous = predict_traits_from_ancestors(tree,tips)
+        for tip in ['A','B','E','F']:
+            self.assertEqual(previous[tip],exp[tip])
+
+    def test_load_predictions_from_biom(self):
+        """load_predictions_from_biom should load predictions in trait order"""
+        predictions = {'A':array([1.0,2.0]),'B':array([3.0,0.0])}
+        table = biom_table_from_predictions(predictions,['K1','K2'],\
+          convert_to_int=False)
+        biom_fp = self.write('predictions.biom',format_biom_table(table))
+        obs = load_predictions_from_biom(biom_fp,['K2','K1'])
+        self.assertEqual(sorted(obs),['A','B'])
+        self.assertEqual(obs['A'],array([2.0,1.0]))
+        self.assertEqual(obs['B'],array([0.0,3.0]))
+        self.assertRaises(ValueError,load_predictions_from_biom,biom_fp,['K3'])
+
+old_tree = """(((1:0.1,2:0.2)11:0.6,3:0.8)12:0.2,(4:0.3,D:0.4)10:0.5)14;"""
+
+new_tree = """(((1:0.1,2:0.2)11:0.6,(3:0.8,5:0.3)13:0.1)12:0.2,(4:0.3,D:0.4)10:0.5)14;"""
+
+old_traits = """tips\ttrait1\ttrait2
+1\t1\t3
+2\t0\t3
+3\t2\t3
+4\t5\t2
+D\t5\t2
+"""
+
+new_traits = """tips\ttrait1\ttrait2
+1\t1\t3
+2\t0\t3
+3\t2\t3
+4\t5\t2
+D\t5\t2
+5\t7\t0
+"""
+
+ref_tree = """((A:0.1,B:0.2)I2:0.3,((C:0.1,D:0.2)I3:0.2,(E:0.1,F:0.1)I4:0.2)I5:0.1)I1;"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from cogent.util.unit_test import main,TestCase
+from cogent.app.util import get_tmp_filename
+from cogent.util.misc import remove_files
+from numpy import array, float32
+from biom.table import table_factory, SparseGeneTable, SparseOTUTable,\
+  DenseOTUTable
+from picrust.matrix_cache import write_matrix_cache, load_matrix_cache,\
+  is_matrix_cache_file, biom_table_to_matrix_cache
+
+"""
+Tests for matrix_cache.py
+"""
+
+class TestMatrixCache(TestCase):
+    """Tests of matrix_cache.py"""
+
+    def setUp(self):
+        self.row_ids = ['A','B','C']
+        self.column_ids = ['K1','K2','K3','K4']
+        self.matrix = array([[0,1,0,2],[0,0,0,0],[3,0,4.5,0]])
+
+        self.gene_table = table_factory(self.matrix.T,self.row_ids,\
+          self.column_ids,[{'NSTI':0.1},{'NSTI':0.2},{'NSTI':0.3}],\
+          [{'KEGG_Pathways':[['a','b']]},{'KEGG_Pathways':[['c']]},\
+          {'KEGG_Pathways':[['d']]},{'KEGG_Pathways':[['e']]}],\
+          constructor=SparseGeneTable)
+
+        self.cache_fp = get_tmp_filename(prefix='Matrix_Cache_Tests',suffix='.pmc')
+        self.text_fp = get_tmp_filename(prefix='Matrix_Cache_Tests',suffix='.txt')
+        open(self.text_fp,'w').write("not a cache\n")
+        self.files_to_remove = [self.cache_fp,self.text_fp]
+
+    def tearDown(self):
+        remove_files(self.files_to_remove,error_on_missing=False)
+
+    def test_write_and_load_matrix_cache(self):
+        """write_matrix_cache output should be reloaded by load_matrix_cache"""
+        for matrix_type in ['dense','csr']:
+            write_matrix_cache(self.cache_fp,self.row_ids,self.column_ids,\
+              self.matrix,matrix_type=matrix_type)
+            self.assertTrue(is_matrix_cache_file(self.cache_fp))
+
+            cache = load_matrix_cache(self.cache_fp)
+            self.assertEqual(cache.matrix_type,matrix_type)
+            self.assertEqual(cache.shape,(3,4))
+            self.assertEqual(cache.row_ids,self.row_ids)
+            self.assertEqual(cache.column_ids,self.column_ids)
+            self.assertEqual(cache.get_row_index(),{'A':0,'B':1,'C':2})
+            self.assertFloatEqual(cache.to_dense(),self.matrix)
+            self.assertFloatEqual(cache.get_rows([2,0]),self.matrix[[2,0]])
+
+        #Dense caches are memory-mapped rather than copied
+        write_matrix_cache(self.cache_fp,self.row_ids,self.column_ids,\
+          self.matrix,dtype=float32)
+        cache = load_matrix_cache(self.cache_fp)
+        self.assertEqual(cache.to_dense().dtype,float32)
+        self.assertFalse(cache.to_dense().flags.writeable)
+
+    def test_write_matrix_cache_errors(self):
+        """write_matrix_cache should check its input"""
+        self.assertRaises(ValueError,write_matrix_cache,self.cache_fp,\
+          self.row_ids,self.column_ids,self.matrix,matrix_type='bad')
+        #Wrong number of columns
+        self.assertRaises(ValueError,write_matrix_cache,self.cache_fp,\
+          self.row_ids,self.column_ids[:3],self.matrix)
+        #Wrong number of rows
+        self.assertRaises(ValueError,write_matrix_cache,self.cache_fp,\
+          self.row_ids[:2],self.column_ids,self.matrix)
+
+    def test_is_matrix_cache_file(self):
+        """is_matrix_cache_file should only recognize cache files"""
+        self.assertFalse(is_matrix_cache_file(self.text_fp))
+        self.assertFalse(is_matrix_cache_file(self.cache_fp))
+        self.assertRaises(ValueError,load_matrix_cache,self.text_fp)
+
+    def test_biom_table_round_trip(self):
+        """biom tables should be unchanged by conversion to and from a cache"""
+        for matrix_type in [None,'dense','csr']:
+            biom_table_to_matrix_cache(self.gene_table,self.cache_fp,\
+              matrix_type=matrix_type)
+            cache = load_matrix_cache(self.cache_fp)
+            obs = cache.to_biom_table()
+            self.assertEqual(obs.SampleIds,self.gene_table.SampleIds)
+            self.assertEqual(obs.ObservationIds,self.gene_table.ObservationIds)
+            self.assertEqual(obs.SampleMetadata,self.gene_table.SampleMetadata)
+            self.assertEqual(obs.ObservationMetadata,\
+              self.gene_table.ObservationMetadata)
+            self.assertEqual(obs._biom_type,"Gene table")
+            for sample_id in self.row_ids:
+                self.assertFloatEqual(obs.sampleData(sample_id),\
+                  self.gene_table.sampleData(sample_id))
+
+        self.assertEqual(load_matrix_cache(self.cache_fp).matrix_type,'csr')
+
+    def test_to_biom_table_subset(self):
+        """to_biom_table should load only the requested rows"""
+        for matrix_type in ['dense','csr']:
+            write_matrix_cache(self.cache_fp,self.row_ids,self.column_ids,\
+              self.matrix,matrix_type=matrix_type)
+            cache = load_matrix_cache(self.cache_fp)
+            #Rows stay in cache order
+            obs = cache.to_biom_table(['C','A'])
+            self.assertEqual(obs.SampleIds,('A','C'))
+            self.assertFloatEqual(obs.sampleData('C'),self.matrix[2])
+
+            #All zero subsets still work
+            obs = cache.to_biom_table(['B'])
+            self.assertFloatEqual(obs.sampleData('B'),self.matrix[1])
+
+            self.assertRaises(KeyError,cache.to_biom_table,['A','Z'])
+
+        #The default table type is an OTU table
+        self.assertTrue(isinstance(cache.to_biom_table(),SparseOTUTable))
+        write_matrix_cache(self.cache_fp,self.row_ids,self.column_ids,\
+          self.matrix)
+        self.assertTrue(isinstance(load_matrix_cache(self.cache_fp).to_biom_table(),\
+          DenseOTUTable))
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,12 @@ __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
  
 
+from cStringIO import StringIO
 from cogent.util.unit_test import TestCase, main
 from biom.parse import parse_biom_table_str
 from biom.table import DenseTable
-from picrust.metagenome_contributions import partition_metagenome_contributions
+from picrust.metagenome_contributions import partition_metagenome_contributions,\
+  yield_metagenome_contributions, write_metagenome_contributions
 from picrust.predict_metagenomes import predict_metagenomes,\
   calc_nsti,get_overlapping_ids, extract_otu_and_genome_data
 
@@ -93,6 +95,58 @@ class PartitionMetagenomeTests(TestCase):
         #Having validated that this looks OK, just compare to hand-checked result
         self.assertEqual(obs_text,exp_text)
        
+    def test_yield_metagenome_contributions(self):
+        """yield_metagenome_contributions yields the partition_metagenome_contributions rows"""
+        obs = yield_metagenome_contributions(self.otu_table1,self.genome_table1,\
+          verbose=False)
+        self.assertFalse(isinstance(obs,list))
+        exp = partition_metagenome_contributions(self.otu_table1,\
+          self.genome_table1,verbose=False)
+        self.assertEqual(list(obs),exp)
+
+        #Without removing zero rows, every gene/sample/OTU combination is output
+        obs = list(yield_metagenome_contributions(self.otu_table1,\
+          self.genome_table1,remove_zero_rows=False,verbose=False))
+        self.assertEqual(len(obs),1+3*4*3)
+        self.assertEqual(obs[1][:3],["f1","Sample1","GG_OTU_1"])
+        nonzero_rows = [r for r in obs[1:] if r[5] != 0.0]
+        self.assertEqual(nonzero_rows,exp[1:])
+
+        #Results can be limited to a few functions
+        obs = list(yield_metagenome_contributions(self.otu_table1,\
+          self.genome_table1,limit_to_functions=["f3"],verbose=False))
+        self.assertEqual(obs[1:],[r for r in exp[1:] if r[0] == "f3"])
+        #An empty filter is reported when called, before any rows are read
+        self.assertRaises(ValueError,yield_metagenome_contributions,\
+          self.otu_table1,self.genome_table1,limit_to_functions=["f4"],\
+          verbose=False)
+
+    def test_write_metagenome_contributions(self):
+        """write_metagenome_contributions writes rows as tab-delimited text"""
+        rows = partition_metagenome_contributions(self.otu_table1,\
+          self.genome_table1,verbose=False)
+        out_f = StringIO()
+        write_metagenome_contributions(iter(rows),out_f)
+        exp_text = "\n".join(["\t".join(map(str,r.split())) for r in\
+          self.predicted_gene_partition_table.split('\n')])
+        self.assertEqual(out_f.getvalue(),exp_text)
+
+        #The output is flushed once before each gene after the header
+        flushed_at = []
+        class FlushRecorder(object):
+            def __init__(self):
+                self.text = []
+            def write(self,text):
+                self.text.append(text)
+            def flush(self):
+                flushed_at.append(''.join(self.text).count('\n'))
+        write_metagenome_contributions(rows,FlushRecorder())
+        self.assertEqual(flushed_at,[1,10,12])
+
+        flushed_at = []
+        write_metagenome_contributions(rows,FlushRecorder(),flush_per_gene=False)
+        self.assertEqual(flushed_at,[])
+
 otu_table1 = """{"rows": [{"id": "GG_OTU_1", "metadata": null}, {"id": "GG_OTU_2", "metadata": null}, {"id": "GG_OTU_3", "metadata": null}], "format": "Biological Observation Matrix v0.9", "data": [[0, 0, 1.0], [0, 1, 2.0], [0, 2, 3.0], [0, 3, 5.0], [1, 0, 5.0], [1, 1, 1.0], [1, 3, 2.0], [2, 2, 1.0], [2, 3, 4.0]], "columns": [{"id": "Sample1", "metadata": null}, {"id": "Sample2", "metadata": null}, {"id": "Sample3", "metadata": null}, {"id": "Sample4", "metadata": null}], "generated_by": "QIIME 1.4.0-dev, svn revision 2753", "matrix_type": "sparse", "shape": [3, 4], "format_url": "http://www.qiime.org/svn_documentation/documentation/biom_format.html", "date": "2012-02-22T20:50:05.024661", "type": "OTU table", "id": null, "matrix_element_type": "float"}"""
 
 genome_table1 = """{"rows": [{"id": "f1", "metadata": null}, {"id": "f2", "metadata": null}, {"id": "f3", "metadata": null}], "format": "Biological Observation Matrix v0.9", "data": [[0, 0, 1.0], [0, 1, 2.0], [0, 2, 3.0], [1, 1, 1.0], [2, 2, 1.0]], "columns": [{"id": "GG_OTU_1", "metadata": null}, {"id": "GG_OTU_3", "metadata": null}, {"id": "GG_OTU_2", "metadata": null}], "generated_by": "QIIME 1.4.0-dev, svn revision 2753", "matrix_type": "sparse", "shape": [3, 3], "format_url": "http://www.qiime.org/svn_documentation/documentation/biom_format.html", "date": "2012-02-22T20:49:58.258296", "type": "OTU table", "id": null, "matrix_element_type": "float"}"""
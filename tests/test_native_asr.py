@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from cogent.util.unit_test import main,TestCase
+from cogent.app.util import get_tmp_filename
+from cogent.util.misc import remove_files
+from cogent.parse.tree import DndParser
+from cogent.util.table import Table
+from numpy import array, inf, nan, sqrt, log, pi
+from picrust.compact_tree import flatten_tree, CompactTree
+from picrust.native_asr import load_asr_tree_and_traits, make_asr_table,\
+  wagner_parsimony, wagner_native_for_picrust, make_asr_ci_table,\
+  pic_reconstruction, pic_native_for_picrust, student_t_quantile,\
+  brownian_motion_reconstruction, bm_native_for_picrust, format_r_values,\
+  _linear_cost_transform
+
+"""
+Tests for native_asr.py
+"""
+
+class TestNativeAsr(TestCase):
+    """Tests of native_asr.py"""
+
+    def setUp(self):
+        self.files_to_remove = []
+        self.in_tree1_fp = self.write_tmp_file(in_tree1,'.nwk')
+        self.in_tree2_fp = self.write_tmp_file(in_tree2,'.nwk')
+        self.in_trait1_fp = self.write_tmp_file(in_trait1,'.tsv')
+        self.in_trait3_fp = self.write_tmp_file(in_trait3,'.tsv')
+
+    def tearDown(self):
+        remove_files(self.files_to_remove)
+
+    def write_tmp_file(self,data,suffix):
+        fp = get_tmp_filename(prefix='NativeAsrTests',suffix=suffix)
+        open(fp,'w').write(data)
+        self.files_to_remove.append(fp)
+        return fp
+
+    def test_load_asr_tree_and_traits(self):
+        """load_asr_tree_and_traits should match tips to trait table rows"""
+        tree,trait_ids,tip_indices,tip_values =\
+          load_asr_tree_and_traits(self.in_tree2_fp,self.in_trait3_fp)
+        self.assertEqual(trait_ids,['trait1','trait2'])
+        self.assertEqual([tree.get_node_names()[i] for i in tip_indices],\
+          ["'abc_123|id1'",'2','3',"'NC_2345|id2'",'D'])
+        self.assertFloatEqual(tip_values,\
+          array([[1,3],[0,3],[2,3],[5,2],[5,2]]))
+
+        missing_tip_fp = self.write_tmp_file(in_trait1.replace('\nD','\nE'),'.tsv')
+        self.assertRaises(ValueError,load_asr_tree_and_traits,\
+          self.in_tree1_fp,missing_tip_fp)
+        unnamed_fp = self.write_tmp_file(in_tree1.replace(')11',')'),'.nwk')
+        self.assertRaises(ValueError,load_asr_tree_and_traits,\
+          unnamed_fp,self.in_trait1_fp)
+
+    def test_make_asr_table(self):
+        """make_asr_table should list internal nodes in postorder"""
+        tree = CompactTree.from_phylo_node(DndParser(in_tree1))
+        values = array([[i,i*2] for i in range(len(tree))])
+        obs = make_asr_table(tree,['a','b'],values,value_type=int)
+        #preorder: 14,12,11,1,2,3,10,4,D
+        self.assertEqual(obs.Header,['nodes','a','b'])
+        self.assertEqual(obs.getRawData(),\
+          [['11',2,4],['12',1,2],['10',6,12],['14',0,0]])
+        obs = make_asr_table(tree,['a','b'],values,postorder=False)
+        self.assertEqual(obs.getRawData(columns=['nodes']),['14','12','11','10'])
+
+    def test_make_asr_ci_table(self):
+        """make_asr_ci_table should format intervals as ace.R does"""
+        tree = CompactTree.from_phylo_node(DndParser("(A:1,B:1)R;"))
+        lower = array([[0.14700001,-0.00001],[0,0],[0,0]])
+        upper = array([[3.0,1.23456],[0,0],[0,0]])
+        obs = make_asr_ci_table(tree,['a','b'],lower,upper,\
+          params=[('sigma',['1|2','3|4'])])
+        self.assertEqual(obs.Header,['nodes','a','b'])
+        self.assertEqual(obs.getRawData(),\
+          [['R','0.147|3','0|1.2346'],['sigma','1|2','3|4']])
+
+    def test_wagner_parsimony(self):
+        """wagner_parsimony should minimize the total gain and loss penalty"""
+        tree = DndParser("((A:1,B:1)C:1,(D:1,E:1)F:1)G;")
+        nodes,parents,lengths = flatten_tree(tree)
+        #preorder: G,C,A,B,F,D,E
+        tip_indices = array([2,3,5,6])
+        tip_values = array([[0,4,0],[0,4,2],[3,4,2],[3,0,2]])
+        exp = array([[3,4,2],[0,4,2],[0,4,0],[0,4,2],[3,4,2],[3,4,2],\
+          [3,0,2]])
+        self.assertEqual(wagner_parsimony(parents,tip_indices,tip_values),exp)
+        #Blocks of traits give the same result
+        self.assertEqual(wagner_parsimony(parents,tip_indices,tip_values,\
+          max_cells=1),exp)
+
+        #Scaling both penalties keeps the solution, even though sums of
+        #non-integer penalties are rounded
+        scaled_values = array([[4],[2],[4],[5]])
+        self.assertEqual(wagner_parsimony(parents,tip_indices,scaled_values,\
+          gain=0.2,loss=0.1),wagner_parsimony(parents,tip_indices,\
+          scaled_values,gain=2.0,loss=1.0))
+
+        #An expensive gain favours a root with more copies
+        obs = wagner_parsimony(parents,tip_indices,tip_values,gain=3.0)
+        self.assertEqual(obs[[0,1,4],0],[3,0,3])
+
+        self.assertRaises(ValueError,wagner_parsimony,parents,tip_indices,\
+          tip_values - 1)
+        self.assertRaises(ValueError,wagner_parsimony,parents,tip_indices,\
+          tip_values + 0.5)
+
+    def test_linear_cost_transform(self):
+        """_linear_cost_transform should match comparing all pairs of states"""
+        costs = array([[0.0,5.0],[4.0,1.0],[1.5,7.0],[9.0,0.0]])
+        for gain,loss in [(1.0,1.0),(2.0,0.5),(0.3,1.7)]:
+            exp = [[min([costs[t,j] + (gain*(t-s) if t > s else loss*(s-t))\
+              for t in range(4)]) for j in range(2)] for s in range(4)]
+            self.assertFloatEqual(_linear_cost_transform(costs,gain,loss),exp)
+
+    def test_wagner_native_for_picrust(self):
+        """wagner_native_for_picrust should match Count's Wagner parsimony"""
+        #Expected results are those given by wagner_for_picrust (see test_count.py)
+        expected = Table(['nodes','trait1','trait2'],\
+          [['11',1,3],['12',2,3],['10',5,2],['14',5,3]])
+        obs = wagner_native_for_picrust(self.in_tree1_fp,self.in_trait1_fp)
+        self.assertEqual(obs.tostring(),expected.tostring())
+        obs = wagner_native_for_picrust(self.in_tree2_fp,self.in_trait3_fp)
+        self.assertEqual(obs.tostring(),expected.tostring())
+
+    def test_pic_reconstruction(self):
+        """pic_reconstruction should average children by inverse branch length"""
+        #A polytomy is resolved with zero-length branches
+        nodes,parents,lengths = flatten_tree(DndParser("(A:1,B:1,C:2)R;"))
+        values,variances = pic_reconstruction(parents,lengths,array([1,2,3]),\
+          array([[0,1],[3,1],[6,1]]))
+        self.assertFloatEqual(values,array([[2.4,1],[0,1],[3,1],[6,1]]))
+        self.assertFloatEqual(variances,array([5/3,0,0,0]))
+
+        #Child branch lengths are extended by the variance of their estimates
+        tree = DndParser("((A:0.1,B:0.2)C:0.6,D:0.8)R;")
+        nodes,parents,lengths = flatten_tree(tree)
+        values,variances = pic_reconstruction(parents,lengths,array([2,3,4]),\
+          array([[1],[0],[2]]))
+        self.assertFloatEqual(values[[0,1],0],[(1+2.5)/(1/(0.6+0.2/3)+1.25),2/3])
+        self.assertFloatEqual(variances[[0,1]],[0.6+0.2/3+0.8,0.3])
+
+        #Zero length branches give an equally weighted average
+        nodes,parents,lengths = flatten_tree(DndParser("(A:0,B:0)R;"))
+        values,variances = pic_reconstruction(parents,lengths,array([1,2]),\
+          array([[1],[3]]))
+        self.assertFloatEqual(values[0],[2])
+
+    def test_pic_native_for_picrust(self):
+        """pic_native_for_picrust should match ace_for_picrust with method pic"""
+        #Expected results are those given by ace.R (see test_ace.py)
+        actual,actual_ci = pic_native_for_picrust(self.in_tree1_fp,\
+          self.in_trait1_fp)
+        expected = Table(['nodes','trait1','trait2'],[['14','2.9737','2.5436'],\
+          ['12','1.2727','3.0000'],['11','0.6667','3.0000'],['10','5.0000','2.0000']])
+        self.assertEqual(actual.tostring(),expected.tostring())
+        expected_ci = Table(['nodes','trait1','trait2'],\
+          [['14','0.7955|5.1519','0.3655|4.7218'],\
+           ['12','-1.1009|3.6464','0.6264|5.3736'],\
+           ['11','-0.4068|1.7402','1.9265|4.0735'],\
+           ['10','3.3602|6.6398','0.3602|3.6398']])
+        self.assertEqual(actual_ci.tostring(),expected_ci.tostring())
+
+    def test_student_t_quantile(self):
+        """student_t_quantile should match R's qt"""
+        self.assertFloatEqual(student_t_quantile(0.975,1),12.70620473617471)
+        self.assertFloatEqual(student_t_quantile(0.975,4),2.776445105197799)
+        self.assertFloatEqual(student_t_quantile(0.975,3),3.182446305284263)
+        self.assertFloatEqual(student_t_quantile(0.95,10),1.812461122811676)
+        self.assertFloatEqual(student_t_quantile(0.5,10),0.0)
+        self.assertRaises(ValueError,student_t_quantile,0.975,0)
+        self.assertRaises(ValueError,student_t_quantile,1.0,3)
+
+    def test_format_r_values(self):
+        """format_r_values should write numbers as R does"""
+        self.assertEqual(format_r_values(array([1.0,-0.00001,2.123456,inf,nan])),\
+          ['1','0','2.1235','Inf','NaN'])
+
+    def test_brownian_motion_reconstruction(self):
+        """brownian_motion_reconstruction should give ML and REML estimates"""
+        nodes,parents,lengths = flatten_tree(DndParser("(A:1,B:1)R;"))
+        tip_indices = array([1,2])
+        tip_values = array([[0,3],[2,3]])
+        values,errors,sigma2,sigma2_se,loglik = brownian_motion_reconstruction(\
+          parents,lengths,tip_indices,tip_values,method='ML')
+        self.assertFloatEqual(values,array([[1,3],[0,3],[2,3]]))
+        self.assertFloatEqual(sigma2,[1,0])
+        self.assertFloatEqual(sigma2_se,[1/sqrt(2),0])
+        self.assertFloatEqual(errors[:,0],[0.5,0,0])
+        #A trait without variation has an infinite likelihood
+        self.assertFloatEqual(loglik,[-1,inf])
+
+        values,errors,sigma2,sigma2_se,loglik = brownian_motion_reconstruction(\
+          parents,lengths,tip_indices,tip_values,method='REML')
+        self.assertFloatEqual(values,array([[1,3],[0,3],[2,3]]))
+        self.assertFloatEqual(sigma2,[1,0])
+        self.assertFloatEqual(sigma2_se,[1,0])
+        self.assertFloatEqual(errors[:,0],[sqrt(0.5),0,0])
+        #One contrast (0 - 2, variance 2) and the root estimate (variance
+        #1/2), so log det V = log(2) + log(1/2) = 0
+        self.assertFloatEqual(loglik,[-(2*log(2*pi) + 2)/2,inf])
+
+        #Internal nodes use information from the whole tree, unlike pic
+        tree = DndParser("((A:1,B:1)C:1,D:1)R;")
+        nodes,parents,lengths = flatten_tree(tree)
+        values,errors,sigma2,sigma2_se,loglik = brownian_motion_reconstruction(\
+          parents,lengths,array([2,3,4]),array([[0],[0],[3]]))
+        #The root averages C's subtree (0, with variance 0.5 + 1) and D (3,
+        #with variance 1).  C averages A and B (0, with precision 2) and the
+        #rest of the tree (3, with variance 1 + 1).
+        self.assertFloatEqual(values[[0,1],0],[1.8,0.6])
+
+        self.assertRaises(ValueError,brownian_motion_reconstruction,\
+          parents,lengths,array([2,3,4]),array([[0],[0],[3]]),method='pic')
+
+    def test_bm_native_for_picrust(self):
+        """bm_native_for_picrust should match ace_for_picrust with method ML or REML"""
+        #Expected results are those given by ace.R (see test_ace.py)
+        actual,actual_ci = bm_native_for_picrust(self.in_tree1_fp,\
+          self.in_trait1_fp,method='ML')
+        expected = Table(['nodes','trait1','trait2'],[['14','2.9737','2.5436'],\
+          ['12','2.3701','2.7056'],['11','0.8370','2.9706'],['10','4.4826','2.1388']])
+        self.assertEqual(actual.tostring(),expected.tostring())
+        #ace's standard errors of sigma^2 come from a numerical Hessian, so
+        #they differ from the exact values here in the 4th decimal place
+        #(0.6981 and 0.0359)
+        expected_ci = Table(['nodes','trait1','trait2'],\
+          [['14','1.4467|4.5007','2.1979|2.8894'],\
+           ['12','0.9729|3.7674','2.3892|3.0219'],\
+           ['11','0.147|1.527','2.8143|3.1268'],\
+           ['10','3.4227|5.5426','1.8988|2.3788'],\
+           ['sigma','1.9742|0.698','0.1012|0.0358'],\
+           ['loglik','-6.7207','5.1623']])
+        self.assertEqual(actual_ci.tostring(),expected_ci.tostring())
+
+        actual,actual_ci = bm_native_for_picrust(self.in_tree1_fp,\
+          self.in_trait1_fp,method='REML')
+        self.assertEqual(actual.tostring(),expected.tostring())
+        #The restricted log likelihoods are those of ace's REML objective,
+        #(n*log(2*pi) + logdet(sigma^2*V) + mahalanobis)/2, evaluated with
+        #the full tip covariance matrix V
+        expected_ci = Table(['nodes','trait1','trait2'],\
+          [['14','0.2422|5.7052','1.9252|3.1621'],\
+           ['12','-0.1294|4.8696','2.1396|3.2715'],\
+           ['11','-0.3973|2.0713','2.6911|3.25'],\
+           ['10','2.5866|6.3787','1.7095|2.5681'],\
+           ['sigma','3.1588|1.9978','0.1619|0.1024'],\
+           ['loglik','-8.8955','-1.4686']])
+        self.assertEqual(actual_ci.tostring(),expected_ci.tostring())
+
+in_tree1="""(((1:0.1,2:0.2)11:0.6,3:0.8)12:0.2,(4:0.3,D:0.4)10:0.5)14;"""
+
+in_tree2="""((('abc_123|id1':0.1,2:0.2)11:0.6,3:0.8)12:0.2,('NC_2345|id2':0.3,D:0.4)10:0.5)14;"""
+
+in_trait1="""tips	trait1	trait2
+1	1	3
+2	0	3
+3	2	3
+4	5	2
+D	5	2"""
+
+in_trait3="""tips	trait1	trait2
+'abc_123|id1'	1	3
+2	0	3
+3	2	3
+'NC_2345|id2'	5	2
+D	5	2"""
+
+if __name__ == "__main__":
+    main()
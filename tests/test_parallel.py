@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from subprocess import Popen
+from tempfile import mkdtemp
+from time import time
+from cogent.util.unit_test import main,TestCase
+from picrust.parallel import system_call, get_sentinel_fp,\
+  wrap_command_with_sentinel, read_sentinel_file, iter_completed_files,\
+  wait_for_output_files, wait_for_job_sentinels, InotifyWatcher
+
+"""
+Tests for parallel.py
+"""
+
+class TestParallel(TestCase):
+    """Tests of parallel.py"""
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='Parallel_Tests')
+        self.files = [join(self.tmp_dir,'out%i' % i) for i in range(3)]
+        self.procs = []
+
+    def tearDown(self):
+        for proc in self.procs:
+            proc.wait()
+        rmtree(self.tmp_dir)
+
+    def create_later(self,filepaths,delay=0.2):
+        """Create filepaths from a background process after delay seconds"""
+        cmd = 'sleep %s; %s' % (delay,\
+          '; '.join(['touch "%s"' % fp for fp in filepaths]))
+        self.procs.append(Popen(cmd,shell=True))
+
+    def test_wrap_command_with_sentinel(self):
+        """wrap_command_with_sentinel should record the command's exit status"""
+        sentinel_fp = get_sentinel_fp(self.files[0])
+        self.assertEqual(sentinel_fp,self.files[0] + '.done')
+        system_call(wrap_command_with_sentinel('touch "%s"' % self.files[0],\
+          sentinel_fp))
+        self.assertEqual(read_sentinel_file(sentinel_fp),0)
+        system_call(wrap_command_with_sentinel('sh -c "exit 3"',sentinel_fp))
+        self.assertEqual(read_sentinel_file(sentinel_fp),3)
+        #Only the output and sentinel remain (the temporary file was renamed)
+        self.assertEqual(sorted(listdir(self.tmp_dir)),['out0','out0.done'])
+
+        open(sentinel_fp,'w').write('')
+        self.assertRaises(ValueError,read_sentinel_file,sentinel_fp)
+
+    def test_iter_completed_files(self):
+        """iter_completed_files should yield files as they are created"""
+        for use_inotify in [True,False]:
+            for f in self.files:
+                open(f,'w').close()
+                break
+            self.create_later(self.files[1:])
+            start = time()
+            obs = list(iter_completed_files(self.files,poll_interval=0.05,\
+              use_inotify=use_inotify,timeout=30))
+            self.assertEqual(obs[0],self.files[0])
+            self.assertEqualItems(obs,self.files)
+            #Well within the old 30 second polling interval
+            self.assertLessThan(time() - start,10)
+            rmtree(self.tmp_dir)
+            self.tmp_dir = mkdtemp(prefix='Parallel_Tests')
+            self.files = [join(self.tmp_dir,'out%i' % i) for i in range(3)]
+
+        self.assertEqual(list(iter_completed_files([])),[])
+        wait_for_output_files([])
+        self.assertRaises(RuntimeError,wait_for_output_files,self.files,\
+          poll_interval=0.01,timeout=0.1)
+
+    def test_inotify_watcher(self):
+        """InotifyWatcher should report files created in the watched directories"""
+        try:
+            watcher = InotifyWatcher([self.tmp_dir])
+        except OSError:
+            #inotify isn't available on this system
+            return
+        self.assertEqual(watcher.wait(0.01),[])
+        open(self.files[0],'w').close()
+        self.assertContains(watcher.wait(5),(self.tmp_dir,'out0'))
+        watcher.close()
+
+    def test_wait_for_job_sentinels(self):
+        """wait_for_job_sentinels should return exit statuses, and fail on errors"""
+        sentinels = [get_sentinel_fp(f) for f in self.files]
+        cmds = [wrap_command_with_sentinel('sleep 0.1',s) for s in sentinels]
+        self.procs.append(Popen('; '.join(cmds),shell=True))
+        self.assertEqual(wait_for_job_sentinels(sentinels,poll_interval=0.05),\
+          dict([(s,0) for s in sentinels]))
+
+        #A failed job is reported, rather than waiting for the others
+        self.procs.append(Popen(wrap_command_with_sentinel('sh -c "exit 1"',\
+          sentinels[0] + '2'),shell=True))
+        self.assertRaises(RuntimeError,wait_for_job_sentinels,\
+          [sentinels[0] + '2',self.files[0] + '.never'],poll_interval=0.05,\
+          timeout=30)
+
+if __name__ == "__main__":
+    main()
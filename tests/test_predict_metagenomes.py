@@ -13,14 +13,19 @@ __status__ = "Development"
  
 
 from cogent.util.unit_test import TestCase, main
+from cStringIO import StringIO
 from biom.parse import parse_biom_table_str, get_axis_indices,\
   direct_slice_data
 from biom.table import DenseTable
+from numpy import array
 from picrust.predict_metagenomes import predict_metagenomes,\
   calc_nsti,get_overlapping_ids,\
   extract_otu_and_genome_data,transfer_sample_metadata,\
   transfer_observation_metadata,transfer_metadata,\
-  load_subset_from_biom_str,yield_subset_biom_str
+  load_subset_from_biom_str,yield_subset_biom_str,\
+  predict_metagenomes_sparse,get_sparse_table_arrays,sum_sparse_rows,\
+  make_empty_metagenome_table,yield_predicted_metagenome_chunks,\
+  write_metagenome_chunks_as_biom,write_metagenome_chunks_as_tab_delimited
 
 class PredictMetagenomeTests(TestCase):
     """ """
@@ -77,6 +82,151 @@ class PredictMetagenomeTests(TestCase):
         for i,md in enumerate(exp_md):
             self.assertEqualItems(md,actual_md[i])
 
+    def test_predict_metagenomes_sparse(self):
+        """ predict_metagenomes_sparse gives the same result as predict_metagenomes """
+        actual = predict_metagenomes_sparse(self.otu_table1,self.genome_table1)
+        self.assertEqual(actual,self.predicted_metagenome_table1)
+
+        actual = predict_metagenomes_sparse(self.otu_table1_with_metadata,\
+          self.genome_table1_with_metadata)
+        exp = predict_metagenomes(self.otu_table1_with_metadata,\
+          self.genome_table1_with_metadata)
+        self.assertEqual(actual,exp)
+        self.assertEqual(map(dict,actual.SampleMetadata),\
+          map(dict,exp.SampleMetadata))
+        self.assertEqual(map(dict,actual.ObservationMetadata),\
+          map(dict,exp.ObservationMetadata))
+
+        self.assertRaises(ValueError,predict_metagenomes_sparse,\
+          self.otu_table1,self.genome_table2)
+
+    def test_get_sparse_table_arrays(self):
+        """ get_sparse_table_arrays compresses biom tables by sample or observation """
+        #otu_table1 is dense: observations GG_OTU_1..3 x samples
+        data = array([list(self.otu_table1.observationData(o)) for o in\
+          self.otu_table1.ObservationIds])
+        for by_sample,exp in [(True,data.T),(False,data)]:
+            indptr,indices,values = get_sparse_table_arrays(self.otu_table1,\
+              by_sample=by_sample)
+            self.assertEqual(len(indptr),exp.shape[0]+1)
+            for i,row in enumerate(exp):
+                start,end = indptr[i],indptr[i+1]
+                self.assertEqual(list(indices[start:end]),list(row.nonzero()[0]))
+                self.assertFloatEqual(values[start:end],row[row.nonzero()[0]])
+
+        #genome_table1 is sparse
+        indptr,indices,values = get_sparse_table_arrays(self.genome_table1)
+        for i,sample_id in enumerate(self.genome_table1.SampleIds):
+            row = self.genome_table1.sampleData(sample_id)
+            start,end = indptr[i],indptr[i+1]
+            self.assertEqual(list(indices[start:end]),list(row.nonzero()[0]))
+            self.assertFloatEqual(values[start:end],row[row.nonzero()[0]])
+
+    def test_sum_sparse_rows(self):
+        """ sum_sparse_rows calculates weighted sums of compressed rows """
+        #[[1,0,2],[0,0,0],[0,3,4]]
+        indptr = array([0,2,2,4])
+        indices = array([0,2,1,2])
+        values = array([1.0,2.0,3.0,4.0])
+        self.assertFloatEqual(sum_sparse_rows(indptr,indices,values,\
+          [0,2],[2,0.5],3),[2.0,1.5,6.0])
+        self.assertFloatEqual(sum_sparse_rows(indptr,indices,values,\
+          [2,2,1],[1,1,5],3),[0.0,6.0,8.0])
+        self.assertFloatEqual(sum_sparse_rows(indptr,indices,values,\
+          [1],[3],3),[0.0,0.0,0.0])
+        self.assertFloatEqual(sum_sparse_rows(indptr,indices,values,\
+          [],[],3),[0.0,0.0,0.0])
+
+    def test_make_empty_metagenome_table(self):
+        """ make_empty_metagenome_table has the ids and metadata of the result, but no data """
+        exp = predict_metagenomes(self.otu_table1_with_metadata,\
+          self.genome_table1_with_metadata)
+        actual = make_empty_metagenome_table(self.otu_table1_with_metadata,\
+          self.genome_table1_with_metadata)
+        self.assertEqual(actual.SampleIds,exp.SampleIds)
+        self.assertEqual(actual.ObservationIds,exp.ObservationIds)
+        self.assertEqual(map(dict,actual.SampleMetadata),\
+          map(dict,exp.SampleMetadata))
+        self.assertEqual(map(dict,actual.ObservationMetadata),\
+          map(dict,exp.ObservationMetadata))
+        self.assertEqual(actual.sum(),0)
+
+        self.assertRaises(ValueError,make_empty_metagenome_table,\
+          self.otu_table1,self.genome_table2)
+
+    def test_yield_predicted_metagenome_chunks(self):
+        """ yield_predicted_metagenome_chunks yields blocks of samples """
+        exp = self.predicted_metagenome_table1
+        n_samples = len(self.otu_table1.SampleIds)
+        for chunk_size in [None,1,2,n_samples,n_samples+5]:
+            chunks = list(yield_predicted_metagenome_chunks(self.otu_table1,\
+              self.genome_table1,chunk_size=chunk_size))
+            if chunk_size is None:
+                self.assertEqual(len(chunks),1)
+            self.assertEqual(chunks[0][0],0)
+            self.assertEqual(chunks[-1][1],n_samples)
+            for start,end,gene_indices,sample_indices,counts in chunks:
+                self.assertTrue(end - start <= (chunk_size or n_samples))
+                self.assertTrue(((sample_indices >= start) &\
+                  (sample_indices < end)).all())
+
+            actual = {}
+            for start,end,gene_indices,sample_indices,counts in chunks:
+                for gene_index,sample_index,count in\
+                  zip(gene_indices,sample_indices,counts):
+                    actual[(gene_index,sample_index)] = count
+            for i,obs_id in enumerate(exp.ObservationIds):
+                for j,sample_id in enumerate(exp.SampleIds):
+                    self.assertEqual(actual.get((i,j),0),\
+                      exp.getValueByIds(obs_id,sample_id))
+
+        self.assertRaises(ValueError,list,yield_predicted_metagenome_chunks(\
+          self.otu_table1,self.genome_table1,chunk_size=0))
+
+    def test_write_metagenome_chunks_as_biom(self):
+        """ write_metagenome_chunks_as_biom writes the predicted metagenome as biom """
+        for otu_table,genome_table in [(self.otu_table1,self.genome_table1),\
+          (self.otu_table1_with_metadata,self.genome_table1_with_metadata)]:
+            exp = predict_metagenomes(otu_table,genome_table)
+            for chunk_size in [1,2,None]:
+                out_f = StringIO()
+                write_metagenome_chunks_as_biom(out_f,\
+                  make_empty_metagenome_table(otu_table,genome_table),\
+                  yield_predicted_metagenome_chunks(otu_table,genome_table,\
+                  chunk_size=chunk_size))
+                actual = parse_biom_table_str(out_f.getvalue())
+                self.assertEqual(actual,exp)
+                self.assertEqual(actual.ObservationMetadata,\
+                  exp.ObservationMetadata)
+                self.assertEqual(actual.SampleMetadata,exp.SampleMetadata)
+
+    def test_write_metagenome_chunks_as_tab_delimited(self):
+        """ write_metagenome_chunks_as_tab_delimited matches delimitedSelf """
+        exp = predict_metagenomes(self.otu_table1,self.genome_table1)
+        for chunk_size in [1,2,None]:
+            out_f = StringIO()
+            write_metagenome_chunks_as_tab_delimited(out_f,\
+              make_empty_metagenome_table(self.otu_table1,self.genome_table1),\
+              yield_predicted_metagenome_chunks(self.otu_table1,\
+              self.genome_table1,chunk_size=chunk_size))
+            self.assertEqual(out_f.getvalue(),exp.delimitedSelf())
+
+        #Observation metadata can be added as a final column
+        exp = predict_metagenomes(self.otu_table1_with_metadata,\
+          self.genome_table1_with_metadata)
+        out_f = StringIO()
+        write_metagenome_chunks_as_tab_delimited(out_f,\
+          make_empty_metagenome_table(self.otu_table1_with_metadata,\
+          self.genome_table1_with_metadata),\
+          yield_predicted_metagenome_chunks(self.otu_table1_with_metadata,\
+          self.genome_table1_with_metadata,chunk_size=2),\
+          header_key="KEGG_description",header_value="KEGG Description")
+        self.assertEqual(out_f.getvalue(),exp.delimitedSelf(\
+          header_key="KEGG_description",header_value="KEGG Description"))
+
+        self.assertRaises(ValueError,write_metagenome_chunks_as_tab_delimited,\
+          out_f,exp,[],header_key="KEGG_description")
+
     def test_transfer_metadata_moves_sample_metadata_between_biom_tables(self):
         """transfer_metadata moves sample metadata values between BIOM format tables"""
         t1 = self.otu_table1
@@ -10,14 +10,16 @@ __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
 
 from math import e,sqrt
+from collections import defaultdict
 from cogent.util.unit_test import main,TestCase
-from numpy import array,arange,array_equal,around
+from numpy import array,arange,array_equal,around,float32
 from cogent import LoadTree
 from cogent.parse.tree import DndParser
 from cogent.app.util import get_tmp_filename
 from cogent.util.misc import remove_files
 from cogent.maths.stats.special import ndtri
-from warnings import catch_warnings
+from cogent.maths.stats.distribution import z_high
+from warnings import catch_warnings, simplefilter
 from picrust.predict_traits  import assign_traits_to_tree,\
   predict_traits_from_ancestors, get_most_recent_ancestral_states,\
   fill_unknown_traits, equal_weight,linear_weight,\
@@ -30,7 +32,17 @@ from picrust.predict_traits  import assign_traits_to_tree,\
   variance_of_weighted_mean,fit_normal_to_confidence_interval,\
   get_most_recent_reconstructed_ancestor,\
   normal_product_monte_carlo, get_bounds_from_histogram,\
-  get_nn_by_tree_descent,get_brownian_motion_param_from_confidence_intervals
+  get_nn_by_tree_descent,get_brownian_motion_param_from_confidence_intervals,\
+  predict_traits_from_ancestors_vectorized, predict_traits_from_arrays,\
+  get_weights_for_distances, build_ancestor_index, get_ancestor_distance,\
+  get_nearest_annotated_neighbors, load_trait_matrix_from_file,\
+  predict_variances_from_arrays, calc_confidence_interval_95,\
+  normal_upper_tail, get_brownian_interval_probs,\
+  thresholded_brownian_probabilities
+from picrust.compact_tree import CompactTree
+from picrust.matrix_cache import write_matrix_cache
+from picrust.predict_traits import partition_nodes_to_predict,\
+  predict_traits_from_ancestors_in_parallel
 
 
 """
@@ -156,6 +168,10 @@ class TestPredictTraits(TestCase):
         self.assertEqual(results["C"],array([0.0,1.0]))
         self.assertEqual(results["D"],array([0.0,0.0]))
 
+        #Unknown nodes are an error
+        self.assertRaises(ValueError,predict_nearest_neighbor,tree,\
+          nodes_to_predict=["not_a_node"])
+
  
     def test_calc_nearest_sequenced_taxon_index(self):
         """calc_nearest_sequenced_taxon_index calculates the NSTI measure"""
@@ -190,6 +206,34 @@ class TestPredictTraits(TestCase):
         self.assertFloatEqual(obs_nsti,exp)
         self.assertFloatEqual(obs_distances["B"],0.03)
         self.assertFloatEqual(obs_distances["C"],0.02)
+
+        #The dense method should give the same results
+        obs_nsti,obs_distances = calc_nearest_sequenced_taxon_index(tree,\
+          limit_to_tips = ["B","C"],verbose=False,method="dense")
+        self.assertFloatEqual(obs_nsti,exp)
+        self.assertFloatEqual(obs_distances["B"],0.03)
+        self.assertFloatEqual(obs_distances["C"],0.02)
+
+        self.assertRaises(ValueError,calc_nearest_sequenced_taxon_index,\
+          tree,verbose=False,method="not_a_method")
+
+    def test_calc_nearest_sequenced_taxon_index_methods_agree(self):
+        """calc_nearest_sequenced_taxon_index tree_dp and dense methods should agree"""
+        traits = self.PartialReconstructionTraits
+        for tree in [self.PartialReconstructionTree,self.CloseToI3Tree,\
+          self.CloseToI1Tree,self.BetweenI3AndI1Tree]:
+            tree = assign_traits_to_tree(traits,tree)
+            for include_self in [True,False]:
+                exp_nsti,exp_distances =\
+                  calc_nearest_sequenced_taxon_index(tree,\
+                  include_self=include_self,verbose=False,method="dense")
+                obs_nsti,obs_distances =\
+                  calc_nearest_sequenced_taxon_index(tree,\
+                  include_self=include_self,verbose=False,method="tree_dp")
+                self.assertFloatEqual(obs_nsti,exp_nsti)
+                self.assertEqualItems(obs_distances.keys(),exp_distances.keys())
+                for tip in exp_distances:
+                    self.assertFloatEqual(obs_distances[tip],exp_distances[tip])
     
     def test_get_nn_by_tree_descent(self):
         """calc_nearest_sequenced_taxon_index calculates the NSTI measure"""
@@ -346,6 +390,31 @@ class TestPredictTraits(TestCase):
         
         self.assertEqual(nn.Name,'A')
 
+    def test_get_nearest_annotated_neighbors(self):
+        """get_nearest_annotated_neighbors should match get_nearest_annotated_neighbor for all nodes"""
+        for traits,tree in [(self.SimpleTreeTraits,self.SimpleTree),\
+          (self.PartialReconstructionTraits,self.BetweenI3AndI1Tree),\
+          (self.PartialReconstructionTraits,self.CloseToI1Tree)]:
+            tree = assign_traits_to_tree(traits,tree)
+            for tips_only in [True,False]:
+                for include_self in [True,False]:
+                    obs = get_nearest_annotated_neighbors(tree,\
+                      tips_only=tips_only,include_self=include_self)
+                    for node in tree.preorder():
+                        exp_nn = get_nearest_annotated_neighbor(tree,\
+                          node.Name,tips_only=tips_only,\
+                          include_self=include_self)
+                        obs_nn,obs_distance = obs[node.Name]
+                        self.assertTrue(obs_nn is exp_nn)
+                        self.assertFloatEqual(obs_distance,\
+                          node.distance(exp_nn))
+
+        #Nodes without any annotated neighbor get None
+        tree = assign_traits_to_tree({"A":[1.0]},self.SimpleTree)
+        obs = get_nearest_annotated_neighbors(tree,include_self=False)
+        self.assertEqual(obs["A"],(None,None))
+        self.assertEqual(obs["B"][0].Name,"A")
+
     def test_biom_table_from_predictions(self):
         """format predictions into biom format"""
         traits = self.SimpleTreeTraits
@@ -507,6 +576,68 @@ class TestPredictTraits(TestCase):
         #try giving a trait table with a trait that doesn't match our header
         self.assertRaises(RuntimeError,update_trait_dict_from_file,self.in_bad_trait_fp,header)
 
+    def test_load_trait_matrix_from_file(self):
+        """load_trait_matrix_from_file should parse trait tables into a matrix and row index"""
+        header,row_index,trait_matrix =\
+          load_trait_matrix_from_file(self.in_trait1_fp)
+        self.assertEqual(header,["trait2","trait1"])
+        self.assertEqual(row_index,{'3':0,'A':1,'D':2})
+        self.assertFloatEqual(trait_matrix,array([[3,1],[5,2.5],[5,2]]))
+
+        #Columns should be subset and reordered to match a given header,
+        #regardless of chunk size
+        for chunk_size in [1,2,10]:
+            with catch_warnings(record=True) as w:
+                simplefilter("always")
+                header2,row_index,trait_matrix =\
+                  load_trait_matrix_from_file(self.in_trait2_fp,header,\
+                  chunk_size=chunk_size)
+                self.assertEqual(len(w),1)
+                self.assertTrue("Missing" in str(w[-1].message))
+            self.assertEqual(header2,["trait2","trait1"])
+            self.assertEqual(row_index,{'1':0,'2':1,'3':2})
+            self.assertFloatEqual(trait_matrix,array([[3,1],[3,0],[3,2]]))
+
+        header,row_index,trait_matrix =\
+          load_trait_matrix_from_file(self.in_trait1_fp,dtype=float32)
+        self.assertEqual(trait_matrix.dtype,float32)
+
+        self.assertRaises(RuntimeError,load_trait_matrix_from_file,\
+          self.in_bad_trait_fp,header)
+
+        #Non-numeric values are an error
+        bad_value_fp = get_tmp_filename(prefix='Predict_Traits_Tests',suffix='.tsv')
+        self.files_to_remove.append(bad_value_fp)
+        f = open(bad_value_fp,'w')
+        f.write("tips\ttrait1\n1\t1\n2\tabc\n")
+        f.close()
+        self.assertRaises(ValueError,load_trait_matrix_from_file,bad_value_fp)
+
+    def test_load_trait_matrix_from_matrix_cache(self):
+        """load_trait_matrix_from_file should accept matrix cache files"""
+        cache_fp = get_tmp_filename(prefix='Predict_Traits_Tests',suffix='.pmc')
+        self.files_to_remove.append(cache_fp)
+        exp_header,exp_row_index,exp_matrix =\
+          load_trait_matrix_from_file(self.in_trait2_fp)
+        row_ids = sorted(exp_row_index.keys(),key=exp_row_index.get)
+        write_matrix_cache(cache_fp,row_ids,exp_header,exp_matrix)
+
+        header,row_index,trait_matrix = load_trait_matrix_from_file(cache_fp)
+        self.assertEqual(header,exp_header)
+        self.assertEqual(row_index,exp_row_index)
+        self.assertFloatEqual(trait_matrix,exp_matrix)
+
+        #Header subsetting and reordering work as for text tables
+        with catch_warnings(record=True) as w:
+            simplefilter("always")
+            header,row_index,trait_matrix =\
+              load_trait_matrix_from_file(cache_fp,["trait2","trait1"])
+            self.assertEqual(len(w),1)
+        self.assertEqual(header,["trait2","trait1"])
+        self.assertFloatEqual(trait_matrix,array([[3,1],[3,0],[3,2]]))
+        self.assertRaises(RuntimeError,load_trait_matrix_from_file,\
+          cache_fp,["trait1","not_a_trait"])
+
     def test_predict_traits_from_ancestors(self):
         """predict_traits_from_ancestors should propagate ancestral states"""
         # Testing the point predictions first (since these are easiest) 
@@ -529,6 +660,220 @@ class TestPredictTraits(TestCase):
         # test that use_self_in_prediction controls whether this is used
         
 
+    def test_predict_traits_from_ancestors_vectorized(self):
+        """predict_traits_from_ancestors_vectorized should match predict_traits_from_ancestors"""
+        test_cases = [(self.PartialReconstructionTraits,self.CloseToI3Tree),\
+          (self.PartialReconstructionTraits,self.CloseToI1Tree),\
+          (self.GeneCountTraits,self.BetweenI3AndI1Tree),\
+          (self.SimpleTreeTraits,self.SimpleTree),\
+          (self.SimpleTreeTraits,self.SimplePolytomyTree)]
+        weight_fns = [linear_weight,equal_weight,\
+          make_neg_exponential_weight_fn(e)]
+
+        for traits,tree in test_cases:
+            tree = assign_traits_to_tree(traits,tree)
+            nodes_to_predict = [n.Name for n in tree.tips()]
+            for weight_fn in weight_fns:
+                exp = predict_traits_from_ancestors(tree,nodes_to_predict,\
+                  weight_fn=weight_fn)
+                obs = predict_traits_from_ancestors_vectorized(tree,\
+                  nodes_to_predict,weight_fn=weight_fn)
+                self.assertEqualItems(obs.keys(),exp.keys())
+                for node in nodes_to_predict:
+                    self.assertFloatEqual(obs[node],exp[node])
+
+        #Limiting predictions to a subset of tips
+        tree = assign_traits_to_tree(self.GeneCountTraits,\
+          self.BetweenI3AndI1Tree)
+        obs = predict_traits_from_ancestors_vectorized(tree,['A'],\
+          weight_fn=make_neg_exponential_weight_fn(e))
+        self.assertEqual(obs.keys(),['A'])
+        exp = (array(self.GeneCountTraits["I1"]) +\
+          array(self.GeneCountTraits["I3"]))/2.0
+        self.assertFloatEqual(obs['A'],around(exp))
+
+        #Variances and confidence intervals match too, for PhyloNode and
+        #CompactTree inputs
+        kwargs = {'calc_confidence_intervals':True,\
+          'lower_bound_trait_label':'lower_bound',\
+          'upper_bound_trait_label':'upper_bound',\
+          'brownian_motion_parameter':[1.0,10.0,100.0]}
+        tree = self.SimpleUnequalVarianceTree
+        compact_tree = CompactTree.from_phylo_node(tree,\
+          ['Reconstruction','lower_bound','upper_bound'])
+        exp = predict_traits_from_ancestors(tree,['B','D'],**kwargs)
+        for t in [tree,compact_tree]:
+            obs = predict_traits_from_ancestors_vectorized(t,['B','D'],**kwargs)
+            for node in ['B','D']:
+                self.assertFloatEqual(obs[0][node],exp[0][node])
+                self.assertFloatEqual(obs[1][node]['variance'],\
+                  exp[1][node]['variance'])
+                self.assertFloatEqual(obs[2][node]['lower_CI'],\
+                  exp[2][node]['lower_CI'])
+                self.assertFloatEqual(obs[2][node]['upper_CI'],\
+                  exp[2][node]['upper_CI'])
+
+    def test_partition_nodes_to_predict(self):
+        """partition_nodes_to_predict should deal nodes into balanced partitions"""
+        nodes = ['A','B','C','D','E']
+        self.assertEqual(partition_nodes_to_predict(nodes,2),\
+          [['A','C','E'],['B','D']])
+        self.assertEqual(partition_nodes_to_predict(nodes,1),[nodes])
+        #Empty partitions are dropped
+        self.assertEqual(partition_nodes_to_predict(['A','B'],3),[['A'],['B']])
+        self.assertRaises(ValueError,partition_nodes_to_predict,nodes,0)
+
+    def test_predict_traits_from_ancestors_in_parallel(self):
+        """predict_traits_from_ancestors_in_parallel should match predict_traits_from_ancestors"""
+        tree = assign_traits_to_tree(self.GeneCountTraits,\
+          self.BetweenI3AndI1Tree)
+        nodes_to_predict = [n.Name for n in tree.tips()]
+        weight_fn = make_neg_exponential_weight_fn(e)
+        exp = predict_traits_from_ancestors(tree,nodes_to_predict,\
+          weight_fn=weight_fn)
+        for num_processes in [1,2,len(nodes_to_predict)+1]:
+            obs = predict_traits_from_ancestors_in_parallel(tree,\
+              nodes_to_predict,num_processes=num_processes,weight_fn=weight_fn)
+            #Same results, in the same order
+            self.assertEqual(obs.keys(),exp.keys())
+            for node in nodes_to_predict:
+                self.assertFloatEqual(obs[node],exp[node])
+
+        #Variances and confidence intervals are merged too
+        tree = self.SimpleUnequalVarianceTree
+        kwargs = {'calc_confidence_intervals':True,\
+          'lower_bound_trait_label':'lower_bound',\
+          'upper_bound_trait_label':'upper_bound',\
+          'brownian_motion_parameter':[1.0,10.0,100.0]}
+        exp = predict_traits_from_ancestors(tree,['B','D'],**kwargs)
+        obs = predict_traits_from_ancestors_in_parallel(tree,['B','D'],\
+          num_processes=2,**kwargs)
+        for obs_dict,exp_dict in zip(obs,exp):
+            self.assertEqual(obs_dict.keys(),exp_dict.keys())
+        for node in ['B','D']:
+            self.assertFloatEqual(obs[0][node],exp[0][node])
+            self.assertFloatEqual(obs[1][node]['variance'],\
+              exp[1][node]['variance'])
+            self.assertFloatEqual(obs[2][node]['lower_CI'],\
+              exp[2][node]['lower_CI'])
+            self.assertFloatEqual(obs[2][node]['upper_CI'],\
+              exp[2][node]['upper_CI'])
+
+    def test_predict_traits_from_arrays(self):
+        """predict_traits_from_arrays should predict tips from flattened arrays"""
+        #Flattened form of ((A:0.02,B:0.01)E:0.05,(C:0.01,D:0.01)F:0.05)root;
+        #in preorder: root,E,A,B,F,C,D
+        parents = array([-1,0,1,1,0,4,4])
+        lengths = array([0.0,0.05,0.02,0.01,0.05,0.01,0.01])
+        #E and D have traits
+        trait_rows = array([-1,0,-1,-1,-1,-1,1])
+        trait_matrix = array([[1.0,1.0],[0.0,4.0]])
+
+        obs = predict_traits_from_arrays(parents,lengths,trait_rows,\
+          trait_matrix,[3,5,6],weight_fn=equal_weight)
+        #B has only E as information; C averages root-less F children (D)
+        #and D is known
+        self.assertFloatEqual(obs,array([[1.0,1.0],[0.0,4.0],[0.0,4.0]]))
+
+        #Nodes without any ancestral or sibling information can't be predicted
+        trait_rows = array([-1,-1,-1,-1,-1,-1,0])
+        trait_matrix = array([[0.0,4.0]])
+        self.assertRaises(ValueError,predict_traits_from_arrays,parents,\
+          lengths,trait_rows,trait_matrix,[3],weight_fn=equal_weight)
+
+    def test_predict_variances_from_arrays(self):
+        """predict_variances_from_arrays should match weighted_average_variance_prediction"""
+        #Flattened form of ((A:0.02,B:0.01)E:0.05,(C:0.01,D:0.01)F:0.05)root;
+        #in preorder: root,E,A,B,F,C,D
+        parents = array([-1,0,1,1,0,4,4])
+        lengths = array([0.0,0.05,0.02,0.01,0.05,0.01,0.01])
+        #E and F are reconstructed with confidence intervals; D is known
+        trait_rows = array([-1,0,-1,-1,1,-1,2])
+        trait_matrix = array([[1.0,1.0],[0.0,1.0],[0.0,0.0]])
+        bound_rows = array([-1,0,-1,-1,1,-1,-1])
+        upper_matrix = array([[2.0,3.0],[1.0,1.0]])
+        lower_matrix = array([[0.0,-1.0],[-1.0,1.0]])
+        bm = array([1.0,10.0])
+        obs = predict_variances_from_arrays(parents,lengths,trait_rows,\
+          trait_matrix,bound_rows,upper_matrix,bound_rows,lower_matrix,\
+          [3,5],bm,weight_fn=equal_weight)
+
+        #Same as predicting the tips one at a time
+        tree = assign_traits_to_tree({"E":[1.0,1.0],"F":[0.0,1.0],\
+          "D":[0.0,0.0]},self.SimpleTree)
+        tree.getNodeMatchingName('E').upper_bound = upper_matrix[0]
+        tree.getNodeMatchingName('E').lower_bound = lower_matrix[0]
+        tree.getNodeMatchingName('F').upper_bound = upper_matrix[1]
+        tree.getNodeMatchingName('F').lower_bound = lower_matrix[1]
+        exp = predict_traits_from_ancestors(tree,['B','C'],\
+          weight_fn=equal_weight,calc_confidence_intervals=True,\
+          upper_bound_trait_label='upper_bound',\
+          lower_bound_trait_label='lower_bound',brownian_motion_parameter=bm)[1]
+        self.assertFloatEqual(obs[0],exp['B']['variance'])
+        self.assertFloatEqual(obs[1],exp['C']['variance'])
+
+        #Reconstructed ancestors need confidence intervals
+        self.assertRaises(ValueError,predict_variances_from_arrays,parents,\
+          lengths,trait_rows,trait_matrix,array([-1,-1,-1,-1,1,-1,-1]),\
+          upper_matrix,bound_rows,lower_matrix,[3],bm)
+
+    def test_calc_confidence_interval_95(self):
+        """calc_confidence_interval_95 should bound predictions of one or many nodes"""
+        predictions = array([[1.0,5.0],[0.0,2.0]])
+        variances = array([[1.0,0.25],[4.0,0.0]])
+        lower,upper = calc_confidence_interval_95(predictions,variances)
+        self.assertFloatEqual(lower,array([[0.0,4.0],[0.0,2.0]]))
+        self.assertFloatEqual(upper,array([[3.0,6.0],[4.0,2.0]]))
+        #Rows are bounded as single nodes are
+        for i in range(2):
+            obs = calc_confidence_interval_95(predictions[i],variances[i])
+            self.assertFloatEqual(obs[0],lower[i])
+            self.assertFloatEqual(obs[1],upper[i])
+
+    def test_get_weights_for_distances(self):
+        """get_weights_for_distances should apply weight functions to arrays"""
+        distances = array([0.0,0.5,1.0])
+        self.assertFloatEqual(get_weights_for_distances(linear_weight,\
+          distances),array([1.0,0.5,0.0]))
+        self.assertFloatEqual(get_weights_for_distances(equal_weight,\
+          distances),array([1.0,1.0,1.0]))
+        weight_fn = make_neg_exponential_weight_fn(2.0)
+        self.assertFloatEqual(get_weights_for_distances(weight_fn,\
+          distances),array([1.0,2.0**-0.5,0.5]))
+
+        #Functions that only handle scalars are applied elementwise
+        scalar_only_fn = lambda d: max(d,0.5)
+        self.assertFloatEqual(get_weights_for_distances(scalar_only_fn,\
+          distances),array([0.5,0.5,1.0]))
+
+    def test_build_ancestor_index(self):
+        """build_ancestor_index should find reconstructed ancestors and root distances"""
+        traits = self.PartialReconstructionTraits
+        tree = assign_traits_to_tree(traits,self.BetweenI3AndI1Tree)
+        ancestor_index = build_ancestor_index(tree)
+
+        for node in tree.preorder():
+            obs_ancestor,obs_root_distance = ancestor_index[node]
+            exp_ancestor = get_most_recent_reconstructed_ancestor(node)
+            self.assertTrue(obs_ancestor is exp_ancestor)
+            self.assertFloatEqual(obs_root_distance,tree.distance(node))
+            self.assertTrue(get_most_recent_reconstructed_ancestor(node,\
+              ancestor_index=ancestor_index) is exp_ancestor)
+
+        #Spot check: A's parent I2 is unreconstructed, so I1 is used
+        a_node = tree.getNodeMatchingName('A')
+        i1_node = tree.getNodeMatchingName('I1')
+        self.assertTrue(ancestor_index[a_node][0] is i1_node)
+        self.assertEqual(ancestor_index[tree][0],None)
+        self.assertFloatEqual(get_ancestor_distance(a_node,i1_node,\
+          ancestor_index),a_node.distance(i1_node))
+
+        #Ancestral states should be retrieved identically with the index
+        for node in tree.tips():
+            self.assertEqual(get_most_recent_ancestral_states(node,\
+              "Reconstruction",ancestor_index=ancestor_index),\
+              get_most_recent_ancestral_states(node,"Reconstruction"))
+
     def test_predict_traits_from_ancestors_correctly_predicts_variance(self):
         """predict_traits_from_ancestors should correctly report variance due to branch lengths and rates of gene copy number evolution """
         tree = self.SimpleUnequalVarianceTree
@@ -771,6 +1116,68 @@ class TestPredictTraits(TestCase):
         #Test that the start state is the highest prob value
         self.assertEqual(max(obs.values()),obs[start_state])
         
+    def test_normal_upper_tail(self):
+        """normal_upper_tail should match z_high for arrays of z"""
+        z = array([[0.0,0.5,0.7071,1.0],[1.5,5.0,11.5,40.0]])
+        obs = normal_upper_tail(z)
+        self.assertEqual(obs.shape,z.shape)
+        self.assertFloatEqual(obs,[[z_high(v) for v in row] for row in z])
+        self.assertEqual(normal_upper_tail(array([float('inf')])),[0.0])
+
+    def test_get_brownian_interval_probs(self):
+        """get_brownian_interval_probs should give probabilities of copy number changes"""
+        obs = get_brownian_interval_probs(array([0.9,0.0]),\
+          trait_prob_cutoff=0.01)
+        exp = thresholded_brownian_probability(10.0,0.9,1.0,\
+          trait_prob_cutoff=0.01)
+        self.assertEqual(obs.shape,(2,len(exp)//2 + 1))
+        self.assertFloatEqual(obs[0],[exp[10.0 + k] for k in range(obs.shape[1])])
+        #Without variance the start state is certain
+        self.assertFloatEqual(obs[1],[1.0] + [0.0]*(obs.shape[1] - 1))
+        self.assertRaises(ValueError,get_brownian_interval_probs,[1.0],\
+          trait_prob_cutoff=0.0)
+
+    def test_thresholded_brownian_probabilities(self):
+        """thresholded_brownian_probabilities should match thresholded_brownian_probability"""
+        start_states = array([[3.0,0.4],[2.2755,0.0]])
+        variances = array([30.0,5.0])
+        distances = array([[0.03],[1.0]])
+        for trait_prob_cutoff in [0.01,1e-4,1e-200]:
+            values,probs = thresholded_brownian_probabilities(start_states,\
+              variances,distances,trait_prob_cutoff=trait_prob_cutoff)
+            self.assertEqual(values.shape,probs.shape)
+            self.assertEqual(values.shape[:2],(2,2))
+            for i in range(2):
+                for j in range(2):
+                    exp = thresholded_brownian_probability(start_states[i,j],\
+                      variances[j],distances[i,0],trait_prob_cutoff=trait_prob_cutoff)
+                    obs = defaultdict(float)
+                    for value,p in zip(values[i,j],probs[i,j]):
+                        if p > 0:
+                            obs[value] += p
+                    self.assertEqualItems(obs.keys(),exp.keys())
+                    for value in exp:
+                        self.assertFloatEqual(obs[value],exp[value])
+        #Values are never below min_val
+        self.assertTrue(values.min() >= 0.0)
+
+        #Cached probabilities are used for equal variances along branches,
+        #after rounding
+        cache = {}
+        values,probs = thresholded_brownian_probabilities(start_states,\
+          variances,distances,cache=cache,cache_decimals=3)
+        self.assertEqual(len(cache),4)
+        self.assertFloatEqual(cache[(0.9,1.0,0.01)],\
+          get_brownian_interval_probs(array([0.9]))[0])
+        obs_values,obs_probs = thresholded_brownian_probabilities(\
+          start_states + 1.0,variances + 1e-5,distances,cache=cache,\
+          cache_decimals=3)
+        self.assertEqual(len(cache),4)
+        self.assertFloatEqual(obs_probs,probs)
+        max_offset = values.shape[-1]//2
+        self.assertFloatEqual(obs_values[...,max_offset:],\
+          values[...,max_offset:] + 1.0)
+
 
     def test_fit_normal_to_confidence_interval(self):
         """fit_normal_to_confidence_interval should return a mean and variance given CI"""
@@ -798,6 +1205,13 @@ class TestPredictTraits(TestCase):
         exp_var = 1.0
         self.assertFloatEqual(obs_mean,exp_mean)
         self.assertFloatEqual(obs_var,exp_var)
+
+        #Arrays of bounds are fit elementwise
+        obs_mean,obs_var = fit_normal_to_confidence_interval(\
+          array([normal_99,5.0+2*normal_99]),array([-normal_99,5.0-2*normal_99]),\
+          confidence=0.99)
+        self.assertFloatEqual(obs_mean,[0.0,5.0])
+        self.assertFloatEqual(obs_var,[1.0,4.0])
     
     def test_variance_of_weighted_mean(self):
         """variance_of_weighted_mean calculates the variance of a weighted mean"""
@@ -998,6 +1412,30 @@ class TestPredictTraits(TestCase):
 
         #self.assertFloatEqual(brownian_motion_parameter,[1.0,1.0])    
         self.assertEqual(len(brownian_motion_parameter),2) 
+
+        #A is the first tip whose parent (E) has only one annotated child
+        z = ndtri(0.95)
+        self.assertFloatEqual(brownian_motion_parameter,\
+          ((array([1.0,1.0]) - array([1.0,1.0]))/z)**2/0.02)
+
+        #CompactTrees give the same result
+        compact_tree = CompactTree.from_phylo_node(tree,\
+          ['Reconstruction','lower_bound','upper_bound'])
+        self.assertFloatEqual(get_brownian_motion_param_from_confidence_intervals(\
+          compact_tree,upper_bound_trait_label="upper_bound",\
+          lower_bound_trait_label="lower_bound",trait_label="Reconstruction",\
+          confidence=0.95),brownian_motion_parameter)
+
+        #Without a tip whose reconstructed parent has no other annotated
+        #children, the parameter can't be inferred
+        traits = {"A":[1.0],"B":[2.0],"E":[1.0]}
+        tree = assign_traits_to_tree(traits,\
+          DndParser("((A:0.02,B:0.01)E:0.05,(C:0.01,D:0.01)F:0.05)root;"))
+        tree.getNodeMatchingName('E').upper_bound = [2.0]
+        tree.getNodeMatchingName('E').lower_bound = [0.0]
+        self.assertRaises(ValueError,\
+          get_brownian_motion_param_from_confidence_intervals,tree,\
+          "upper_bound","lower_bound")
     
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.9.1-dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import join, exists
+from numpy import array
+from cogent.util.unit_test import main,TestCase
+from picrust.compact_tree import CompactTree
+from picrust.tree_cache import get_tree_cache_key, get_tree_cache_fp,\
+  save_decorated_tree, load_decorated_tree
+
+"""
+Tests for tree_cache.py
+"""
+
+class TestTreeCache(TestCase):
+    """Tests of tree_cache.py"""
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='Tree_Cache_Tests')
+        self.tree = CompactTree.from_newick(in_tree1)
+        self.tree.assign_traits({'A':array([1.0,2.0]),'E':array([0.5,3.0])})
+        self.tree.assign_traits({'E':array([0.0,1.0])},'lower_bound')
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def write(self,name,data):
+        fp = join(self.tmp_dir,name)
+        open(fp,'w').write(data)
+        return fp
+
+    def test_get_tree_cache_key(self):
+        """get_tree_cache_key should depend on file contents and params"""
+        tree_fp = self.write('tree.newick',in_tree1)
+        copy_fp = self.write('copy.newick',in_tree1)
+        traits_fp = self.write('traits.tab','tips\ttrait1\nA\t1\n')
+        key = get_tree_cache_key([tree_fp,traits_fp,None])
+        self.assertEqual(get_tree_cache_key([copy_fp,traits_fp,None]),key)
+        self.assertNotEqual(get_tree_cache_key([traits_fp,tree_fp,None]),key)
+        self.assertNotEqual(get_tree_cache_key([tree_fp,traits_fp,tree_fp]),key)
+        self.assertNotEqual(get_tree_cache_key([tree_fp,traits_fp,None],\
+          params={'confidence_format':'sigma'}),key)
+        self.write('traits.tab','tips\ttrait1\nA\t2\n')
+        self.assertNotEqual(get_tree_cache_key([tree_fp,traits_fp,None]),key)
+
+    def test_save_decorated_tree(self):
+        """save_decorated_tree should round trip the tree, traits and parameters"""
+        fp = get_tree_cache_fp(join(self.tmp_dir,'cache'),'abc')
+        save_decorated_tree(fp,self.tree,['K1','K2'],array([0.1,0.2]))
+        self.assertTrue(exists(fp))
+        tree,trait_ids,brownian_motion_parameter = load_decorated_tree(fp)
+        self.assertEqual(trait_ids,['K1','K2'])
+        self.assertFloatEqual(brownian_motion_parameter,[0.1,0.2])
+        self.assertEqual(tree.get_node_names(),self.tree.get_node_names())
+        self.assertEqual(tree.postorder,self.tree.postorder)
+        self.assertEqual(tree.to_phylo_node().getNewick(with_distances=True),\
+          self.tree.to_phylo_node().getNewick(with_distances=True))
+        self.assertEqual(sorted(tree.traits),['Reconstruction','lower_bound'])
+        for trait_label in tree.traits:
+            exp_rows,exp_matrix = self.tree.get_trait_matrix(trait_label)
+            rows,matrix = tree.get_trait_matrix(trait_label)
+            self.assertEqual(rows,exp_rows)
+            self.assertFloatEqual(matrix,exp_matrix)
+
+        #Scalar and missing parameters are kept as they were
+        save_decorated_tree(fp,self.tree,['K1','K2'],0.5)
+        self.assertEqual(load_decorated_tree(fp)[2],0.5)
+        save_decorated_tree(fp,self.tree,['K1','K2'])
+        self.assertEqual(load_decorated_tree(fp)[2],None)
+
+in_tree1 = """((A:0.02,'B 1':0.01)E:0.05,(C,D:0.01):0.05)root;"""
+
+if __name__ == "__main__":
+    main()
@@ -20,8 +20,12 @@ from picrust.util import (get_picrust_project_dir,)
 
 from cogent.core.tree import TreeError
 from cogent.parse.tree import DndParser
+from numpy import array
+from biom.table import table_factory, SparseGeneTable, DenseGeneTable,\
+  SparseOTUTable, DenseTable
 from picrust.util import PicrustNode,\
-  transpose_trait_table_fields
+  transpose_trait_table_fields, is_sparse_biom_table, get_biom_table_type,\
+  get_biom_table_nonzero
 
 class PicrustNodeTests(TestCase):
     def setUp(self):
@@ -145,6 +149,28 @@ class UtilTests(TestCase):
         
         pass
 
+    def test_biom_table_helpers(self):
+        """biom table helpers should give the type and non-zero values of tables"""
+        data = array([[0.0,2.0,0.0],[1.0,0.0,3.0]])
+        sparse = table_factory(data,['s1','s2','s3'],['g1','g2'],\
+          constructor=SparseGeneTable)
+        dense = table_factory(data,['s1','s2','s3'],['g1','g2'],\
+          constructor=DenseGeneTable)
+        self.assertTrue(is_sparse_biom_table(sparse))
+        self.assertFalse(is_sparse_biom_table(dense))
+        self.assertEqual(get_biom_table_type(sparse),'Gene table')
+        self.assertEqual(get_biom_table_type(dense),'Gene table')
+        self.assertEqual(get_biom_table_type(table_factory(data,\
+          ['s1','s2','s3'],['g1','g2'],constructor=SparseOTUTable)),'OTU table')
+        self.assertEqual(get_biom_table_type(table_factory(data,\
+          ['s1','s2','s3'],['g1','g2'],constructor=DenseTable)),None)
+
+        for table in [sparse,dense]:
+            obs_indices,sample_indices,values = get_biom_table_nonzero(table)
+            self.assertEqual(sorted(zip(obs_indices.tolist(),\
+              sample_indices.tolist(),values.tolist())),\
+              [(0,1,2.0),(1,0,1.0),(1,2,3.0)])
+
 
 if __name__ == "__main__":
     main()